@@ -0,0 +1,65 @@
+import os
+import copy
+import time
+import yaml
+import tempfile
+import torch
+from net_utils.train_test_utils import load_device
+from benchmarks.common import BenchResults,machine_info
+from benchmarks.fake_data import make_fake_tree
+from benchmarks.models import bench_config,build_model,load_batch,bench_train,bench_extract_mesh,\
+    bench_inference,bench_dataset,bench_relation
+from benchmarks.geometry import bench_mesh,bench_metrics
+
+def load_yaml(path):
+    with open(path, 'r') as f:
+        return yaml.load(f, Loader=yaml.FullLoader)
+
+def run(cfg):
+    config=cfg.config
+    bench_cfg=config['bench']
+    suites=bench_cfg.get('suites',['train','extract_mesh','inference','dataset','mesh','metrics','relation'])
+    device=load_device(cfg)
+    if bench_cfg.get('num_threads'):
+        torch.set_num_threads(bench_cfg['num_threads'])
+    torch.manual_seed(bench_cfg.get('seed',0))
+    results=BenchResults(cfg)
+
+    '''Fake prepare_data tree'''
+    fake_root=bench_cfg.get('fake_data_dir') or tempfile.mkdtemp(prefix='instpifu_bench_')
+    cfg.log_string('Writing fake data to %s.'%(fake_root))
+    make_fake_tree(fake_root,bench_cfg.get('num_scenes',4),bench_cfg.get('num_objects',4),
+                   bench_cfg.get('num_occ_points',4096),bench_cfg.get('seed',0))
+
+    for name,config_path in bench_cfg['configs'].items():
+        model_config=bench_config(load_yaml(config_path),fake_root,bench_cfg.get('load_dynamic',True))
+        cfg.log_string('Benchmarking %s built from %s.'%(name,config_path))
+        if 'dataset' in suites:
+            bench_dataset(results,name,model_config,bench_cfg)
+        if len(set(suites)&{'train','extract_mesh','inference','mesh'})==0:
+            continue
+        model,optimizer=build_model(copy.deepcopy(model_config),device)
+        if 'train' in suites:
+            bench_train(results,name,model,optimizer,model_config,bench_cfg,device)
+        if 'extract_mesh' in suites and hasattr(model,'extract_mesh'):
+            bench_extract_mesh(results,name,model,model_config,bench_cfg,device)
+        if 'inference' in suites and model_config['method']=='det':
+            bench_inference(results,name,model,model_config,bench_cfg,device)
+        if 'mesh' in suites and model_config['method'] in ['instPIFu','bgPIFu']:
+            intrinsic,height,width=None,None,None
+            if model_config['method']=='bgPIFu':
+                data_batch=load_batch(model_config,1,torch.device('cpu'))
+                intrinsic=data_batch['intrinsic']
+                height,width=data_batch['image'].shape[2:4]
+            bench_mesh(results,model_config['method'],model,bench_cfg,intrinsic,height,width)
+        del model,optimizer
+        if device.type=='cuda':
+            torch.cuda.empty_cache()
+    if 'metrics' in suites:
+        bench_metrics(results,bench_cfg,device)
+    if 'relation' in suites:
+        bench_relation(results,bench_cfg,device)
+
+    output=bench_cfg.get('output') or os.path.join(cfg.save_path,'bench_%s.json'%(time.strftime('%Y%m%d_%H%M%S')))
+    results.dump(output,machine_info(device),bench_cfg)
+    cfg.log_string('Benchmark results written to %s.'%(output))
@@ -0,0 +1,3 @@
+# Benchmark suite of the reconstruction and detection hot paths, run by main.py --mode bench.
+# The networks are built from the shipped configs with random weights and fed with synthetic inputs,
+# so it runs on any machine (cpu included) without checkpoints or the 3D-FRONT data.
@@ -0,0 +1,114 @@
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+import numpy as np
+import torch
+from net_utils.profiler import current_rss_mb
+
+def synchronize(device):
+    if device is not None and torch.device(device).type == 'cuda':
+        torch.cuda.synchronize()
+
+def time_fn(fn, device=None, warmup=1, iterations=3):
+    '''
+    call fn warmup times untimed, then iterations times.
+    :return: dict of the timings in seconds (mean, std, min, p50, max), the peak cuda memory and the resident memory
+    '''
+    for _ in range(warmup):
+        fn()
+    synchronize(device)
+    if device is not None and torch.device(device).type == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+    times = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        synchronize(device)
+        times.append(time.perf_counter() - start)
+    times = np.array(times)
+    result = {
+        'iterations': int(times.shape[0]),
+        'mean': float(times.mean()),
+        'std': float(times.std()),
+        'min': float(times.min()),
+        'p50': float(np.percentile(times, 50)),
+        'max': float(times.max()),
+        'rss_mb': current_rss_mb(),
+    }
+    if device is not None and torch.device(device).type == 'cuda':
+        result['peak_mem_mb'] = torch.cuda.max_memory_allocated() / 1024 ** 2
+    return result
+
+def cpu_model():
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor()
+
+def total_memory_gb():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024 ** 3
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def machine_info(device):
+    info = {
+        'hostname': platform.node(),
+        'platform': platform.platform(),
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'torch': torch.__version__,
+        'cpu': cpu_model(),
+        'cpu_count': os.cpu_count(),
+        'torch_threads': torch.get_num_threads(),
+        'memory_gb': total_memory_gb(),
+        'device': str(device),
+        'cuda': torch.version.cuda,
+        'git_commit': git_commit(),
+    }
+    if torch.device(device).type == 'cuda':
+        info['gpu'] = torch.cuda.get_device_name(device)
+    return info
+
+class BenchResults(object):
+    '''
+    list of timed cases, each one is suite/name with its parameters.
+    '''
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.records = []
+
+    def add(self, suite, name, params, result):
+        record = {'suite': suite, 'name': name, 'params': params}
+        record.update(result)
+        self.records.append(record)
+        if 'mean' in result:
+            self.cfg.log_string('[%s] %-12s %-40s mean %9.2f ms, p50 %9.2f ms' % (
+                suite, name, json.dumps(params), result['mean'] * 1e3, result['p50'] * 1e3))
+        else:
+            self.cfg.log_string('[%s] %-12s %-40s %s' % (suite, name, json.dumps(params), result.get('error', '')))
+
+    def skip(self, suite, name, params, error):
+        self.add(suite, name, params, {'error': '%s: %s' % (type(error).__name__, error)})
+
+    def dump(self, path, machine, bench_config):
+        save_dir = os.path.dirname(path)
+        if save_dir and not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+        with open(path, 'w') as f:
+            json.dump({'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'machine': machine,
+                       'bench': bench_config, 'results': self.records}, f, indent=2)
+        return path
@@ -0,0 +1,134 @@
+# Writes a small prepare_data tree with the layout of data/3dfront (prepare_data pickles, splits, occupancy
+# samples and instance masks) filled with random values, so the datasets can be timed without the real data.
+# The object, background and detection datasets all read the same scene pickles, as with the real tree.
+import os
+import json
+import pickle
+import numpy as np
+from PIL import Image
+
+'''prepare_data stores the rgb image downsampled by 2, the intrinsic is the one of the 1296x968 image'''
+IMAGE_WIDTH = 648
+IMAGE_HEIGHT = 484
+FULL_K = np.array([[1168., 0., 648.],
+                   [0., 1168., 484.],
+                   [0., 0., 1.]])
+
+def write_obj_points(path, points):
+    with open(path, 'w') as f:
+        for point in points:
+            f.write('v %f %f %f\n' % (point[0], point[1], point[2]))
+
+def fake_boxes(rng, num_objects):
+    '''
+    object boxes in front of the camera, the world frame is the camera frame with x and y flipped.
+    '''
+    size_cls = rng.randint(0, 9, num_objects)
+    tran_matrix = np.tile(np.eye(4), (num_objects, 1, 1))
+    tran_matrix[:, 0, 3] = rng.uniform(-1, 1, num_objects)
+    tran_matrix[:, 2, 3] = rng.uniform(2.5, 4, num_objects)
+    cam_center = np.stack([-tran_matrix[:, 0, 3], np.zeros(num_objects), tran_matrix[:, 2, 3]], axis=1)
+
+    '''2D boxes around the projected centers, in the pixels of the full resolution image'''
+    u = FULL_K[0, 0] * cam_center[:, 0] / cam_center[:, 2] + FULL_K[0, 2]
+    v = FULL_K[1, 1] * cam_center[:, 1] / cam_center[:, 2] + FULL_K[1, 2]
+    half = FULL_K[0, 0] * 0.6 / cam_center[:, 2]
+    bdb2D_pos = np.stack([np.clip(u - half, 0, 1200), np.clip(v - half, 0, 900),
+                          np.clip(u + half, 96, 1296), np.clip(v + half, 68, 968)], axis=1)
+    return {
+        'jid': ['bench_%d' % (cls) for cls in size_cls],
+        'size_cls': size_cls,
+        'size_reg': rng.uniform(-0.2, 0.2, (num_objects, 3)),
+        'scale': np.ones((num_objects, 3)),
+        'tran_matrix': tran_matrix,
+        'cam_center': cam_center,
+        'bdb2D_pos': bdb2D_pos,
+        'ori_cls': rng.randint(0, 6, num_objects),
+        'ori_reg': rng.uniform(-0.5, 0.5, num_objects),
+        'centroid_cls': np.clip(cam_center[:, 2].astype(np.int64), 0, 9),
+        'centroid_reg': rng.uniform(-0.5, 0.5, num_objects),
+        'delta_2D': rng.uniform(-0.1, 0.1, (num_objects, 2)),
+        'bdb3D': cam_center[:, None, :] + rng.uniform(-0.5, 0.5, (num_objects, 8, 3)),
+        'yaw': rng.uniform(-np.pi, np.pi, num_objects),
+    }
+
+def fake_scene(rng, sequence_id, num_objects):
+    return {
+        'sequence_id': sequence_id,
+        'rgb_img': rng.randint(0, 256, (IMAGE_HEIGHT, IMAGE_WIDTH, 3)).astype(np.uint8),
+        'depth_map': rng.uniform(1, 8, (IMAGE_HEIGHT, IMAGE_WIDTH)).astype(np.float32),
+        'camera': {'K': FULL_K.copy(), 'wrd2cam_matrix': np.eye(4),
+                   'pitch_cls': 1, 'pitch_reg': rng.uniform(-0.5, 0.5),
+                   'roll_cls': 1, 'roll_reg': rng.uniform(-0.5, 0.5)},
+        'layout': {'pitch': rng.uniform(-0.3, 0.3), 'roll': rng.uniform(-0.1, 0.1),
+                   'centroid_reg': rng.uniform(-0.5, 0.5, 3), 'coeffs_reg': rng.uniform(-0.5, 0.5, 3),
+                   'bdb3D': rng.uniform(-3, 3, (8, 3))},
+        'boxes': fake_boxes(rng, num_objects),
+    }
+
+def make_fake_tree(root, num_scenes=4, num_objects=4, num_occ_points=4096, seed=0):
+    '''
+    :param root: folder to write the tree to, it is overwritten file by file
+    :param num_occ_points: inside and outside occupancy samples per object and per scene,
+                           the datasets draw 2048 (objects) and 2500 (background) of each
+    :return: root
+    '''
+    rng = np.random.RandomState(seed)
+    for folder in ['prepare_data/train', 'prepare_data/test', 'split/train', 'split/test', 'occ', 'bgocc',
+                   'bg_split', 'mask']:
+        if not os.path.exists(os.path.join(root, folder)):
+            os.makedirs(os.path.join(root, folder))
+    object_split, bg_split, jid_set = [], [], set()
+    for scene_id in range(num_scenes):
+        taskid = 'bench%05d' % (scene_id)
+        sequence = fake_scene(rng, taskid, num_objects)
+        for mode in ['train', 'test']:
+            with open(os.path.join(root, 'prepare_data', mode, taskid + '.pkl'), 'wb') as f:
+                pickle.dump(sequence, f)
+        for object_id in range(num_objects):
+            object_split.append([taskid, object_id])
+            mask = np.zeros((IMAGE_HEIGHT, IMAGE_WIDTH), dtype=np.uint8)
+            bdb = (sequence['boxes']['bdb2D_pos'][object_id] / 2).astype(np.int64)
+            mask[bdb[1]:bdb[3], bdb[0]:bdb[2]] = 255
+            Image.fromarray(mask).save(os.path.join(root, 'mask', '%s_%s.png' % (taskid, object_id)))
+        jid_set.update(sequence['boxes']['jid'])
+
+        '''background samples in the camera frame'''
+        bg_split.append({'render_id': taskid, 'scene_id': 'bench'})
+        os.makedirs(os.path.join(root, 'bgocc', taskid), exist_ok=True)
+        for name in ['inside_points.obj', 'outside_points.obj']:
+            points = rng.uniform([-3, -2, 1], [3, 2, 10], (num_occ_points, 3))
+            write_obj_points(os.path.join(root, 'bgocc', taskid, name), points)
+
+    for jid in jid_set:
+        os.makedirs(os.path.join(root, 'occ', jid), exist_ok=True)
+        write_obj_points(os.path.join(root, 'occ', jid, 'inside_points.obj'), rng.uniform(-0.4, 0.4, (num_occ_points, 3)))
+        write_obj_points(os.path.join(root, 'occ', jid, 'outside_points.obj'), rng.uniform(-0.6, 0.6, (num_occ_points, 3)))
+    for mode in ['train', 'test']:
+        with open(os.path.join(root, 'split', mode, 'bench.json'), 'w') as f:
+            json.dump(object_split, f)
+        with open(os.path.join(root, 'bg_split', mode + '.json'), 'w') as f:
+            json.dump(bg_split, f)
+    return root
+
+def use_fake_tree(config, root, load_dynamic=True):
+    '''
+    point the data section of a shipped config to the fake tree, in place.
+    '''
+    data = config['data']
+    data['data_path'] = os.path.join(root, 'prepare_data')
+    data['num_workers'] = 0
+    data['distributed'] = False
+    if data['dataset'] == 'front3d_recon':
+        data['split_dir'] = os.path.join(root, 'split')
+        data['occ_path'] = os.path.join(root, 'occ')
+        data['mask_path'] = os.path.join(root, 'mask')
+        data['class_name'] = 'bench'
+        data['test_class_name'] = 'bench'
+        data['use_pred_pose'] = False
+        data['load_dynamic'] = load_dynamic
+    elif data['dataset'] == 'front3d_bg':
+        data['split_path'] = os.path.join(root, 'bg_split')
+        data['occ_path'] = os.path.join(root, 'bgocc')
+        data['load_dynamic'] = load_dynamic
+    return config
@@ -0,0 +1,103 @@
+# Marching cubes + cleanup on synthetic occupancy volumes and the evaluation metrics on sampled surfaces.
+import numpy as np
+import torch
+from benchmarks.common import time_fn
+
+def object_volume(resolution, rng, num_blobs=3):
+    '''
+    occupancy of a union of spheres plus small floating blobs on the [-1.2, 1.2]^3 grid of InstPIFu,
+    the blobs give the connected component cleanup something to remove.
+    :return: [1, resolution**3] tensor
+    '''
+    coor = np.linspace(-1.2, 1.2, resolution)
+    X, Y, Z = np.meshgrid(coor, coor, coor, indexing='ij')
+    sdf = np.full(X.shape, np.inf)
+    for center, radius in zip(rng.uniform(-0.3, 0.3, (num_blobs, 3)), rng.uniform(0.3, 0.6, num_blobs)):
+        sdf = np.minimum(sdf, np.sqrt((X - center[0]) ** 2 + (Y - center[1]) ** 2 + (Z - center[2]) ** 2) - radius)
+    for center in rng.uniform(-1, 1, (num_blobs, 3)):
+        sdf = np.minimum(sdf, np.sqrt((X - center[0]) ** 2 + (Y - center[1]) ** 2 + (Z - center[2]) ** 2) - 0.08)
+    occ = 1 / (1 + np.exp(sdf * 20))
+    return torch.from_numpy(occ.reshape(1, -1)).float()
+
+def room_volume(resolution):
+    '''
+    occupancy of the background grid of BGPIFu (x -3~3, y -2~2, z 1~10), 1 is outside the room.
+    :return: [1, resolution**3] tensor
+    '''
+    X, Y, Z = np.meshgrid(np.linspace(-3, 3, resolution), np.linspace(-2, 2, resolution),
+                          np.linspace(1, 10, resolution), indexing='ij')
+    margin = np.minimum(np.minimum(2.5 - np.abs(X), 1.5 - np.abs(Y)), 8 - Z)
+    occ = 1 / (1 + np.exp(margin * 10))
+    return torch.from_numpy(occ.reshape(1, -1)).float()
+
+def bench_mesh(results, name, model, bench_cfg, intrinsic=None, height=None, width=None):
+    '''
+    time meshes_from_pred (object) or mesh_from_volume (background) on synthetic volumes, i.e. the
+    device to host copy, marching cubes and the component cleanup of extract_mesh.
+    '''
+    rng = np.random.RandomState(0)
+    for resolution in bench_cfg.get('resolutions', [32, 64, 128]):
+        if name == 'instPIFu':
+            volume = object_volume(resolution, rng)
+            fn = lambda: model.meshes_from_pred(volume, resolution)
+        else:
+            volume = room_volume(resolution)
+            fn = lambda: model.mesh_from_volume(volume, intrinsic.cpu(), height, width, resolution)
+        results.add('mesh', name, {'resolution': resolution},
+                    time_fn(fn, None, bench_cfg.get('warmup', 1), bench_cfg.get('iterations', 3)))
+
+OCCNET_FSCORE_EPS = 1e-09
+
+def fscore(points1, points2, tau=0.002):
+    '''
+    F-score at tau as computed by evaluate_object_reconstruction.py.
+    '''
+    from scipy.spatial import cKDTree
+    dist12 = cKDTree(points2).query(points1, workers=-1)[0]
+    dist21 = cKDTree(points1).query(points2, workers=-1)[0]
+    precision = np.mean((dist12 ** 2 <= tau).astype(np.float32)) * 100.0
+    recall = np.mean((dist21 ** 2 <= tau).astype(np.float32)) * 100.0
+    return (2 * precision * recall) / (precision + recall + OCCNET_FSCORE_EPS)
+
+def kdtree_chamfer(points1, points2):
+    '''
+    symmetric chamfer distance (mean of squared distances), the cpu counterpart of ChamferDistance.
+    '''
+    from scipy.spatial import cKDTree
+    dist12 = cKDTree(points2).query(points1, workers=-1)[0]
+    dist21 = cKDTree(points1).query(points2, workers=-1)[0]
+    return np.mean(dist12 ** 2) + np.mean(dist21 ** 2)
+
+def bench_metrics(results, bench_cfg, device):
+    '''
+    surface sampling, F-score, chamfer distance with kd-trees and with the ChamferDistance extension
+    used by the evaluation scripts (skipped when it cannot be built here).
+    '''
+    import trimesh
+    pred_mesh = trimesh.creation.icosphere(subdivisions=4, radius=0.5)
+    gt_mesh = trimesh.creation.icosphere(subdivisions=4, radius=0.5)
+    gt_mesh.vertices = gt_mesh.vertices * np.array([1.0, 0.9, 1.1])
+    try:
+        from external.pyTorchChamferDistance.chamfer_distance import ChamferDistance
+        dist_chamfer = ChamferDistance()
+        chamfer_error = None
+    except Exception as e:
+        dist_chamfer = None
+        chamfer_error = e
+    warmup, iterations = bench_cfg.get('warmup', 1), bench_cfg.get('iterations', 3)
+    for num_points in bench_cfg.get('metric_points', [10000]):
+        params = {'num_points': num_points}
+        results.add('metrics', 'mesh_sample', params, time_fn(lambda: pred_mesh.sample(num_points), None, warmup, iterations))
+        pred_points, gt_points = pred_mesh.sample(num_points), gt_mesh.sample(num_points)
+        results.add('metrics', 'fscore', params, time_fn(lambda: fscore(pred_points, gt_points), None, warmup, iterations))
+        results.add('metrics', 'chamfer_kdtree', params,
+                    time_fn(lambda: kdtree_chamfer(pred_points, gt_points), None, warmup, iterations))
+        if dist_chamfer is None:
+            results.skip('metrics', 'chamfer_ext', params, chamfer_error)
+            continue
+        pred_tensor = torch.from_numpy(pred_points).float().to(device).unsqueeze(0)
+        gt_tensor = torch.from_numpy(gt_points).float().to(device).unsqueeze(0)
+        def chamfer():
+            dist1, dist2 = dist_chamfer(gt_tensor, pred_tensor)[:2]
+            return torch.mean(dist1) + torch.mean(dist2)
+        results.add('metrics', 'chamfer_ext', params, time_fn(chamfer, device, warmup, iterations))
@@ -0,0 +1,171 @@
+# Training step, mesh extraction and dataset timings of InstPIFu, BGPIFu_Net and TOTAL3D.
+import copy
+import torch
+from net_utils.train_test_utils import get_model,get_dataloader,get_optimizer
+from net_utils.profiler import profiler
+from benchmarks.fake_data import use_fake_tree
+from benchmarks.common import time_fn
+from models.detection.relation_net import RelationNet
+
+'''per point inputs of the training batches, resampled to the benchmarked point counts'''
+point_keys = {
+    'instPIFu': ['samples', 'inside_class', 'z_feat', 'img_coor'],
+    'bgPIFu': ['samples', 'inside_class'],
+}
+
+def bench_config(config, fake_root, load_dynamic=True):
+    '''
+    copy of a shipped config that builds the network with random weights and reads the fake tree.
+    '''
+    config = copy.deepcopy(config)
+    config['resume'] = False
+    config['mode'] = 'train'
+    config['debug'] = False
+    config['isTrain'] = True
+    config['model']['runtime'] = 'eager'
+    config['model']['use_quantized'] = False
+    config['model']['pretrained_resnet'] = False
+    config['device']['use_amp'] = False
+    return use_fake_tree(config, fake_root, load_dynamic)
+
+def build_model(config, device):
+    model = get_model(config, device).float()
+    if 'optimizer' in config:
+        optimizer = get_optimizer(config, model)
+    else:
+        optimizer = torch.optim.Adam([param for param in model.parameters() if param.requires_grad], lr=1e-4)
+    return model, optimizer
+
+def load_batch(config, batch_size, device):
+    '''
+    :return: the first batch of the fake training set, on device in the format the network takes
+    '''
+    config = copy.deepcopy(config)
+    config['data']['batch_size'] = batch_size
+    loader = get_dataloader(config, mode='train')
+    data_batch = next(iter(loader))
+    if config['method'] == 'det':
+        from net_utils.tools import total3d_todevice
+        return total3d_todevice(config, data_batch, device)
+    for key in data_batch:
+        if isinstance(data_batch[key], list) == False:
+            data_batch[key] = data_batch[key].float().to(device)
+    return data_batch
+
+def resample_points(data_batch, keys, num_points):
+    index = torch.randint(0, data_batch[keys[0]].shape[1], (num_points,), device=data_batch[keys[0]].device)
+    data_batch = dict(data_batch)
+    for key in keys:
+        data_batch[key] = data_batch[key][:, index]
+    return data_batch
+
+def train_step(model, optimizer, data_batch):
+    optimizer.zero_grad()
+    est_data, loss_dict = model(data_batch)
+    loss = loss_dict['loss'] if 'loss' in loss_dict else loss_dict['total']
+    torch.mean(loss).backward()
+    optimizer.step()
+
+def stage_breakdown(fn):
+    '''
+    run fn once with the stage profiler on and return its per-stage summary.
+    '''
+    enabled = profiler.enabled
+    profiler.enabled = True
+    profiler.reset()
+    try:
+        fn()
+    finally:
+        profiler.enabled = enabled
+    summary = {name: {'count': item['count'], 'total': item['total']} for name, item in profiler.summary().items()}
+    profiler.reset()
+    return summary
+
+def bench_train(results, name, model, optimizer, config, bench_cfg, device):
+    model.train()
+    for batch_size in bench_cfg.get('batch_sizes', [1]):
+        data_batch = load_batch(config, batch_size, device)
+        num_points_list = bench_cfg.get('num_points', [4096]) if name in point_keys else [None]
+        for num_points in num_points_list:
+            params = {'batch_size': batch_size}
+            batch = data_batch
+            if num_points is not None:
+                params['num_points'] = num_points
+                batch = resample_points(data_batch, point_keys[name], num_points)
+            try:
+                result = time_fn(lambda: train_step(model, optimizer, batch), device,
+                                 bench_cfg.get('warmup', 1), bench_cfg.get('iterations', 3))
+            except RuntimeError as e:
+                '''out of memory at the larger sizes is reported instead of ending the run'''
+                results.skip('train', name, params, e)
+                continue
+            results.add('train', name, params, result)
+
+def bench_extract_mesh(results, name, model, config, bench_cfg, device):
+    model.eval()
+    data_batch = load_batch(config, 1, device)
+    for resolution in bench_cfg.get('resolutions', [32, 64, 128]):
+        params = {'resolution': resolution}
+        def extract():
+            with torch.no_grad():
+                model.extract_mesh(data_batch, resolution)
+        try:
+            result = time_fn(extract, device, bench_cfg.get('warmup', 1), bench_cfg.get('iterations', 3))
+            result['stages'] = stage_breakdown(extract)
+        except RuntimeError as e:
+            results.skip('extract_mesh', name, params, e)
+            continue
+        results.add('extract_mesh', name, params, result)
+
+def bench_inference(results, name, model, config, bench_cfg, device):
+    '''
+    forward pass of the detection network as run by Det_tester.
+    '''
+    model.eval()
+    for batch_size in bench_cfg.get('batch_sizes', [1]):
+        data_batch = load_batch(config, batch_size, device)
+        def forward():
+            with torch.no_grad():
+                model(data_batch)
+        results.add('inference', name, {'batch_size': batch_size},
+                    time_fn(forward, device, bench_cfg.get('warmup', 1), bench_cfg.get('iterations', 3)))
+
+def bench_dataset(results, name, config, bench_cfg):
+    '''
+    Dataset.__getitem__ on the fake tree, loading from disk (load_dynamic) as in the test configs.
+    '''
+    dataset = get_dataloader(config, mode='train').dataset
+    count = [0]
+    def getitem():
+        dataset[count[0] % len(dataset)]
+        count[0] += 1
+    results.add('dataset', name, {'load_dynamic': config['data'].get('load_dynamic', True), 'items': len(dataset)},
+                time_fn(getitem, None, bench_cfg.get('warmup', 1), bench_cfg.get('dataset_iterations', 20)))
+
+def bench_relation(results, bench_cfg, device):
+    '''
+    RelationNet with the batched attention against the per image loop, on random features of images with
+    1 to max_objects objects. The largest difference of the two r_features is recorded with the timings.
+    '''
+    relnet = RelationNet().to(device).eval()
+    generator = torch.Generator().manual_seed(bench_cfg.get('seed', 0))
+    for batch_size in bench_cfg.get('relation_batch_sizes', [16]):
+        for max_objects in bench_cfg.get('relation_max_objects', [10, 30]):
+            counts = torch.randint(1, max_objects + 1, (batch_size,), generator=generator)
+            counts[0] = max_objects
+            ends = torch.cumsum(counts, 0)
+            split = torch.stack([ends - counts, ends], 1)
+            rel_pair_counts = torch.cat([torch.tensor([0]), torch.cumsum(counts * counts, 0)], 0)
+            a_features = torch.randn(int(ends[-1]), 2048, generator=generator).to(device)
+            g_features = torch.randn(int(rel_pair_counts[-1]), 64, generator=generator).to(device)
+            outputs = {}
+            for batched in [True, False]:
+                def forward():
+                    relnet.batched = batched
+                    with torch.no_grad():
+                        outputs[batched] = relnet(a_features, g_features, split, rel_pair_counts)
+                result = time_fn(forward, device, bench_cfg.get('warmup', 1), bench_cfg.get('iterations', 3))
+                if not batched:
+                    result['max_abs_diff'] = (outputs[True] - outputs[False]).abs().max().item()
+                results.add('relation', 'batched' if batched else 'per_image',
+                            {'batch_size': batch_size, 'max_objects': max_objects}, result)
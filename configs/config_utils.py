@@ -8,6 +8,7 @@ import logging
 from datetime import datetime
 from configs.data_config import Config as Data_Config
 from net_utils.libs import to_dict_tensor
+from net_utils.distributed import is_main_process
 
 def update_recursive(dict1, dict2):
     ''' Update two config dictionaries recursively.
@@ -72,6 +73,9 @@ class CONFIG(object):
         return logger, save_path
 
     def log_string(self, content):
+        # only the main process logs when running with torch.distributed
+        if not is_main_process():
+            return
         self._logger.info(content)
         print(content)
 
@@ -12,6 +12,7 @@ import cv2
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 import json
 import tqdm
+from net_utils.loader_tuning import loader_options
 
 mean = [0.485, 0.456, 0.406]
 std = [0.229, 0.224, 0.225]
@@ -300,7 +301,7 @@ def Front3D_bg_Dataloader(cfg,mode):
                             num_workers=cfg['data']['num_workers'],
                             batch_size=cfg['data']['batch_size'],
                             shuffle=(mode == 'train'),
-                            worker_init_fn=worker_init_fn, pin_memory=True
+                            worker_init_fn=worker_init_fn, **loader_options(cfg)
                             )
     return dataloader
 
@@ -14,6 +14,8 @@ import glob
 import json
 import random
 from net_utils.bins import *
+from net_utils.loader_tuning import loader_options
+from dataset.relation_features import g_features
 from scipy import io
 from tqdm import tqdm
 import cv2
@@ -67,66 +69,57 @@ class Front_Det_Dataset(Dataset):
         file_path = self.split[index]
         with open(file_path, 'rb') as f:
             sequence = pickle.load(f)
-        image = Image.fromarray(sequence['rgb_img'])
-        width,height=image.size
-        depth = Image.fromarray(sequence['depth_map'])
-        try:
-            camera = sequence['camera']
-            #print(camera["K"])
-        except:
-            print(sequence['sequence_id'])
-        boxes = sequence['boxes']
-        layout=sequence['layout']
-        # build relational geometric features for each object
-        n_objects = boxes['bdb2D_pos'].shape[0]
-        # g_feature: n_objects x n_objects x 4
-        # Note that g_feature is not symmetric,
-        # g_feature[m, n] is the feature of object m contributes to object n.
-        #print(boxes['bdb2D_pos'])
-        g_feature = [[((loc2[0] + loc2[2]) / 2. - (loc1[0] + loc1[2]) / 2.) / (loc1[2] - loc1[0]),
-                      ((loc2[1] + loc2[3]) / 2. - (loc1[1] + loc1[3]) / 2.) / (loc1[3] - loc1[1]),
-                      math.log((loc2[2] - loc2[0]) / (loc1[2] - loc1[0])),
-                      math.log((loc2[3] - loc2[1]) / (loc1[3] - loc1[1]))] \
-                     for id1, loc1 in enumerate(boxes['bdb2D_pos'])
-                     for id2, loc2 in enumerate(boxes['bdb2D_pos'])]
-
-        locs = [num for loc in g_feature for num in loc]
-
-        pe = torch.zeros(len(locs), d_model)
-        position = torch.from_numpy(np.array(locs)).unsqueeze(1).float()
-        #print(position.shape)
-        div_term = torch.exp(torch.arange(0, d_model, 2).float() * -(math.log(10000.) / d_model))
-        pe[:, 0::2] = torch.sin(position * div_term)
-        pe[:, 1::2] = torch.cos(position * div_term)
-
-        boxes['g_feature'] = pe.view(n_objects * n_objects, rel_cfg.d_g)
-
-        # encode class
-        cls_codes = torch.zeros([len(boxes['size_cls']), 9])
-        cls_codes[range(len(boxes['size_cls'])), boxes['size_cls']] = 1
-        boxes['size_cls'] = cls_codes
-
-        #layout = sequence['layout']
-        patch = []
-        box_feat=[]
-        for bdb in boxes['bdb2D_pos']:
-            img = image.crop((bdb[0]/2, bdb[1]/2, bdb[2]/2, bdb[3]/2))
-            img = np.asarray(img)/255.0
-            if self.mode=="train":
-                img = self.augment_image(img)
-            img = data_transforms(img).float()
-            patch.append(img)
-
-            box_feat.append(torch.tensor([(bdb[2]-bdb[0])/width,(bdb[3]-bdb[1])/height,(bdb[2]+bdb[0])/width,(bdb[3]+bdb[1])/height]))
-        #print(box_feat)
-        boxes['patch'] = torch.stack(patch)
-        boxes['box_feat']=torch.stack(box_feat)
-        image = data_transforms(image)
-        if self.mode != 'test':
-            for d, k in zip([camera, boxes], ['world_R_inv', 'bdb3d_inv']):
-                if k in d.keys():
-                    d.pop(k)
-        return {'image':image, 'depth': pil2tensor(depth).squeeze(), 'layout':layout,'boxes_batch':boxes, 'camera':camera, 'sequence_id': sequence['sequence_id']}
+        return det_sample(sequence, self.mode, self.augment_image if self.mode == "train" else None)
+
+
+def det_sample(sequence, mode='test', augment=None):
+    '''
+    TOTAL3D inputs of a loaded prepare_data sequence, the boxes of sequence are left unchanged.
+    :param augment: optional function applied to every [0, 1] patch
+    :return: sample dict read by collate_fn
+    '''
+    image = Image.fromarray(sequence['rgb_img'])
+    width,height=image.size
+    depth = Image.fromarray(sequence['depth_map'])
+    try:
+        camera = sequence['camera']
+        #print(camera["K"])
+    except:
+        print(sequence['sequence_id'])
+    boxes = dict(sequence['boxes'])
+    layout=sequence['layout']
+    # build relational geometric features for each object
+    # g_feature: n_objects x n_objects x 4
+    # Note that g_feature is not symmetric,
+    # g_feature[m, n] is the feature of object m contributes to object n.
+    boxes['g_feature'] = g_features(boxes['bdb2D_pos'])
+
+    # encode class
+    cls_codes = torch.zeros([len(boxes['size_cls']), 9])
+    cls_codes[range(len(boxes['size_cls'])), boxes['size_cls']] = 1
+    boxes['size_cls'] = cls_codes
+
+    #layout = sequence['layout']
+    patch = []
+    box_feat=[]
+    for bdb in boxes['bdb2D_pos']:
+        img = image.crop((bdb[0]/2, bdb[1]/2, bdb[2]/2, bdb[3]/2))
+        img = np.asarray(img)/255.0
+        if augment is not None:
+            img = augment(img)
+        img = data_transforms(img).float()
+        patch.append(img)
+
+        box_feat.append(torch.tensor([(bdb[2]-bdb[0])/width,(bdb[3]-bdb[1])/height,(bdb[2]+bdb[0])/width,(bdb[3]+bdb[1])/height]))
+    #print(box_feat)
+    boxes['patch'] = torch.stack(patch)
+    boxes['box_feat']=torch.stack(box_feat)
+    image = data_transforms(image)
+    if mode != 'test':
+        for d, k in zip([camera, boxes], ['world_R_inv', 'bdb3d_inv']):
+            if k in d.keys():
+                d.pop(k)
+    return {'image':image, 'depth': pil2tensor(depth).squeeze(), 'layout':layout,'boxes_batch':boxes, 'camera':camera, 'sequence_id': sequence['sequence_id']}
 
 
 default_collate = torch.utils.data.dataloader.default_collate
@@ -193,5 +186,6 @@ def Front_det_dataloader(config, mode='train'):
                             batch_size=config['data']['batch_size'],
                             shuffle=(mode == 'train'),
                             collate_fn=collate_fn,
-                            worker_init_fn=worker_init_fn)
+                            worker_init_fn=worker_init_fn,
+                            **loader_options(config, default_pin_memory=False))
     return dataloader
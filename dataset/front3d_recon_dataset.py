@@ -12,6 +12,8 @@ import numpy as np
 import json
 import random
 from net_utils.bins import *
+from net_utils.loader_tuning import loader_options
+from net_utils.tools import load_pred_result
 from tqdm import tqdm
 
 category_label_mapping = {"table": 0,
@@ -272,9 +274,7 @@ class Front3D_Recon_Dataset(Dataset):
             rot_matrix = np.dot(wrd2cam_matrix[0:3, 0:3], tran_matrix[0:3, 0:3])
             '''inference using predicted pose'''
             if self.use_pred_pose:
-                pred_result_path = os.path.join(self.config['data']['pred_pose_path'], "%s.pkl" % (taskid))
-                with open(pred_result_path, 'rb') as f:
-                    pred_result = pickle.load(f)
+                pred_result = load_pred_result(self.config['data']['pred_pose_path'], taskid)
                 pitch = pred_result["layout"]['pitch']
                 roll = pred_result["layout"]["roll"]
                 bboxes = pred_result["bboxes"][object_ind]
@@ -386,7 +386,7 @@ def Front3D_Recon_dataloader(config, mode='train'):
                             num_workers=config['data']['num_workers'],
                             batch_size=config['data']['batch_size'],
                             shuffle=(mode == 'train'),
-                            worker_init_fn=worker_init_fn, pin_memory=True
+                            worker_init_fn=worker_init_fn, **loader_options(config)
                             )
     return dataloader
 
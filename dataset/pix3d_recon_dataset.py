@@ -13,6 +13,7 @@ import numpy as np
 import pickle as p
 from torch.utils.data import DataLoader
 from PIL import ImageFile
+from net_utils.loader_tuning import loader_options
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
 def get_rot_from_yaw(yaw):
@@ -377,7 +378,7 @@ def Pix3D_Recon_dataloader(config, mode='train'):
                             num_workers=config['data']['num_workers'],
                             batch_size=config['data']['batch_size'],
                             shuffle=(mode == 'train'),
-                            worker_init_fn=worker_init_fn, pin_memory=True
+                            worker_init_fn=worker_init_fn, **loader_options(config)
                             )
     return dataloader
 
@@ -0,0 +1,76 @@
+# Relational geometric features of the 2D boxes read by the RelationNet of TOTAL3D.
+# g_features builds the n_objects x n_objects feature with array broadcasting, the detection dataset and the
+# demos share it. g_features_reference is the original per pair loop, check_g_features asserts the two agree.
+import math
+import numpy as np
+import torch
+from configs.data_config import Relation_Config
+
+rel_cfg = Relation_Config()
+
+def position_encoding(locs, d_g=rel_cfg.d_g):
+    '''
+    sinusoidal encoding of every scalar of locs with d_g/4 channels.
+    :param locs: [N] float64 array
+    :return: [N, d_g/4] float tensor
+    '''
+    d_model = int(d_g / 4)
+    pe = torch.zeros(len(locs), d_model)
+    position = torch.from_numpy(np.asarray(locs)).unsqueeze(1).float()
+    div_term = torch.exp(torch.arange(0, d_model, 2).float() * -(math.log(10000.) / d_model))
+    pe[:, 0::2] = torch.sin(position * div_term)
+    pe[:, 1::2] = torch.cos(position * div_term)
+    return pe
+
+def g_features(bdb2D_pos, d_g=rel_cfg.d_g):
+    '''
+    g_feature[m, n] is the feature of object m contributes to object n, it is not symmetric.
+    :param bdb2D_pos: [n_objects, 4] x1, y1, x2, y2
+    :return: [n_objects * n_objects, d_g] float tensor, row m * n_objects + n holds the pair (m, n)
+    '''
+    bdb2D_pos = np.asarray(bdb2D_pos)
+    n_objects = bdb2D_pos.shape[0]
+    center = (bdb2D_pos[:, 0:2] + bdb2D_pos[:, 2:4]) / 2.
+    size = bdb2D_pos[:, 2:4] - bdb2D_pos[:, 0:2]
+    # same dtypes as the per pair loop, math.log takes the log in float64 whatever the box dtype
+    ratio = (size[np.newaxis, :, :] / size[:, np.newaxis, :]).astype(np.float64)
+    g_feature = np.concatenate([(center[np.newaxis, :, :] - center[:, np.newaxis, :]) / size[:, np.newaxis, :],
+                                np.log(ratio)], axis=2).astype(np.float64)
+    return position_encoding(g_feature.reshape(-1), d_g).view(n_objects * n_objects, d_g)
+
+def g_features_reference(bdb2D_pos, d_g=rel_cfg.d_g):
+    '''
+    the per pair implementation g_features replaces, kept for check_g_features.
+    '''
+    n_objects = len(bdb2D_pos)
+    g_feature = [[((loc2[0] + loc2[2]) / 2. - (loc1[0] + loc1[2]) / 2.) / (loc1[2] - loc1[0]),
+                  ((loc2[1] + loc2[3]) / 2. - (loc1[1] + loc1[3]) / 2.) / (loc1[3] - loc1[1]),
+                  math.log((loc2[2] - loc2[0]) / (loc1[2] - loc1[0])),
+                  math.log((loc2[3] - loc2[1]) / (loc1[3] - loc1[1]))] \
+                 for id1, loc1 in enumerate(bdb2D_pos)
+                 for id2, loc2 in enumerate(bdb2D_pos)]
+
+    locs = [num for loc in g_feature for num in loc]
+    return position_encoding(np.array(locs), d_g).view(n_objects * n_objects, d_g)
+
+def check_g_features(n_trials=20, max_objects=40, seed=0, atol=1e-5):
+    '''
+    compare g_features with g_features_reference on random integer and float boxes.
+    np.log and math.log may differ in the last bit, which can move a float32 encoding by an ulp, hence atol.
+    :return: largest absolute difference over all trials, an AssertionError is raised when it exceeds atol
+    '''
+    rng = np.random.RandomState(seed)
+    max_diff = 0.
+    for trial in range(n_trials):
+        n_objects = rng.randint(1, max_objects + 1)
+        corner = rng.uniform(0, 600, size=(n_objects, 2))
+        bdb2D_pos = np.concatenate([corner, corner + rng.uniform(1, 300, size=(n_objects, 2))], axis=1)
+        if trial % 2 == 0:
+            bdb2D_pos = np.round(bdb2D_pos).astype(np.int64)
+        diff = (g_features(bdb2D_pos) - g_features_reference(bdb2D_pos)).abs()
+        max_diff = max(max_diff, diff.max().item())
+    assert max_diff <= atol, "g_features differs from the reference by %g (atol %g)" % (max_diff, atol)
+    return max_diff
+
+if __name__=="__main__":
+    print("g_features matches the reference, largest difference %g" % (check_g_features()))
@@ -0,0 +1,139 @@
+# Builds InstPIFu / BGPIFu inputs for a single scene without the split files and occupancy samples
+# the datasets need, used by the inference service.
+import numpy as np
+import torch
+from PIL import Image
+from net_utils.bins import bin
+from dataset.front3d_recon_dataset import R_from_yaw_pitch_roll,get_centroid_from_proj,\
+    data_transforms_patch,data_transforms_image
+from dataset.front3d_bg_dataset import data_transforms_nocrop
+
+
+def scene_from_prepare_data(sequence,pred_result=None):
+    '''
+    convert a prepare_data sequence into the generic scene description, following Front3D_Recon_Dataset.
+    :param sequence: loaded prepare_data pkl
+    :param pred_result: optional detection result pkl, its pose replaces the gt pose like use_pred_pose
+    :return: dict with image, K and the list of boxes, all expressed at the resolution of rgb_img
+    '''
+    boxes=sequence['boxes']
+    org_K=sequence['camera']['K'].copy()
+    '''intrinsic and 2d boxes are stored for the full resolution image, rgb_img is downsampled by 2'''
+    K=org_K.copy()
+    K[0]=K[0]/2
+    K[1]=K[1]/2
+    wrd2cam_matrix=sequence['camera']['wrd2cam_matrix']
+    box_list=[]
+    for object_ind in range(len(boxes['size_cls'])):
+        size_cls=boxes['size_cls'][object_ind]
+        tran_matrix=boxes['tran_matrix'][object_ind].copy()
+        tran_matrix[1,3]=0
+        rot_matrix=np.dot(wrd2cam_matrix[0:3,0:3],tran_matrix[0:3,0:3])
+        obj_cam_center=boxes['cam_center'][object_ind]
+        if pred_result is not None:
+            bboxes=pred_result['bboxes'][object_ind]
+            rot_matrix=R_from_yaw_pitch_roll(-bboxes['yaw'],pred_result['layout']['pitch'],pred_result['layout']['roll'])
+            obj_cam_center=get_centroid_from_proj(bboxes['centroid_depth'],bboxes['project_center'],org_K)
+        box_list.append({
+            "obj_id":str(object_ind),
+            "bdb2D_pos":np.asarray(boxes['bdb2D_pos'][object_ind])/2,
+            "size_cls":int(size_cls),
+            "bbox_size":(boxes['size_reg'][object_ind]+1)*bin['avg_size'][size_cls],
+            "rot_matrix":rot_matrix,
+            "obj_cam_center":obj_cam_center,
+        })
+    return {"image":sequence['rgb_img'],"K":K,"boxes":box_list}
+
+def parse_box(box,K):
+    '''
+    fill in rot_matrix, obj_cam_center and bbox_size of a box given in one of the accepted forms:
+    rot_matrix or yaw/pitch/roll, obj_cam_center or project_center/centroid_depth, bbox_size or size_reg.
+    :param K: [3,3] intrinsic of the image the box refers to
+    '''
+    box=dict(box)
+    size_cls=int(box['size_cls'])
+    if box.get('bbox_size') is None:
+        box['bbox_size']=(np.asarray(box['size_reg'])+1)*bin['avg_size'][size_cls]
+    if box.get('rot_matrix') is None:
+        box['rot_matrix']=R_from_yaw_pitch_roll(-box['yaw'],box['pitch'],box['roll'])
+    if box.get('obj_cam_center') is None:
+        box['obj_cam_center']=get_centroid_from_proj(box['centroid_depth'],np.asarray(box['project_center']),K)
+    for key in ['bdb2D_pos','bbox_size','rot_matrix','obj_cam_center']:
+        box[key]=np.asarray(box[key],dtype=np.float64)
+    if np.where(box['bbox_size']==0)[0].shape[0]>0:
+        raise ValueError("bbox_size has zero %s"%(box['bbox_size']))
+    box['size_cls']=size_cls
+    return box
+
+def object_inputs(image,K,box):
+    '''
+    InstPIFu inputs of one object, matching the test time output of Front3D_Recon_Dataset.
+    :param image: [H,W,3] uint8 image
+    :param K: [3,3] intrinsic at the resolution of image
+    :param box: dict from parse_box
+    :return: data dict of unbatched tensors
+    '''
+    image=Image.fromarray(np.asarray(image,dtype=np.uint8))
+    width,height=image.size
+    bdb=box['bdb2D_pos']
+    '''sampling grid construction during the RoI align operation'''
+    bdb_X,bdb_Y=np.meshgrid(np.linspace(bdb[0],bdb[2],64),np.linspace(bdb[1],bdb[3],64))
+    bdb_X=(bdb_X-width/2)/width*2
+    bdb_Y=(bdb_Y-height/2)/height*2
+    bdb_grid=np.concatenate([bdb_X[:,:,np.newaxis],bdb_Y[:,:,np.newaxis]],axis=-1)
+
+    patch=np.asarray(image.crop((bdb[0],bdb[1],bdb[2],bdb[3])))/255.0
+    patch=data_transforms_patch(patch[:,:,0:3]).float()
+    whole_image=data_transforms_image(np.asarray(image)/255.0).float()
+    cls_codes=np.zeros([9])
+    cls_codes[box['size_cls']]=1
+    data_dict={"whole_image":whole_image,"image":patch,"patch":patch,
+               "bdb2D_pos":torch.from_numpy(bdb.astype(np.float32)),
+               "K":torch.from_numpy(np.asarray(K,dtype=np.float32)),
+               "rot_matrix":torch.from_numpy(box['rot_matrix'].astype(np.float32)),
+               "bdb_grid":torch.from_numpy(bdb_grid.astype(np.float32)),
+               "obj_cam_center":torch.from_numpy(box['obj_cam_center'].astype(np.float32)),
+               "cls_codes":torch.from_numpy(cls_codes.astype(np.float32)),
+               "bbox_size":torch.from_numpy(box['bbox_size'].astype(np.float32))}
+    return data_dict
+
+def bg_inputs(image,K,config):
+    '''
+    BGPIFu inputs of one scene, matching the test time output of FRONT_bg_dataset.
+    :param image: [H,W,3] uint8 image
+    :param K: [3,3] intrinsic at the resolution of image
+    :param config: bg config dict, provides the network input size
+    :return: data dict of unbatched tensors
+    '''
+    image=Image.fromarray(np.asarray(image,dtype=np.uint8))
+    width,height=image.size
+    input_height,input_width=config["data"]["image_height"],config["data"]["image_width"]
+    image=image.resize((input_width,input_height))
+    intrinsic=np.zeros((4,4))
+    intrinsic[0:3,0:3]=np.abs(np.asarray(K,dtype=np.float64))
+    intrinsic[3,3]=1
+    intrinsic[0]=intrinsic[0]/(width/input_width)
+    intrinsic[1]=intrinsic[1]/(height/input_height)
+    image=data_transforms_nocrop(np.asarray(image,dtype=np.float32)/255.0)
+    return {"image":image.float(),
+            "intrinsic":torch.from_numpy(intrinsic.astype(np.float32)),
+            "rot_matrix":torch.tensor([[1,0,0],[0,1,0]],dtype=torch.float32),
+            "M":torch.eye(3)}
+
+def collate_inputs(data_list):
+    '''
+    stack unbatched data dicts along a new batch dimension.
+    '''
+    return {key:torch.stack([data_dict[key] for data_dict in data_list],dim=0) for key in data_list[0]}
+
+def object_mesh_to_camera(mesh,rot_matrix,obj_cam_center,bbox_size):
+    '''
+    transform a mesh from the canonical object space to camera coordinate, as in demo.py.
+    '''
+    obj_vert=np.asarray(mesh.vertices)
+    obj_vert=obj_vert/2*bbox_size
+    obj_vert=np.dot(obj_vert,rot_matrix.T)
+    obj_vert[:,0:2]=-obj_vert[:,0:2]
+    obj_vert+=obj_cam_center
+    mesh.vertices=np.asarray(obj_vert.copy())
+    return mesh
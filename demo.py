@@ -5,8 +5,9 @@ import argparse
 from dataset.front3d_recon_dataset import Front3D_Recon_Dataset
 from dataset.front3d_bg_dataset import FRONT_bg_dataset
 from torch.utils.data import DataLoader
-from models.instPIFu.InstPIFu_net import InstPIFu
-from models.bg_PIFu.BGPIFu_net import BGPIFu_Net
+from net_utils.train_test_utils import build_inference_model
+from net_utils.mesh_export import get_export_config,export_mesh
+from net_utils.profiler import profiler
 import datetime
 import os
 import time
@@ -36,29 +37,12 @@ if __name__=="__main__":
     bg_config=CONFIG(bg_config_path).config
     instPIFu_config['data']['test_class_name']="test_all"
     instPIFu_config['data']['use_pred_pose']=True #to use predict pose or not
-    instPIFu_model=InstPIFu(instPIFu_config).cuda()
-    instPIFu_checkpoints=torch.load(instPIFu_config["weight"])
-    instPIFu_net_weight=instPIFu_checkpoints['net']
-    instPIFu_new_net_weight={}
-    for key in instPIFu_net_weight:
-        if key.startswith("module."):
-            k_ = key[7:]
-            instPIFu_new_net_weight[k_] = instPIFu_net_weight[key]
-    instPIFu_model.load_state_dict(instPIFu_new_net_weight)
-    instPIFu_model.eval()
+    profiler.configure(instPIFu_config)
+    instPIFu_model=build_inference_model(instPIFu_config,torch.device("cuda"))
     inst_PIFu_dataset=Front3D_Recon_Dataset(instPIFu_config,"test",testid=args.testid)
     instPIFu_loader=dataset2dataloader(inst_PIFu_dataset)
 
-    bg_model=BGPIFu_Net(bg_config).cuda()
-    bg_checkpoints=torch.load(bg_config['weight'])
-    bg_net_weight=bg_checkpoints['net']
-    bg_new_net_weight={}
-    for key in bg_net_weight:
-        if key.startswith("module."):
-            k_=key[7:]
-            bg_new_net_weight[k_]=bg_net_weight[key]
-    bg_model.load_state_dict(bg_new_net_weight)
-    bg_model.eval()
+    bg_model=build_inference_model(bg_config,torch.device("cuda"))
 
     bg_dataset=FRONT_bg_dataset(bg_config,"test",testid=args.testid)
     bg_loader=dataset2dataloader(bg_dataset)
@@ -67,7 +51,7 @@ if __name__=="__main__":
         os.makedirs(save_folder)
     '''inference all objects'''
     start_t=time.time()
-    for batch_id, data_batch in enumerate(instPIFu_loader):
+    for batch_id, data_batch in enumerate(profiler.iterate(instPIFu_loader)):
         for key in data_batch:
             if isinstance(data_batch[key], list) == False:
                 data_batch[key] = data_batch[key].float().cuda()
@@ -89,7 +73,8 @@ if __name__=="__main__":
             object_id=data_batch["obj_id"][0]
             save_path=os.path.join(save_folder,args.testid+"_%s"%(object_id)+".ply")
             print("saving to %s"%(save_path))
-            mesh.export(save_path)
+            with profiler.stage('export'):
+                export_mesh(mesh,save_path,get_export_config(instPIFu_config))
         msg = "{:0>8},[{}/{}]".format(
             str(datetime.timedelta(seconds=round(time.time() - start_t))),
             batch_id + 1,
@@ -104,7 +89,7 @@ if __name__=="__main__":
     cv2.imwrite(save_path,whole_image)
     '''background inference will be added'''
     '''inference background'''
-    for batch_id, data_batch in enumerate(bg_loader):
+    for batch_id, data_batch in enumerate(profiler.iterate(bg_loader)):
         for key in data_batch:
             if isinstance(data_batch[key], list) == False:
                 data_batch[key] = data_batch[key].float().cuda()
@@ -112,7 +97,12 @@ if __name__=="__main__":
             bg_mesh = bg_model.extract_mesh(data_batch, bg_config['data']['marching_cube_resolution'])
         save_path=os.path.join(save_folder,"bg.ply")
         print("saving to %s"%(save_path))
-        bg_mesh.export(save_path)
+        with profiler.stage('export'):
+            export_mesh(bg_mesh,save_path,get_export_config(bg_config))
+    for path in profiler.dump(save_folder):
+        print("profile written to %s"%(path))
+    if profiler.enabled:
+        print(profiler.format_summary())
 
 
 '''
@@ -4,8 +4,9 @@ from configs.config_utils import CONFIG
 import argparse
 from dataset.sunrgbd_dataset import SUNRGBD_Recon_Dataset
 from torch.utils.data import DataLoader
-from models.instPIFu.InstPIFu_net import InstPIFu
-from models.bg_PIFu.BGPIFu_net import BGPIFu_Net
+from net_utils.train_test_utils import build_inference_model
+from net_utils.mesh_export import get_export_config,export_mesh
+from net_utils.profiler import profiler
 import datetime
 import os
 import time
@@ -36,27 +37,10 @@ if __name__=="__main__":
     instPIFu_config=CONFIG(instPIFu_config_path).config
     bg_config = CONFIG(bg_config_path).config
     instPIFu_config['data']['use_pred_pose']=True #to use predict pose or not
-    instPIFu_model=InstPIFu(instPIFu_config).cuda()
-    instPIFu_checkpoints=torch.load(instPIFu_config["weight"])
-    instPIFu_net_weight=instPIFu_checkpoints['net']
-    instPIFu_new_net_weight={}
-    for key in instPIFu_net_weight:
-        if key.startswith("module."):
-            k_ = key[7:]
-            instPIFu_new_net_weight[k_] = instPIFu_net_weight[key]
-    instPIFu_model.load_state_dict(instPIFu_new_net_weight)
-    instPIFu_model.eval()
+    profiler.configure(instPIFu_config)
+    instPIFu_model=build_inference_model(instPIFu_config,torch.device("cuda"))
 
-    bg_model = BGPIFu_Net(bg_config).cuda()
-    bg_checkpoints = torch.load(bg_config['weight'])
-    bg_net_weight = bg_checkpoints['net']
-    bg_new_net_weight = {}
-    for key in bg_net_weight:
-        if key.startswith("module."):
-            k_ = key[7:]
-            bg_new_net_weight[k_] = bg_net_weight[key]
-    bg_model.load_state_dict(bg_new_net_weight)
-    bg_model.eval()
+    bg_model = build_inference_model(bg_config,torch.device("cuda"))
 
     SUNRGBD_recon_dataset=SUNRGBD_Recon_Dataset(instPIFu_config,"test",testid=args.testid)
     SUNRGBD_recon_loader=dataset2dataloader(SUNRGBD_recon_dataset)
@@ -67,7 +51,7 @@ if __name__=="__main__":
         os.makedirs(save_folder)
     '''inference all objects'''
     start_t=time.time()
-    for batch_id, data_batch in enumerate(SUNRGBD_recon_loader):
+    for batch_id, data_batch in enumerate(profiler.iterate(SUNRGBD_recon_loader)):
         
         
         for key in data_batch:
@@ -97,7 +81,8 @@ if __name__=="__main__":
             
             save_path=os.path.join(save_folder,"%s"%(object_id)+".obj")
             print("saving to %s"%(save_path))
-            mesh.export(save_path)
+            with profiler.stage('export'):
+                export_mesh(mesh,save_path,get_export_config(instPIFu_config))
         msg = "{:0>8},[{}/{}]".format(
             str(datetime.timedelta(seconds=round(time.time() - start_t))),
             batch_id + 1,
@@ -118,7 +103,12 @@ if __name__=="__main__":
         bg_mesh = bg_model.extract_mesh(bg_PIFu_input, marching_cube_resolution=256)
     save_path = os.path.join(save_folder, "bg.ply")
     print("saving to %s" % (save_path))
-    bg_mesh.export(save_path)
+    with profiler.stage('export'):
+        export_mesh(bg_mesh,save_path,get_export_config(bg_config))
+    for path in profiler.dump(save_folder):
+        print("profile written to %s"%(path))
+    if profiler.enabled:
+        print(profiler.format_summary())
     #print(bg_mesh.vertices)
     
 
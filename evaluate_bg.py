@@ -5,6 +5,7 @@ import cv2
 import torch
 import trimesh
 from external.pyTorchChamferDistance.chamfer_distance import ChamferDistance
+from net_utils.mesh_export import load_mesh
 dist_chamfer=ChamferDistance()
 import argparse
 
@@ -40,7 +41,7 @@ for result_file in result_filelist:
     if ind < 3000 or ind >= 9000:
         continue
 
-    pred_mesh = trimesh.load(result_file)
+    pred_mesh = load_mesh(result_file)
     '''depth image is scaled into 268x200'''
     width = 268
     height = 200
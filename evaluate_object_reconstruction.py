@@ -12,6 +12,7 @@ import shutil
 import subprocess
 from net_utils.bins import *
 from external.pyTorchChamferDistance.chamfer_distance import ChamferDistance
+from net_utils.mesh_export import load_mesh
 import scipy
 
 dist_chamfer=ChamferDistance()
@@ -130,7 +131,7 @@ for (taskid,object_id) in select_split_list:
     inv_rot=np.linalg.inv(rot_matrix)
     #print(prepare_data['boxes'].keys())
     try:
-        pred_mesh = trimesh.load(result_file)
+        pred_mesh = load_mesh(result_file)
 
         gt_mesh_path=os.path.join(gt_dir,jid,"normalized_watertight.obj")
         gt_mesh=trimesh.load(gt_mesh_path)
@@ -0,0 +1,22 @@
+import copy
+import torch
+from net_utils.train_test_utils import build_inference_model
+from net_utils.graph_export import export_graphs
+
+def run(cfg):
+    config=copy.deepcopy(cfg.config)
+    config['model']['runtime']='eager'
+    export_dir=config['model'].get('export_dir','./checkpoints/exported')
+    formats=config['model'].get('export_formats',['torchscript','onnx'])
+
+    '''Load net'''
+    cfg.log_string('Loading model.')
+    net=build_inference_model(config,torch.device('cpu'))
+
+    '''Export the image and point graphs'''
+    cfg.log_string('Exporting %s graphs to %s.'%(','.join(formats),export_dir))
+    saved=export_graphs(net,config,export_dir,formats)
+    for path in saved:
+        cfg.log_string('saved %s'%(path))
+
+    cfg.log_string('Export finished.')
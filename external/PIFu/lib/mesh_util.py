@@ -63,39 +63,28 @@ def reconstruction(structured_implicit,
 
 
 def save_obj_mesh(mesh_path, verts, faces):
-    file = open(mesh_path, 'w')
-
-    for v in verts:
-        file.write('v %.4f %.4f %.4f\n' % (v[0], v[1], v[2]))
-    for f in faces:
-        f_plus = f + 1
-        file.write('f %d %d %d\n' % (f_plus[0], f_plus[2], f_plus[1]))
-    file.close()
+    verts = np.asarray(verts, dtype=np.float64).reshape(-1, 3)
+    faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)[:, [0, 2, 1]] + 1
+    with open(mesh_path, 'w') as file:
+        file.write(('v %.4f %.4f %.4f\n' * verts.shape[0]) % tuple(verts.ravel()))
+        file.write(('f %d %d %d\n' * faces.shape[0]) % tuple(faces.ravel()))
 
 
 def save_obj_mesh_with_color(mesh_path, verts, faces, colors):
-    file = open(mesh_path, 'w')
-
-    for idx, v in enumerate(verts):
-        c = colors[idx]
-        file.write('v %.4f %.4f %.4f %.4f %.4f %.4f\n' % (v[0], v[1], v[2], c[0], c[1], c[2]))
-    for f in faces:
-        f_plus = f + 1
-        file.write('f %d %d %d\n' % (f_plus[0], f_plus[2], f_plus[1]))
-    file.close()
+    verts = np.asarray(verts, dtype=np.float64).reshape(-1, 3)
+    colors = np.asarray(colors, dtype=np.float64).reshape(-1, 3)
+    faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)[:, [0, 2, 1]] + 1
+    with open(mesh_path, 'w') as file:
+        file.write(('v %.4f %.4f %.4f %.4f %.4f %.4f\n' * verts.shape[0]) %
+                   tuple(np.concatenate([verts, colors], axis=1).ravel()))
+        file.write(('f %d %d %d\n' * faces.shape[0]) % tuple(faces.ravel()))
 
 
 def save_obj_mesh_with_uv(mesh_path, verts, faces, uvs):
-    file = open(mesh_path, 'w')
-
-    for idx, v in enumerate(verts):
-        vt = uvs[idx]
-        file.write('v %.4f %.4f %.4f\n' % (v[0], v[1], v[2]))
-        file.write('vt %.4f %.4f\n' % (vt[0], vt[1]))
-
-    for f in faces:
-        f_plus = f + 1
-        file.write('f %d/%d %d/%d %d/%d\n' % (f_plus[0], f_plus[0],
-                                              f_plus[2], f_plus[2],
-                                              f_plus[1], f_plus[1]))
-    file.close()
+    verts = np.asarray(verts, dtype=np.float64).reshape(-1, 3)
+    uvs = np.asarray(uvs, dtype=np.float64).reshape(-1, 2)
+    faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)[:, [0, 2, 1]] + 1
+    with open(mesh_path, 'w') as file:
+        file.write(('v %.4f %.4f %.4f\nvt %.4f %.4f\n' * verts.shape[0]) %
+                   tuple(np.concatenate([verts, uvs], axis=1).ravel()))
+        file.write(('f %d/%d %d/%d %d/%d\n' * faces.shape[0]) % tuple(np.repeat(faces, 2, axis=1).ravel()))
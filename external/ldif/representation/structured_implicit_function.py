@@ -34,6 +34,7 @@ class StructuredImplicit(object):
         self._packed_vector = None
         self._analytic_code = None
         self._all_centers = None
+        self._effective_elements = None
 
     @classmethod
     def from_packed_vector(cls, config, packed_vector, net):
@@ -99,11 +100,24 @@ class StructuredImplicit(object):
             self._all_centers = torch.cat([self.centers, sym_centers], 1)
         return self._all_centers
 
+    @property
+    def effective_elements(self):
+        # Parameters of the elements with the symmetric ones tiled in and their world2local transformations,
+        # they do not depend on the samples and are kept for later class_at_samples calls in the same grad mode.
+        grad_enabled = torch.is_grad_enabled()
+        if self._effective_elements is None or self._effective_elements[0] != grad_enabled:
+            self._effective_elements = (grad_enabled,
+                                        (self._tile_for_symgroups(self.constants),
+                                         self._tile_for_symgroups(self.centers),
+                                         self._tile_for_symgroups(self.radii),
+                                         self._tile_for_symgroups(self.compute_world2local()),
+                                         self._tile_for_symgroups(self.iparams)))
+        return self._effective_elements[1]
+
     def class_at_samples(self, samples, apply_class_transfer=True):
         # (ldif.representation.structured_implicit_function.StructuredImplicit.class_at_samples)
-        effective_constants = self._tile_for_symgroups(self.constants)
-        effective_centers = self._tile_for_symgroups(self.centers)
-        effective_radii = self._tile_for_symgroups(self.radii)
+        effective_constants, effective_centers, effective_radii, effective_world2local, effective_iparams = \
+            self.effective_elements
 
         effective_samples = self._generate_symgroup_samples(samples)
         constants_quadrics = torch.zeros(self.batch_size, self.effective_element_count, 4, 4, device=self.device)
@@ -121,10 +135,9 @@ class StructuredImplicit(object):
         # have shape [batch_size, sample_count, 3]. This is because each sample
         # should be evaluated in the relative coordinate system of the
         # The world2local transformations for each element. Shape [B, EC, 4, 4].
-        effective_world2local = self._tile_for_symgroups(self.compute_world2local())
         local_samples = torch.matmul(F.pad(effective_samples, [0, 1], "constant", 1),
                                      effective_world2local.transpose(-1, -2))[..., :3]
-        implicit_values = self.implicit_values(local_samples)
+        implicit_values = self.net.eval_implicit_parameters(effective_iparams, local_samples)
 
         residuals = 1 + implicit_values
         local_decisions = per_element_constants * per_element_weights * residuals
@@ -151,17 +164,7 @@ class StructuredImplicit(object):
         assert self.vector.shape[0] == 1
         sif_vector = self.vector.squeeze().cpu().numpy()
         sif_vector[:, 4:7] = np.sqrt(np.maximum(sif_vector[:, 4:7], 0))
-        out = 'SIF\n%i %i %i\n' % (self.element_count, 0, self.implicit_parameter_length)
-        for row_idx in range(self.element_count):
-            row = ' '.join(10 * ['%.9g']) % tuple(sif_vector[row_idx, :10].tolist())
-            symmetry = int(row_idx < self.sym_element_count)
-            row += ' %i' % symmetry
-            implicit_params = ' '.join(self.implicit_parameter_length * ['%.9g']) % (
-                tuple(sif_vector[row_idx, 10:].tolist()))
-            row += ' ' + implicit_params
-            row += '\n'
-            out += row
-        file_util.writetxt(path, out)
+        file_util.write_sif_v1(path, sif_vector, self.sym_element_count)
 
     def unbind(self):
         return [StructuredImplicit.from_packed_vector(self.config, self.vector[i:i+1], self.net)
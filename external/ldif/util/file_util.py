@@ -63,22 +63,58 @@ def write_np(path, arr):
     np.save(f, arr)
 
 
-def read_grd(path):
-  """Reads a GAPS .grd file into a (tx, grd) pair."""
-  with base_util.FS.open(path, 'rb') as f:
-    content = f.read()
-  res = struct.unpack('iii', content[:4 * 3])
-  vcount = res[0] * res[1] * res[2]
-  # if res[0] != 32 or res[1] != 32 or res[2] != 32:
-  #   raise ValueError(f'Expected a resolution of 32^3 but got '
-  #                    f'({res[0]}, {res[1]}, {res[2]}) for example {path}.')
-  content = content[4 * 3:]
-  tx = struct.unpack('f' * 16, content[:4 * 16])
-  tx = np.array(tx).reshape([4, 4]).astype(np.float32)
-  content = content[4 * 16:]
-  grd = struct.unpack('f' * vcount, content[:4 * vcount])
-  grd = np.array(grd).reshape(res).astype(np.float32)
-  return tx, grd
+# A .grd file starts with the resolution (3 int32) and the world2grid matrix
+# (16 float32), followed by the voxels as float32.
+GRD_HEADER_BYTES = 4 * 3 + 4 * 16
+
+
+def _parse_grd_header(header):
+  res = tuple(int(x) for x in np.frombuffer(header, dtype=np.int32, count=3))
+  tx = np.frombuffer(header, dtype=np.float32, count=16, offset=4 * 3)
+  return res, tx.reshape([4, 4])
+
+
+def read_grd(path, mmap=False):
+  """Reads a GAPS .grd file into a (tx, grd) pair.
+
+  grd is a read-only view of the file contents, nothing is copied or converted.
+  With mmap=True the file is memory mapped instead of read.
+  """
+  if mmap:
+    header = np.memmap(path, dtype=np.uint8, mode='r', shape=(GRD_HEADER_BYTES,))
+    res, tx = _parse_grd_header(header)
+    grd = np.memmap(path, dtype=np.float32, mode='r', offset=GRD_HEADER_BYTES,
+                    shape=res)
+    return np.array(tx), grd
+  content = readbin(path)
+  res, tx = _parse_grd_header(content)
+  grd = np.frombuffer(content, dtype=np.float32, count=int(np.prod(res)),
+                      offset=GRD_HEADER_BYTES).reshape(res)
+  return np.array(tx), grd
+
+
+def read_grds(paths, out=None):
+  """Reads .grd files of the same resolution into one [len(paths), *res] array.
+
+  The voxels are read straight into out (allocated from the first header when
+  None), which can be reused across calls.
+
+  Returns:
+    A (txs, grds) pair, txs has shape [len(paths), 4, 4].
+  """
+  txs = np.empty([len(paths), 4, 4], dtype=np.float32)
+  for i, path in enumerate(paths):
+    with base_util.FS.open(path, 'rb') as f:
+      res, txs[i] = _parse_grd_header(f.read(GRD_HEADER_BYTES))
+      if out is None:
+        out = np.empty([len(paths)] + list(res), dtype=np.float32)
+      if out.dtype != np.float32 or tuple(out.shape[1:]) != res:
+        raise ValueError(f'Grid {path} with resolution {res} does not fit an '
+                         f'output of shape {out.shape} and type {out.dtype}.')
+      buf = memoryview(out[i]).cast('B')
+      if f.readinto(buf) != buf.nbytes:
+        raise ValueError(f'Grid file {path} is truncated.')
+  return txs, out
 
 
 def read_sif_v1(path, verbose=False):
@@ -94,31 +130,46 @@ def read_sif_v1(path, verbose=False):
   assert shape_count > 0
   assert implicit_len > 0
   assert len(text) == shape_count + 2
-  rep = []
-  for idx in range(shape_count):
-    row = text[idx + 2]
-    elements = row.split(' ')
-    explicits = [float(x) for x in elements[:10]]
-    explicits[4] = explicits[4] * explicits[4]
-    explicits[5] = explicits[5] * explicits[5]
-    explicits[6] = explicits[6] * explicits[6]
-    # log.info(elements[10])
-    if verbose:
-      symmetry = bool(int(elements[10]))
+  # All rows are parsed at once: 10 explicits, the symmetry flag, implicits.
+  rows = np.array(' '.join(text[2:]).split(), dtype=np.float64)
+  rows = rows.reshape([shape_count, -1])
+  explicits = rows[:, :10].copy()
+  explicits[:, 4:7] = explicits[:, 4:7] * explicits[:, 4:7]
+  implicits = rows[:, 11:]
+  if verbose:
+    for idx in range(shape_count):
+      symmetry = bool(int(rows[idx, 10]))
       log.info(f"Row {idx} {'is' if symmetry else 'is not'} symmetric.")
-    implicits = [float(x) for x in elements[11:]]
-    if verbose:
-      has_implicits = bool(implicits)
+      has_implicits = implicits.shape[1] > 0
       log.info(
           f"Row {idx} {'has' if has_implicits else 'does not have'} implicits.")
-    # TODO(kgenova) Validate the SIF embedding matches the expected symmetry.
-    rep.append(explicits + implicits)
-  rep = np.array(rep, dtype=np.float32)
+  # TODO(kgenova) Validate the SIF embedding matches the expected symmetry.
+  rep = np.concatenate([explicits, implicits], axis=1).astype(np.float32)
   if verbose:
     log.info(f'Representation shape is {rep.shape}')
   return rep
 
 
+def write_sif_v1(path, rows, symmetry_count):
+  """Writes a version 1 SIF .txt file.
+
+  Args:
+    path: String. The path for the file to write.
+    rows: Numpy array with shape [shape_count, 10 + implicit_len], the
+      explicit parameters (radii not squared) followed by the implicits.
+    symmetry_count: Int. The first symmetry_count rows are symmetric.
+  """
+  rows = np.asarray(rows, dtype=np.float64)
+  shape_count, implicit_len = rows.shape[0], rows.shape[1] - 10
+  symmetry = (np.arange(shape_count) < symmetry_count).astype(np.float64)
+  table = np.concatenate([rows[:, :10], symmetry[:, np.newaxis], rows[:, 10:]],
+                         axis=1)
+  row_format = ' '.join(10 * ['%.9g'] + ['%i'] + implicit_len * ['%.9g']) + '\n'
+  out = 'SIF\n%i %i %i\n' % (shape_count, 0, implicit_len)
+  out += (row_format * shape_count) % tuple(table.ravel().tolist())
+  writetxt(path, out)
+
+
 def read_lines(p):
   with base_util.FS.open(p, 'rt') as f:
     contents = f.read()
@@ -253,10 +304,12 @@ def write_grd(path, volume, world2grid=None):
   else:
     header += [1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1]
   header = struct.pack(3*'i' + 16*'f', *header)
-  content = volume.astype('f').tostring()
+  # the voxels are written from their buffer, a copy is only made when they
+  # are not contiguous float32
+  content = np.ascontiguousarray(volume, dtype=np.float32)
   with base_util.FS.open(path, 'wb') as f:
     f.write(header)
-    f.write(content)
+    f.write(memoryview(content).cast('B'))
 
 
 def write_depth_image(path, depth_image):
@@ -1,12 +1,13 @@
 import argparse
 from configs.config_utils import CONFIG
+from net_utils.distributed import init_distributed
 
 def parse_args():
     '''PARAMETERS'''
     parser = argparse.ArgumentParser('Refer-it-in-RGBD training')
     parser.add_argument('--config', type=str, default='config/pretrian_config.yaml',
                         help='configure file for training or testing.')
-    parser.add_argument('--mode', type=str, default='train', help='train, test or demo.')
+    parser.add_argument('--mode', type=str, default='train', help='train, test, demo, scene, export, quantize, bench or tune_loader.')
     parser.add_argument('--demo_path', type=str, default='demo/inputs/1', help='Please specify the demo path.')
     return parser.parse_args()
 
@@ -14,6 +15,7 @@ if __name__=="__main__":
     args=parse_args()
     cfg=CONFIG(args.config)
     cfg.update_config(args.__dict__)
+    init_distributed(cfg)
 
     cfg.log_string('Loading configuration')
     cfg.log_string(cfg.config)
@@ -29,4 +31,19 @@ if __name__=="__main__":
         demo.run(cfg)
     elif cfg.config['mode']=='test':
         import test
-        test.run(cfg)
\ No newline at end of file
+        test.run(cfg)
+    elif cfg.config['mode']=='scene':
+        import scene
+        scene.run(cfg)
+    elif cfg.config['mode']=='export':
+        import export
+        export.run(cfg)
+    elif cfg.config['mode']=='quantize':
+        import quantize
+        quantize.run(cfg)
+    elif cfg.config['mode']=='bench':
+        import bench
+        bench.run(cfg)
+    elif cfg.config['mode']=='tune_loader':
+        import tune_loader
+        tune_loader.run(cfg)
\ No newline at end of file
@@ -1,16 +1,14 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from models.instPIFu.BasePIFuNet import BasePIFuNet
+from models.instPIFu.BasePIFuNet import BasePIFuNet,stack_batch
 from models.instPIFu.SurfaceClassifier import SurfaceClassifier
 from models.instPIFu.HGFilters import *
 from net_utils.init_net import init_net
 from models.modules.resnet import resnet18_full,resnet18
-from skimage import measure
-import trimesh
 from models.instPIFu.PositionEmbedder import get_embedder
-from models.modules.resnet import model_urls
-import torch.utils.model_zoo as model_zoo
+import numpy as np
+from net_utils.profiler import profiler
 
 def positionalEncoder(cam_points, embedder, output_dim):
     cam_points = cam_points.permute(0, 2, 1)#[B,N,3]
@@ -67,10 +65,6 @@ class BGPIFu_Net(BasePIFuNet):
             init_net(self)
 
         self.global_encoder=resnet18_full(pretrained=False)
-        pretrained_dict = model_zoo.load_url(model_urls['resnet18'])
-        model_dict = self.global_encoder.state_dict()
-        pretrained_dict = {k: v for k, v in pretrained_dict.items() if k in model_dict}
-        model_dict.update(pretrained_dict)
 
         if self.config['data']['use_positional_embedding']:
             self.origin_embedder,self.embedder_outDim=get_embedder(self.config['data']['multires'],log_sampling=False,input_dim=3)
@@ -82,28 +76,16 @@ class BGPIFu_Net(BasePIFuNet):
         store all intermediate features.
         :param images: [B, C, H, W] input images
         '''
-        self.im_feat_list, self.tmpx, self.normx = self.image_filter(images)
-        self.global_feat=self.global_encoder(images)
+        self.im_feat_list, self.tmpx, self.normx = self.image_filter(images, None if self.training else [-1])
+        with profiler.stage('global_encoder'):
+            self.global_feat=self.global_encoder(images)
         if not self.training:
             self.im_feat_list = [self.im_feat_list[-1]]
 
-    def query(self, points, intrinsic, height,width, rot_matrix=None, M=None ,transforms=None, labels=None):
+    def project_points(self, points, intrinsic, height, width, rot_matrix=None):
         '''
-        Given 3D points, query the network predictions for each point.
-        Image features should be pre-computed before this call.
-        store all intermediate features.
-        query() function may behave differently during training/testing.
-        :param points: [B, N, 3] world space coordinates of points
-        :param calibs: [B, 3, 4] calibration matrices for each image
-        :param cls_codes: [B,9]
-        :param transforms: Optional [B, 2, 3] image space coordinate transforms
-        :param labels: Optional [B, Res, N] gt labeling
-        :return: [B, Res, N] predictions for each point
-        '''
-        if labels is not None:
-            self.labels = labels
-        '''
-        compute projection
+        project camera space points into the normalized image coordinate used by grid_sample.
+        :return: img_coor [B, N, 3] before the perspective division, xy [B, N, 2]
         '''
         img_coor = torch.einsum("ijk,ikq->ijq", points, intrinsic[:,0:3,0:3].transpose(1, 2))
         x_coor = img_coor[:, :,0]/img_coor[:,:,2]
@@ -123,6 +105,24 @@ class BGPIFu_Net(BasePIFuNet):
         p_project is B,7,NUM_SAM,2
         '''
         xy=p_project #B,NUM_SAM,2
+        return img_coor,xy
+
+    def query(self, points, intrinsic, height,width, rot_matrix=None, M=None ,transforms=None, labels=None):
+        '''
+        Given 3D points, query the network predictions for each point.
+        Image features should be pre-computed before this call.
+        store all intermediate features.
+        query() function may behave differently during training/testing.
+        :param points: [B, N, 3] world space coordinates of points
+        :param calibs: [B, 3, 4] calibration matrices for each image
+        :param cls_codes: [B,9]
+        :param transforms: Optional [B, 2, 3] image space coordinate transforms
+        :param labels: Optional [B, Res, N] gt labeling
+        :return: [B, Res, N] predictions for each point
+        '''
+        if labels is not None:
+            self.labels = labels
+        img_coor,xy=self.project_points(points,intrinsic,height,width,rot_matrix)
         self.in_img = (xy[:, :, 0] >= -1.0) & (xy[:, :, 0] <= 1.0) & (xy[:, :, 1] >= -1.0) & (xy[:, :, 1] <= 1.0)
         z_feat=img_coor[:,:,2:3]
         self.z_feat=z_feat
@@ -132,24 +132,30 @@ class BGPIFu_Net(BasePIFuNet):
 
         self.intermediate_preds_list = []
 
-        for im_feat in self.im_feat_list:
-            if M is not None:
-                points_feat= torch.einsum('ijk,ikq->ijq',points,M.transpose(1,2))# augmentation
-            else:
-                points_feat=points
-            if self.config['data']['use_positional_embedding']:
-                position_feat=self.embedder(points_feat.transpose(1,2),self.origin_embedder,self.embedder_outDim)
-                point_local_feat_list = [self.index(im_feat, xy), position_feat]
-            else:
-                point_local_feat_list = [self.index(im_feat, xy), points_feat.transpose(1,2)]
-
-            if self.opt["model"]["skip_hourglass"]:
-                point_local_feat_list.append(tmpx_local_feature)
-            point_local_feat_list.append(self.global_feat.unsqueeze(2).repeat(1,1,points.shape[1]))
+        if M is not None:
+            points_feat= torch.einsum('ijk,ikq->ijq',points,M.transpose(1,2))# augmentation
+        else:
+            points_feat=points
+        if self.config['data']['use_positional_embedding']:
+            shared_feat_list = [self.embedder(points_feat.transpose(1,2),self.origin_embedder,self.embedder_outDim)]
+        else:
+            shared_feat_list = [points_feat.transpose(1,2)]
+        if self.opt["model"]["skip_hourglass"]:
+            shared_feat_list.append(tmpx_local_feature)
+        shared_feat_list.append(self.global_feat.unsqueeze(2).repeat(1,1,points.shape[1]))
+
+        input_im_feat=self.im_feat_list
+        if len(input_im_feat)>1 and self.config['model'].get('fuse_stacks',True):
+            '''the stacks share the classifier, sample and classify them as one [num_stack*B] batch'''
+            input_im_feat=[torch.cat(input_im_feat,dim=0)]
+        for im_feat in input_im_feat:
+            num_stack=im_feat.shape[0]//points.shape[0]
+            point_local_feat_list = [self.index(im_feat, stack_batch(xy,num_stack))]
+            point_local_feat_list += [stack_batch(feat,num_stack) for feat in shared_feat_list]
             point_local_feat = torch.cat(point_local_feat_list, 1)
 
             pred=self.surface_classifier(point_local_feat)#*self.in_img[:,None].float()
-            self.intermediate_preds_list.append(pred)
+            self.intermediate_preds_list+=list(torch.chunk(pred,num_stack,dim=0))
         self.preds = self.intermediate_preds_list[-1].squeeze(1)
 
     def get_im_feat(self):
@@ -165,7 +171,7 @@ class BGPIFu_Net(BasePIFuNet):
         '''
         error = 0
         for preds in self.intermediate_preds_list:
-            error += self.error_term(preds.squeeze(1),self.labels)
+            error += self.error_term(preds.squeeze(1).float(),self.labels)
         error /= len(self.intermediate_preds_list)
 
         return error
@@ -194,8 +200,8 @@ class BGPIFu_Net(BasePIFuNet):
 
         # Phase 2: point query
         self.query(points=points,intrinsic=intrinsic,rot_matrix=rot_matrix,M=M,transforms=transforms,height=height,width=width)#,depth=depth)
-        # get the prediction
-        res = self.get_preds()
+        # get the prediction, losses and the occupancy threshold are kept in fp32
+        res = self.get_preds().float()
         #print(res)
 
         # get the error
@@ -219,12 +225,56 @@ class BGPIFu_Net(BasePIFuNet):
         image = data_dict["image"]
         height, width = image.shape[2:4]
         K=data_dict["intrinsic"]
-        self.filter(image)
+        volumn=self.predict_volumes(data_dict,marching_cube_resolution)
+        return self.mesh_from_volume(volumn,K,height,width,marching_cube_resolution)
+
+    def predict_volumes(self,data_dict,marching_cube_resolution=64):
+        '''
+        :return: [1, marching_cube_resolution**3] occupancy of the marching cubes grid, 1 outside the image
+        '''
+        image = data_dict["image"]
+        height, width = image.shape[2:4]
+        K=data_dict["intrinsic"]
+        with profiler.stage('filter'):
+            self.filter(image)
+        if self.grid_mode()=='frustum':
+            #every sample of the frustum grid is visible, the predictions are the volume in grid order
+            pred_list=[]
+            for sample in torch.split(self.frustum_grid(data_dict,marching_cube_resolution),200000,dim=1):
+                with profiler.stage('query'):
+                    self.query(points=sample,intrinsic=K,height=height,width=width)
+                    pred_list.append(self.get_preds().float())
+            return torch.cat(pred_list,dim=1)
         volumn = torch.ones((marching_cube_resolution, marching_cube_resolution, marching_cube_resolution)).float().to(
             image.device)
-        x_coor = torch.linspace(-3, 3, steps=marching_cube_resolution).float().cuda()
-        y_coor = torch.linspace(-2, 2, steps=marching_cube_resolution).float().cuda()
-        z_coor = torch.linspace(1, 10, steps=marching_cube_resolution).float().cuda()
+        samples_incam,visible_ind=self.query_grid(data_dict,marching_cube_resolution)
+        visible_sample=samples_incam[visible_ind[0],visible_ind[1],:].unsqueeze(0)
+        sample_list=torch.split(visible_sample,200000,dim=1)
+        #print(visible_sample.shape,K.shape)
+        # Phase 2: point query
+        for i,sample in enumerate(sample_list):
+            #print(sample.shape)
+            with profiler.stage('query'):
+                self.query(points=sample.to(image.device),intrinsic=K,height=height,width=width)
+
+                res = self.get_preds().float()
+            volumn = volumn.view(-1, 1)
+            if i < len(sample_list)-1:
+                volumn[visible_ind[1][i*200000:(i+1)*200000], :] = res.squeeze(0).unsqueeze(1)
+            else:
+                volumn[visible_ind[1][i*200000:], :] = res.squeeze(0).unsqueeze(1)
+        return volumn.view(1,-1)
+
+    def query_grid(self,data_dict,marching_cube_resolution):
+        '''
+        the marching cubes grid in camera space and the indices of the samples projecting inside the image.
+        :return: samples_incam [1,N,3], visible_ind
+        '''
+        image = data_dict["image"]
+        height, width = image.shape[2:4]
+        x_coor = torch.linspace(-3, 3, steps=marching_cube_resolution).float().to(image.device)
+        y_coor = torch.linspace(-2, 2, steps=marching_cube_resolution).float().to(image.device)
+        z_coor = torch.linspace(1, 10, steps=marching_cube_resolution).float().to(image.device)
         X, Y, Z = torch.meshgrid(x_coor, y_coor, z_coor)
         samples_incam = torch.cat([X[:, :, :, None], Y[:, :, :, None], Z[:, :, :, None]], dim=3).unsqueeze(0)
         samples_incam=samples_incam.reshape(samples_incam.shape[0],-1,3)
@@ -237,32 +287,63 @@ class BGPIFu_Net(BasePIFuNet):
             (project_x <= width-1) & (project_x > 0) & (project_y > 0) & (project_y <= height-1) & (project_sample[:, :, 2] > 0))
         # print(samples_incam.shape,visible_ind[0].shape,visible_ind[1].reshape)
         #print(torch.max(visible_ind[0]))
-        visible_sample=samples_incam[visible_ind[0],visible_ind[1],:].unsqueeze(0)
-        sample_list=torch.split(visible_sample,200000,dim=1)
-        #print(visible_sample.shape,K.shape)
-        # Phase 2: point query
-        for i,sample in enumerate(sample_list):
-            #print(sample.shape)
-            self.query(points=sample.to(image.device),intrinsic=K,height=height,width=width)
+        return samples_incam,visible_ind
 
-            res = self.get_preds()
-            volumn = volumn.view(-1, 1)
-            if i < len(sample_list)-1:
-                volumn[visible_ind[1][i*200000:(i+1)*200000], :] = res.squeeze(0).unsqueeze(1)
-            else:
-                volumn[visible_ind[1][i*200000:], :] = res.squeeze(0).unsqueeze(1)
-        volumn = volumn.view(marching_cube_resolution, marching_cube_resolution,
-                             marching_cube_resolution).detach().cpu().numpy()
+    def grid_mode(self):
+        '''
+        box samples x -3~3, y -2~2, z 1~10 in camera space and keeps the points projecting inside the image,
+        frustum samples pixel columns, pixel rows and inverse depth so that every point is visible.
+        '''
+        return self.config['data'].get('grid_mode','box')
+
+    def frustum_axes(self,height,width,marching_cube_resolution):
+        '''
+        :return: u, v and inverse depth of the frustum grid lines, inverse depth goes from the near to the far
+                 plane so that the grid keeps the orientation of the box grid in camera space
+        '''
+        near,far=self.config['data'].get('frustum_depth',[1,10])
+        u=np.linspace(0,width-1,marching_cube_resolution)
+        v=np.linspace(0,height-1,marching_cube_resolution)
+        inv_depth=np.linspace(1.0/near,1.0/far,marching_cube_resolution)
+        return u,v,inv_depth
+
+    def frustum_grid(self,data_dict,marching_cube_resolution):
+        '''
+        the frustum grid back projected into camera space.
+        :return: samples_incam [1,marching_cube_resolution**3,3]
+        '''
+        image = data_dict["image"]
+        height, width = image.shape[2:4]
+        u,v,inv_depth=[torch.from_numpy(axis).float().to(image.device)
+                       for axis in self.frustum_axes(height,width,marching_cube_resolution)]
+        U, V, S = torch.meshgrid(u, v, inv_depth)
+        pixels=torch.stack([U,V,torch.ones_like(U)],dim=3).reshape(1,-1,3)
+        K_inv=torch.inverse(data_dict["intrinsic"][0:1,0:3,0:3].float())
+        rays=torch.einsum("ijk,ikq->ijq",pixels,K_inv.transpose(1,2))
+        return rays/S.reshape(1,-1,1)
+
+    def mesh_from_volume(self,volumn,K,height,width,marching_cube_resolution):
+        with profiler.stage('device_to_host'):
+            volumn = volumn.view(marching_cube_resolution, marching_cube_resolution,
+                                 marching_cube_resolution).detach().cpu().numpy()
         volumn=1-volumn
-        mesh=self.marching_cubes(volumn,mcubes_extent=(3,2,4.5))[1]
+        with profiler.stage('marching_cubes'):
+            if self.grid_mode()=='frustum':
+                mesh=self.frustum_marching_cubes(volumn,K,height,width)[1]
+            else:
+                mesh=self.marching_cubes(volumn,mcubes_extent=(3,2,4.5))[1]
 
         #vertices=mesh.vertices
-        mesh=self.delete_invisible_vert(mesh,K,height,width)
+        with profiler.stage('component_cleanup'):
+            mesh=self.delete_invisible_vert(mesh,K,height,width)
         #mesh=self.delete_disconnected_component(mesh)
         return mesh
 
     def marching_cubes(self,volume, mcubes_extent):
         """Maps from a voxel grid of implicit surface samples to a Trimesh mesh."""
+        # geometry libraries are only needed for mesh extraction, keep them out of model import
+        from skimage import measure
+        import trimesh
         volume = np.squeeze(volume)
         length, height, width = volume.shape
         resolution = length
@@ -290,6 +371,26 @@ class BGPIFu_Net(BasePIFuNet):
                 'Failed to extract mesh with error %s. Setting to unit sphere.' %
                 repr(e))
             return False, trimesh.primitives.Sphere(radius=0.5)
+    def frustum_marching_cubes(self,volume,intrinsic,height,width):
+        """marching cubes in the index space of the frustum grid, the vertices are mapped back to camera space."""
+        from skimage import measure
+        import trimesh
+        volume = np.squeeze(volume)
+        resolution = volume.shape[0]
+        try:
+            vertices, faces, normals, _ = measure.marching_cubes(volume, 0.5)
+        except (ValueError, RuntimeError) as e:
+            print(
+                'Failed to extract mesh with error %s. Setting to unit sphere.' %
+                repr(e))
+            return False, trimesh.primitives.Sphere(radius=0.5)
+        axes=self.frustum_axes(height,width,resolution)
+        u,v,inv_depth=[np.interp(vertices[:,i],np.arange(resolution),axes[i]) for i in range(3)]
+        intrinsic=intrinsic.squeeze(0).cpu().numpy()
+        rays=np.dot(np.stack([u,v,np.ones_like(u)],axis=1),np.linalg.inv(intrinsic[0:3,0:3]).T)
+        mesh = trimesh.Trimesh(vertices=rays/inv_depth[:,None], faces=faces)
+        return True, mesh
+
     def delete_invisible_vert(self,mesh,intrinsic,height,width):
         vertices=mesh.vertices
         faces=mesh.faces
@@ -8,6 +8,7 @@ import torch.nn.functional as F
 from net_utils.libs import get_bdb_form_from_corners, recover_points_to_world_sys, \
     get_rotation_matix_result, get_bdb_3d_result, recover_points_to_obj_sys
 from net_utils.bins import *
+from models.detection.relation_net import relation_index
 
 def normal_init(m, mean, stddev, truncated=False):
     if truncated:
@@ -17,6 +18,31 @@ def normal_init(m, mean, stddev, truncated=False):
         m.bias.data.zero_()
 
 
+class _Sparse_Map(object):
+    """ 0/1 map between graph vertices stored by the (row, col) positions of its ones """
+    def __init__(self, rows, cols, shape):
+        self.rows = rows
+        self.cols = cols
+        self.shape = shape
+        self.row_count = torch.bincount(rows, minlength=shape[0])  # sum(1) of the dense map
+        self._t = None
+
+    def t(self):
+        if self._t is None:
+            self._t = _Sparse_Map(self.cols, self.rows, (self.shape[1], self.shape[0]))
+            self._t._t = self
+        return self._t
+
+    def mm(self, x):
+        # torch.mm(dense_map, x) without the dense map
+        return x.new_zeros(self.shape[0], x.size(1)).index_add_(0, self.rows, x[self.cols])
+
+    def dense(self):
+        dense_map = torch.zeros(self.shape, device=self.rows.device)
+        dense_map[self.rows, self.cols] = 1
+        return dense_map
+
+
 class _Collection_Unit(nn.Module):
     def __init__(self, dim_in, dim_out):
         super(_Collection_Unit, self).__init__()
@@ -26,8 +52,13 @@ class _Collection_Unit(nn.Module):
     def forward(self, target, source, attention_base):
         # assert attention_base.size(0) == source.size(0), "source number must be equal to attention number"
         fc_out = F.relu(self.fc(source))
-        collect = torch.mm(attention_base, fc_out)  # Nobj x Nrel Nrel x dim
-        collect_avg = collect / (attention_base.sum(1).view(collect.size(0), 1) + 1e-7)
+        if isinstance(attention_base, _Sparse_Map):
+            collect = attention_base.mm(fc_out)
+            attention_sum = attention_base.row_count.to(collect.dtype)
+        else:
+            collect = torch.mm(attention_base, fc_out)  # Nobj x Nrel Nrel x dim
+            attention_sum = attention_base.sum(1)
+        collect_avg = collect / (attention_sum.view(collect.size(0), 1) + 1e-7)
         return collect_avg
 
 
@@ -88,6 +119,8 @@ class GCNN(nn.Module):
         self.res_output = cfg['model']['output_adjust'].get('res_output', False)
         self.feat_update_group = cfg['model']['output_adjust'].get('feat_update_group', 1)
         self.res_group = cfg['model']['output_adjust'].get('res_group', False)
+        # message passing over the edge lists of the graph, False multiplies with the dense vertex/relation maps
+        self.sparse_graph = cfg['model']['output_adjust'].get('sparse_graph', True)
 
         self.feature_length = {
             'size_cls': 9, 'cls_codes': 9,
@@ -218,7 +251,7 @@ class GCNN(nn.Module):
 
         return bdb3D_form
 
-    def _get_object_features(self, data, type):
+    def _get_object_features(self, data, type, graph):
         features = []
         keys = self.obj_features if type == 'obj' else self.rel_features
         for k in keys:
@@ -231,19 +264,11 @@ class GCNN(nn.Module):
                 v = data[k]
             elif k == 'bdb2D_pos':
                 v = data[k].clone()
-                center_inds = data['K'][:, :2, 2]
-                for center_ind, (start, end) in zip(center_inds.long(), data['split'].long()):
-                    for i in range(start.item(), end.item()):
-                        v[i][0] = (v[i][0] - center_ind[0]) / center_ind[0]
-                        v[i][2] = (v[i][2] - center_ind[0]) / center_ind[0]
-                        v[i][1] = (v[i][1] - center_ind[1]) / center_ind[1]
-                        v[i][3] = (v[i][3] - center_ind[1]) / center_ind[1]
+                center_inds = data['K'][:, :2, 2].long()[graph['obj_batch']].to(v.dtype).repeat(1, 2)
+                v[graph['obj_index']] = (v[graph['obj_index']] - center_inds) / center_inds
             elif k == 'K':
                 camKs = self._K2feature(data[k])
-                v = []
-                for i, (start, end) in enumerate(data['split']):
-                    v.append(camKs[i:i+1, :].expand(end-start, -1))
-                v = torch.cat(v, 0)
+                v = camKs[graph['obj_batch']]
             elif k in ['analytic_code', 'structured_implicit_vector', 'blob_center']:
                 if k == 'analytic_code':
                     v = data['structured_implicit'].analytic_code
@@ -269,11 +294,11 @@ class GCNN(nn.Module):
                 element_count = centers.shape[1]
 
                 # put points to other objects' coor
-                max_sample_points = (data['split'][:, 1] - data['split'][:, 0]).max() * element_count
-                other_obj_samples = torch.zeros([len(obj_samples), max_sample_points, 3], device=centers.device)
-                for start, end in data['split']:
-                    other_obj_sample = obj_samples[start:end].reshape(1, -1, 3).expand(end - start, -1, -1)
-                    other_obj_samples[start:end, :other_obj_sample.shape[1]] = other_obj_sample
+                # row i holds the samples of all objects of its image, the image of object j at columns j, j + 1, ...
+                max_objects = graph['max_objects']
+                other_obj_samples = torch.zeros([len(obj_samples), max_objects, element_count, 3], device=centers.device)
+                other_obj_samples[graph['pair_i'], graph['pair_col']] = obj_samples[graph['pair_j']]
+                other_obj_samples = other_obj_samples.view(len(obj_samples), max_objects * element_count, 3)
                 other_obj_samples = recover_points_to_obj_sys(bdb3D_form, other_obj_samples, ldif_center, ldif_coef)
                 other_obj_samples[:, :, 2] *= -1
 
@@ -285,9 +310,7 @@ class GCNN(nn.Module):
                 )['global_decisions'] + 0.07
 
                 # reshape into relation features
-                v = [est_sdf[start:end, :(end - start) * element_count].reshape(-1, element_count)
-                     for start, end in data['split']]
-                v = torch.cat(v)
+                v = est_sdf.view(len(obj_samples), max_objects, element_count)[graph['pair_i'], graph['pair_col']]
 
             else:
                 raise NotImplementedError
@@ -295,13 +318,7 @@ class GCNN(nn.Module):
             if type == 'obj' or k in ('g_features', 'ldif_phy'):
                 features.append(v)
             else:
-                features_rel = []
-                for start, end in data['split'].long():
-                    features_rel.append(torch.stack(
-                        [torch.cat([loc1, loc2], -1)
-                         for loc1 in v[start:end]
-                         for loc2 in v[start:end]]))
-                features.append(torch.cat(features_rel, 0))
+                features.append(torch.cat([v[graph['pair_i']], v[graph['pair_j']]], -1))
         return torch.cat(features, -1)
 
     def _get_layout_features(self, data):
@@ -319,67 +336,93 @@ class GCNN(nn.Module):
             features.append(v)
         return torch.cat(features, -1)
 
-    def _get_map(self, data):
+    def _get_graph(self, data):
+        '''
+        index tensors of the graph of a batch, built once on the cpu from split and rel_pair_counts.
+        Each image is a complete subgraph with self circles of its Ni object vertices followed by 1 layout vertex,
+        relation vertices connect every ordered pair of different obj/lo vertices of a subgraph.
+        '''
         device = data['g_features'].device
-        split = data['split'].long()
+        split = data['split'].long().cpu()
+        rel_pair_counts = data['rel_pair_counts'].long().cpu()
+        obj_index, obj_batch, obj_pos, pair_index, pair_batch, pair_row, pair_col, max_objects = \
+            relation_index(split, rel_pair_counts, 'cpu')
         obj_num = split[-1][-1] + split.shape[0]  # number of objects and layouts
-        obj_obj_map = torch.zeros([obj_num, obj_num])  # mapping of obj/lo vertices with connections
-        rel_inds = []  # indexes of vertices connected by relation nodes
-        rel_masks = []  # mask of relation features for obj/lo vertices connected by relation nodes
+        lo_index = torch.arange(split.shape[0])
+
+        # each subgraph has Ni object vertices and 1 layout vertex
+        vertex_counts = split[:, 1] - split[:, 0] + 1
+        vertex_start = split[:, 0] + lo_index
+        lo_vertex = vertex_start + vertex_counts - 1
+        obj_vertex = vertex_start[obj_batch] + obj_pos
+
+        # all ordered vertex pairs of every subgraph, row-major as torch.meshgrid lists them
+        full_counts = vertex_counts * vertex_counts
+        full_batch = torch.repeat_interleave(lo_index, full_counts)
+        full_pos = torch.arange(full_batch.shape[0]) - (torch.cumsum(full_counts, 0) - full_counts)[full_batch]
+        subj_local = full_pos // vertex_counts[full_batch]
+        obj_local = full_pos % vertex_counts[full_batch]
+        subj_ind = vertex_start[full_batch] + subj_local
+        obj_ind = vertex_start[full_batch] + obj_local
+
+        # vertices connected by relation nodes should be different
+        rel_masks = subj_ind != obj_ind
+        rel_inds = torch.stack([subj_ind[rel_masks], obj_ind[rel_masks]], -1)
+        # relation vertices between two objects take their relation features, the ones touching the layout are padded
+        rel_batch, rel_subj, rel_obj = full_batch[rel_masks], subj_local[rel_masks], obj_local[rel_masks]
+        rel_obj_counts = vertex_counts[rel_batch] - 1
+        rel_objobj = (rel_subj < rel_obj_counts) & (rel_obj < rel_obj_counts)
+        rel_feature_index = (rel_pair_counts[rel_batch] + rel_subj * rel_obj_counts + rel_obj)[rel_objobj]
+
         obj_masks = torch.zeros(obj_num, dtype=torch.bool)  # mask of object vertices
+        obj_masks[obj_vertex] = True
         lo_masks = torch.zeros(obj_num, dtype=torch.bool)  # mask of layout vertices
-        for lo_index, (start, end) in enumerate(split):
-            start = start + lo_index  # each subgraph has Ni object vertices and 1 layout vertex
-            end = end + lo_index + 1  # consider layout vertex, Ni + 1 vertices in total
-            obj_obj_map[start:end, start:end] = 1  # each subgraph is a complete graph with self circle
-            obj_ind = torch.arange(start, end, dtype=torch.long)
-            subj_ind_i, obj_ind_i = torch.meshgrid(obj_ind, obj_ind)  # indexes of each vertex in the subgraph
-            rel_ind_i = torch.stack([subj_ind_i.reshape(-1), obj_ind_i.reshape(-1)], -1)
-            rel_mask_i = rel_ind_i[:, 0] != rel_ind_i[:, 1]  # vertices connected by relation nodes should be different
-            rel_inds.append(rel_ind_i[rel_mask_i])
-            rel_masks.append(rel_mask_i)
-            obj_masks[start:end - 1] = True  # for each subgraph, first Ni vertices are objects
-            lo_masks[end - 1] = True  # for each subgraph, last 1 vertex is layout
-
-        rel_inds = torch.cat(rel_inds, 0)
-        rel_masks = torch.cat(rel_masks, 0)
-
-        subj_pred_map = torch.zeros(obj_num, rel_inds.shape[0])  # [sum(Ni + 1), sum((Ni + 1) ** 2)]
-        obj_pred_map = torch.zeros(obj_num, rel_inds.shape[0])
-        # map from subject (an object or layout vertex) to predicate (a relation vertex)
-        subj_pred_map.scatter_(0, (rel_inds[:, 0].view(1, -1)), 1)
-        # map from object (an object or layout vertex) to predicate (a relation vertex)
-        obj_pred_map.scatter_(0, (rel_inds[:, 1].view(1, -1)), 1)
-
-        return rel_masks.to(device), obj_masks.to(device), lo_masks.to(device), \
-               obj_obj_map.to(device), subj_pred_map.to(device), obj_pred_map.to(device)
+        lo_masks[lo_vertex] = True
+
+        rel_ids = torch.arange(rel_inds.shape[0])
+        maps = {
+            # mapping of obj/lo vertices with connections
+            'obj_obj_map': _Sparse_Map(subj_ind.to(device), obj_ind.to(device), (int(obj_num), int(obj_num))),
+            # map from subject (an object or layout vertex) to predicate (a relation vertex)
+            'subj_pred_map': _Sparse_Map(rel_inds[:, 0].to(device), rel_ids.to(device), (int(obj_num), rel_inds.shape[0])),
+            # map from object (an object or layout vertex) to predicate (a relation vertex)
+            'obj_pred_map': _Sparse_Map(rel_inds[:, 1].to(device), rel_ids.to(device), (int(obj_num), rel_inds.shape[0])),
+        }
+        if not self.sparse_graph:
+            maps = {key: maps[key].dense() for key in maps}
+
+        graph = {'obj_index': obj_index, 'obj_batch': obj_batch, 'obj_vertex': obj_vertex, 'lo_vertex': lo_vertex,
+                 'pair_i': split[pair_batch, 0] + pair_row, 'pair_j': split[pair_batch, 0] + pair_col,
+                 'pair_col': pair_col, 'rel_objobj': rel_objobj, 'rel_feature_index': rel_feature_index,
+                 'obj_masks': obj_masks, 'lo_masks': lo_masks}
+        graph = {key: graph[key].to(device) for key in graph}
+        graph.update(maps)
+        graph['obj_num'] = int(obj_num)
+        graph['max_objects'] = max_objects
+        return graph
 
     def forward(self, output):
-        maps = self._get_map(output)
-        if maps is None:
-            return {}
-        rel_masks, obj_masks, lo_masks, obj_obj_map, subj_pred_map, obj_pred_map = maps
+        graph = self._get_graph(output)
+        obj_masks, lo_masks = graph['obj_masks'], graph['lo_masks']
+        obj_obj_map, subj_pred_map, obj_pred_map = graph['obj_obj_map'], graph['subj_pred_map'], graph['obj_pred_map']
 
-        x_obj, x_pred = self._get_object_features(output, 'obj'), self._get_object_features(output, 'rel')
+        x_obj, x_pred = self._get_object_features(output, 'obj', graph), self._get_object_features(output, 'rel', graph)
         #print(x_obj.shape,x_pred.shape)
         x_obj, x_pred = self.obj_embedding(x_obj), self.rel_embedding(x_pred)
         x_lo = self._get_layout_features(output)
         #print(x_lo.shape)
         x_lo = self.lo_embedding(x_lo)
 
-        x_obj_lo = [] # representation of object and layout vertices
-        x_pred_objlo = [] # representation of relation vertices connecting obj/lo vertices
-        rel_pair = output['rel_pair_counts'].long()
-        for lo_index, (start, end) in enumerate(output['split'].long()):
-            x_obj_lo.append(x_obj[start:end]) # for each subgraph, first Ni vertices are objects
-            x_obj_lo.append(x_lo[lo_index:lo_index+1]) # for each subgraph, last 1 vertex is layout
-            x_pred_objlo.append(
-                x_pred[rel_pair[lo_index]:rel_pair[lo_index + 1]].reshape(end - start, end - start, -1))
-            x_pred_objlo[-1] = F.pad(x_pred_objlo[-1].permute(2,0,1), [0, 1, 0, 1], "constant", 0.001).permute(1,2,0)
-            x_pred_objlo[-1] = x_pred_objlo[-1].reshape((end - start + 1) ** 2, -1)
-        x_obj = torch.cat(x_obj_lo) # from here, for compatibility with graph-rcnn, x_obj corresponds to obj/lo vertices
-        x_pred = torch.cat(x_pred_objlo)
-        x_pred = x_pred[rel_masks]
+        # representation of object and layout vertices, for each subgraph first Ni vertices are objects
+        # and the last 1 vertex is layout
+        x_obj_lo = x_obj.new_empty(graph['obj_num'], x_obj.shape[1])
+        x_obj_lo[graph['obj_vertex']] = x_obj[graph['obj_index']]
+        x_obj_lo[graph['lo_vertex']] = x_lo
+        # representation of relation vertices connecting obj/lo vertices, 0.001 for the ones touching the layout
+        x_pred_objlo = x_pred.new_full((graph['rel_objobj'].shape[0], x_pred.shape[1]), 0.001)
+        x_pred_objlo[graph['rel_objobj']] = x_pred[graph['rel_feature_index']]
+        x_obj = x_obj_lo # from here, for compatibility with graph-rcnn, x_obj corresponds to obj/lo vertices
+        x_pred = x_pred_objlo
 
         '''feature level agcn'''
         obj_feats = [x_obj]
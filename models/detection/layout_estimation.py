@@ -46,12 +46,13 @@ class PoseNet(nn.Module):
                 if hasattr(m.bias, 'data'):
                     m.bias.data.zero_()
 
-        # load pretrained resnet
-        pretrained_dict = model_zoo.load_url(model_urls['resnet34'])
-        model_dict = self.resnet.state_dict()
-        pretrained_dict = {k: v for k, v in pretrained_dict.items() if k in model_dict}
-        model_dict.update(pretrained_dict)
-        self.resnet.load_state_dict(model_dict)
+        # load pretrained resnet, model.pretrained_resnet: False keeps the random weights (no download)
+        if cfg['model'].get('pretrained_resnet', True):
+            pretrained_dict = model_zoo.load_url(model_urls['resnet34'])
+            model_dict = self.resnet.state_dict()
+            pretrained_dict = {k: v for k, v in pretrained_dict.items() if k in model_dict}
+            model_dict.update(pretrained_dict)
+            self.resnet.load_state_dict(model_dict)
         #self.resnet=nn.DataParallel(self.resnet)
 
     def forward(self, x):
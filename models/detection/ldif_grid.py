@@ -0,0 +1,146 @@
+# In-process evaluation of StructuredImplicit on the grids of ldif2mesh, for all objects of a batch at once.
+# The volumes follow the .grd files of ldif2mesh: depth, height, width order, the same sample positions and the
+# same culling of the elements whose RBF weight is below 1e-4, so extract_mesh.marching_cubes reads them unchanged.
+# A coarse grid is evaluated first and only the band of voxels around the surface is refined at full resolution.
+import numpy as np
+import torch
+import torch.nn.functional as F
+from external.ldif.representation import quadrics
+
+def grid_axis(resolution, extent, device=None):
+    '''
+    sample positions along one axis of the grid, as the Eval kernel of ldif2mesh places them.
+    '''
+    index = torch.arange(resolution, dtype=torch.float32, device=device)
+    fraction = (0.5 + (resolution - 0.5) * (index / resolution)) / resolution
+    return fraction * (2 * extent) - extent
+
+def grid_matrix(resolution, extent):
+    '''
+    :return: 4 x 4 transformation from the (depth, height, width) voxel index to x, y, z
+    '''
+    scale = 2 * extent * (resolution - 0.5) / resolution ** 2
+    offset = extent / resolution - extent
+    return np.array([[0, 0, scale, offset],
+                     [0, scale, 0, offset],
+                     [scale, 0, 0, offset],
+                     [0, 0, 0, 1]], dtype=np.float32)
+
+class LDIFGridEvaluator(object):
+    '''
+    evaluates a batch of StructuredImplicit at points that each belong to one of its objects.
+    '''
+    def __init__(self, structured_implicit, cull_threshold=1e-4):
+        '''
+        :param cull_threshold: elements with a smaller RBF weight at a point are skipped there,
+                               0 keeps all of them as class_at_samples does
+        '''
+        constants, centers, radii, world2local, iparams = structured_implicit.effective_elements
+        self.net = structured_implicit.net
+        self.effective_element_count = constants.shape[1]
+        self.constants = constants[..., 0]
+        self.centers = centers
+        self.inv_cov = quadrics.decode_covariance_roll_pitch_yaw(radii, invert=True)
+        self.world2local = world2local[:, :, :3, :]
+        self.iparams = iparams.reshape(-1, iparams.shape[-1])
+        # the symmetric elements see the samples reflected across the YZ plane
+        self.flip = torch.ones(self.effective_element_count, 3, device=constants.device)
+        self.flip[structured_implicit.element_count:, 0] = -1
+        self.cull_threshold = cull_threshold
+
+    def __call__(self, points, batch_index):
+        '''
+        :param points: M x 3
+        :param batch_index: M, object of every point
+        :return: M, values of class_at_samples without class transfer
+        '''
+        samples = points.unsqueeze(1) * self.flip
+        diff = samples - self.centers[batch_index]
+        weights = torch.exp(-0.5 * torch.einsum('mei,meij,mej->me', diff, self.inv_cov[batch_index], diff))
+
+        # the decoder only runs for the elements that influence a point
+        point_ids, element_ids = torch.nonzero(weights > self.cull_threshold, as_tuple=True)
+        object_ids = batch_index[point_ids]
+        world2local = self.world2local[object_ids, element_ids]
+        local_samples = torch.matmul(world2local[:, :, :3], samples[point_ids, element_ids].unsqueeze(-1))[..., 0] \
+                        + world2local[:, :, 3]
+        implicit_values = self.net.decoder(self.iparams, local_samples,
+                                           object_ids * self.effective_element_count + element_ids)[:, 0]
+
+        local_decisions = self.constants[object_ids, element_ids] * weights[point_ids, element_ids] * (1 + implicit_values)
+        return torch.zeros(len(points), device=points.device, dtype=local_decisions.dtype).index_add_(
+            0, point_ids, local_decisions)
+
+def eval_voxels(evaluator, volume, voxels, axis, chunk_size):
+    '''
+    write the values at the voxels (object, depth, height, width) into volume, chunk_size voxels at a time.
+    '''
+    for start in range(0, len(voxels), chunk_size):
+        b, z, y, x = voxels[start:start + chunk_size].unbind(1)
+        volume[b, z, y, x] = evaluator(torch.stack([axis[x], axis[y], axis[z]], 1), b)
+    return volume
+
+def cell_index(resolution, coarse_index):
+    '''
+    coarse cell of every fine index and the position of the index in the cell.
+    '''
+    fine_index = torch.arange(resolution, device=coarse_index.device)
+    cell = (torch.searchsorted(coarse_index, fine_index, right=True) - 1).clamp(0, len(coarse_index) - 2)
+    t = (fine_index - coarse_index[cell]).float() / (coarse_index[cell + 1] - coarse_index[cell]).float()
+    return cell, t
+
+def upsample(coarse, cell, t):
+    '''
+    trilinear interpolation of the coarse volumes at every fine index.
+    '''
+    for dim in [1, 2, 3]:
+        shape = [1, 1, 1, 1]
+        shape[dim] = -1
+        coarse = coarse.index_select(dim, cell) * (1 - t.view(shape)) + coarse.index_select(dim, cell + 1) * t.view(shape)
+    return coarse
+
+def eval_grid(structured_implicit, resolution, extent, chunk_size=32768, cull_threshold=1e-4, coarse_step=4,
+              band=0.1, level=-0.07):
+    '''
+    volumes of all objects of structured_implicit on the resolution^3 grid of ldif2mesh.
+    :param coarse_step: spacing of the coarse grid in voxels, 1 evaluates every voxel
+    :param band: the cells of the coarse grid whose values come within band of level, and their neighbours,
+                 are evaluated at full resolution, the rest is interpolated from the coarse grid
+    :return: Batch_size x resolution x resolution x resolution tensor
+    '''
+    batch_size, device = structured_implicit.batch_size, structured_implicit.device
+    axis = grid_axis(resolution, extent, device)
+    with torch.no_grad():
+        evaluator = LDIFGridEvaluator(structured_implicit, cull_threshold)
+        if coarse_step <= 1 or resolution <= 2 * coarse_step:
+            volume = torch.empty(batch_size, resolution, resolution, resolution, device=device)
+            active = torch.ones_like(volume, dtype=torch.bool)
+        else:
+            # coarse nodes are fine voxels, the last one included
+            coarse_index = torch.arange(0, resolution, coarse_step, device=device)
+            if coarse_index[-1] != resolution - 1:
+                coarse_index = torch.cat([coarse_index, torch.tensor([resolution - 1], device=device)])
+            coarse_count = len(coarse_index)
+            coarse = torch.empty(batch_size, coarse_count, coarse_count, coarse_count, device=device)
+            nodes = torch.nonzero(torch.ones_like(coarse, dtype=torch.bool))
+            eval_voxels(evaluator, coarse, nodes, axis[coarse_index], chunk_size)
+
+            cell, t = cell_index(resolution, coarse_index)
+            volume = upsample(coarse, cell, t)
+            cell_min = -F.max_pool3d(-coarse.unsqueeze(1), 2, stride=1)
+            cell_max = F.max_pool3d(coarse.unsqueeze(1), 2, stride=1)
+            active_cells = ((cell_min <= level + band) & (cell_max >= level - band)).float()
+            active_cells = F.max_pool3d(active_cells, 3, stride=1, padding=1)[:, 0] > 0
+            active = active_cells[:, cell][:, :, cell][:, :, :, cell]
+        eval_voxels(evaluator, volume, torch.nonzero(active), axis, chunk_size)
+    return volume
+
+def grid_options(config):
+    '''
+    keyword arguments of eval_grid read from config['data'].
+    '''
+    data = config['data']
+    return {'chunk_size': data.get('ldif_grid_chunk_size', 32768),
+            'cull_threshold': data.get('ldif_grid_cull_threshold', 1e-4),
+            'coarse_step': data.get('ldif_grid_coarse_step', 4),
+            'band': data.get('ldif_grid_band', 0.1)}
@@ -11,6 +11,7 @@ import tempfile
 import subprocess
 from external.ldif.representation.structured_implicit_function import StructuredImplicit
 from external.ldif.inference import extract_mesh
+from models.detection import ldif_grid
 import numpy as np
 from external.PIFu.lib import mesh_util
 import trimesh
@@ -45,15 +46,23 @@ class BatchedCBNLayer(nn.Module):
         self.register_buffer('running_mean', torch.zeros(1))
         self.register_buffer('running_var', torch.ones(1))
 
-    def forward(self, shape_embedding, sample_embeddings):
+    def forward(self, shape_embedding, sample_embeddings, element_index=None):
+        '''
+        :param element_index: embedding of every sample when the samples come as one flat Number_of_samples x dim
+        '''
         beta = self.fc_beta(shape_embedding)
         gamma = self.fc_gamma(shape_embedding)
+        if element_index is not None:
+            beta, gamma = beta[element_index].unsqueeze(1), gamma[element_index].unsqueeze(1)
+            sample_embeddings = sample_embeddings.unsqueeze(1)
         if self.training:
             batch_mean, batch_variance = sample_embeddings.mean().detach(), sample_embeddings.var().detach()
             self.running_mean = 0.995 * self.running_mean + 0.005 * batch_mean
             self.running_var = 0.995 * self.running_var + 0.005 * batch_variance
         sample_embeddings = (sample_embeddings - self.running_mean) / torch.sqrt(self.running_var + 1e-5)
 
+        if element_index is not None:
+            return (gamma * sample_embeddings + beta)[:, 0]
         out = gamma.unsqueeze(1) * sample_embeddings + beta.unsqueeze(1)
 
         return out
@@ -67,13 +76,13 @@ class BatchedOccNetResnetLayer(nn.Module):
         self.bn2 = BatchedCBNLayer(f_dim=f_dim)
         self.fc2 = nn.Linear(f_dim, f_dim)
 
-    def forward(self, shape_embedding, sample_embeddings):
-        sample_embeddings = self.bn1(shape_embedding, sample_embeddings)
+    def forward(self, shape_embedding, sample_embeddings, element_index=None):
+        sample_embeddings = self.bn1(shape_embedding, sample_embeddings, element_index)
         init_sample_embeddings = sample_embeddings
 
         sample_embeddings = torch.relu(sample_embeddings)
         sample_embeddings = self.fc1(sample_embeddings)
-        sample_embeddings = self.bn2(shape_embedding, sample_embeddings)
+        sample_embeddings = self.bn2(shape_embedding, sample_embeddings, element_index)
 
         sample_embeddings = torch.relu(sample_embeddings)
         sample_embeddings = self.fc2(sample_embeddings)
@@ -124,10 +133,13 @@ class OccNetDecoder(nn.Module):
         f.write(struct.pack('f', bias))
         f.close()
 
-    def forward(self, embedding, samples):
+    def forward(self, embedding, samples, element_index=None):
+        '''
+        :param element_index: row of embedding for every sample, samples are then Number_of_samples x 3
+        '''
         sample_embeddings = self.fc1(samples)
-        sample_embeddings = self.resnet(embedding, sample_embeddings)
-        sample_embeddings = self.bn(embedding, sample_embeddings)
+        sample_embeddings = self.resnet(embedding, sample_embeddings, element_index)
+        sample_embeddings = self.bn(embedding, sample_embeddings, element_index)
         vals = self.fc2(sample_embeddings)
         return vals
 
@@ -190,7 +202,14 @@ class LDIF(nn.Module):
 
     def extract_mesh(self, structured_implicit, resolution=64, extent=0.75, num_samples=10000,
                      cuda=True, marching_cube=True):
-        if cuda:
+        if self.config['data'].get('ldif_grid_eval', 'torch') == 'torch':
+            # all objects evaluated in process on the grid of ldif2mesh
+            volumes = ldif_grid.eval_grid(structured_implicit, resolution, extent, **ldif_grid.grid_options(self.config))
+            volumes = volumes.cpu().numpy()
+            if not marching_cube:
+                return volumes, ldif_grid.grid_matrix(resolution, extent)
+            mesh = [extract_mesh.marching_cubes(volume, extent)[1] for volume in volumes]
+        elif cuda:
             mesh = []
             for s in structured_implicit.unbind():
                 if self._temp_folder is None:
@@ -368,7 +387,14 @@ class LDIF_joint(nn.Module):
 
     def extract_mesh(self, structured_implicit, resolution=64, extent=0.75, num_samples=10000,
                      cuda=True, marching_cube=True):
-        if cuda:
+        if self.config['data'].get('ldif_grid_eval', 'torch') == 'torch':
+            # all objects evaluated in process on the grid of ldif2mesh
+            volumes = ldif_grid.eval_grid(structured_implicit, resolution, extent, **ldif_grid.grid_options(self.config))
+            volumes = volumes.cpu().numpy()
+            if not marching_cube:
+                return volumes, ldif_grid.grid_matrix(resolution, extent)
+            mesh = [extract_mesh.marching_cubes(volume, extent)[1] for volume in volumes]
+        elif cuda:
             mesh = []
             for s in structured_implicit.unbind():
                 if self._temp_folder is None:
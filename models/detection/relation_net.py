@@ -28,6 +28,10 @@ class RelationNet(nn.Module):
         # control scale
         self.conv_s = nn.Conv1d(1,1,1)
 
+        # pad the images to the largest object count and attend over the whole batch at once,
+        # False runs the images one by one
+        self.batched = True
+
 
     def forward(self, a_features, g_features, split, rel_pair_counts):
         '''
@@ -70,6 +74,56 @@ class RelationNet(nn.Module):
         #print(a_features.shape)
         v_features = a_features.view(a_features.size(0), rel_cfg.Nr, -1).transpose(0, 1)
 
+        if self.batched:
+            r_features = self.batched_relation(k_features, q_features, v_features, g_weights, split, rel_pair_counts)
+        else:
+            r_features = self.per_image_relation(k_features, q_features, v_features, g_weights, split, rel_pair_counts)
+        r_features = self.conv_s(r_features.unsqueeze(1)).squeeze(1)
+
+        return r_features
+
+    def batched_relation(self, k_features, q_features, v_features, g_weights, split, rel_pair_counts):
+        '''
+        relational features of all images with one bmm and softmax. The objects of every image are padded to the
+        largest object count M, the padded objects get no weight in the softmax and their outputs are dropped.
+        :param k_features, q_features: Nr x num_objects_in_batch x d_k
+        :param v_features: Nr x num_objects_in_batch x dim
+        :param g_weights: Nr x num_pairs_in_batch
+        :return: num_objects_in_batch x (Nr * dim)
+        '''
+        obj_index, obj_batch, obj_pos, pair_index, pair_batch, pair_row, pair_col, max_objects = \
+            relation_index(split, rel_pair_counts, k_features.device)
+        batch_size = split.size(0)
+        Nr = k_features.size(0)
+
+        def pad(features):
+            # Nr x num_objects_in_batch x dim -> (Nr * Batch_size) x M x dim
+            padded = features.new_zeros(Nr, batch_size, max_objects, features.size(2))
+            padded[:, obj_batch, obj_pos] = features[:, obj_index]
+            return padded.view(Nr * batch_size, max_objects, features.size(2))
+
+        a_weights = torch.div(torch.bmm(pad(k_features), pad(q_features).transpose(1, 2)), math.sqrt(rel_cfg.d_k))
+
+        padded_g_weights = g_weights.new_ones(Nr, batch_size, max_objects, max_objects)
+        padded_g_weights[:, pair_batch, pair_row, pair_col] = g_weights[:, pair_index]
+        padded_g_weights = padded_g_weights.view(Nr * batch_size, max_objects, max_objects)
+
+        # the softmax runs over the first object index, the padded objects there get a zero weight
+        valid = torch.zeros(batch_size, max_objects, dtype=torch.bool, device=k_features.device)
+        valid[obj_batch, obj_pos] = True
+        fin_weight = torch.log(padded_g_weights) + a_weights
+        fin_weight = self.softmax(fin_weight.masked_fill(~valid.repeat(Nr, 1)[:, :, None], float('-inf')))
+
+        r_features = torch.bmm(pad(v_features).transpose(1, 2), fin_weight)
+        # (Nr * Batch_size) x dim x M -> Batch_size x M x Nr x dim, rows of the real objects only
+        r_features = r_features.view(Nr, batch_size, -1, max_objects).permute(1, 3, 0, 2)
+        r_features = r_features[obj_batch, obj_pos]
+        return r_features.reshape(r_features.size(0), -1)
+
+    def per_image_relation(self, k_features, q_features, v_features, g_weights, split, rel_pair_counts):
+        '''
+        the original per image loop of batched_relation.
+        '''
         # to estimate appearance weight
         r_features = []
 
@@ -96,7 +150,30 @@ class RelationNet(nn.Module):
 
             r_features.append(sample_r_feature)
 
-        r_features = torch.cat(r_features, 0)
-        r_features = self.conv_s(r_features.unsqueeze(1)).squeeze(1)
-
-        return r_features
\ No newline at end of file
+        return torch.cat(r_features, 0)
+
+def relation_index(split, rel_pair_counts, device):
+    '''
+    where the objects and the object pairs of a batch go in the padded Batch_size x M (x M) layout.
+    :return: index into the batch, image and position of every object, index into the batch, image, row and column
+             of every pair, and M. Objects and pairs are listed image by image as the per image loop visits them.
+    '''
+    split = split.long().cpu()
+    rel_pair_counts = rel_pair_counts.long().cpu()
+    counts = split[:, 1] - split[:, 0]
+    batch_ids = torch.arange(split.size(0))
+
+    obj_batch = torch.repeat_interleave(batch_ids, counts)
+    obj_pos = torch.arange(obj_batch.size(0)) - (torch.cumsum(counts, 0) - counts)[obj_batch]
+    obj_index = split[obj_batch, 0] + obj_pos
+
+    pair_counts = counts * counts
+    pair_batch = torch.repeat_interleave(batch_ids, pair_counts)
+    pair_pos = torch.arange(pair_batch.size(0)) - (torch.cumsum(pair_counts, 0) - pair_counts)[pair_batch]
+    pair_index = rel_pair_counts[pair_batch] + pair_pos
+    pair_row = pair_pos // counts[pair_batch]
+    pair_col = pair_pos % counts[pair_batch]
+
+    max_objects = int(counts.max()) if counts.numel() > 0 else 0
+    return [index.to(device) for index in [obj_index, obj_batch, obj_pos, pair_index, pair_batch, pair_row, pair_col]] \
+        + [max_objects]
@@ -7,6 +7,7 @@ from net_utils.libs import get_layout_bdb_sunrgbd, get_bdb_form_from_corners, \
     get_bdb_2d_result, physical_violation, recover_points_to_obj_sys,R_from_yaw_pitch_roll
 import numpy as np
 from net_utils.bins import *
+from external.ldif.representation.structured_implicit_function import StructuredImplicit
 
 
 cls_criterion = nn.CrossEntropyLoss(reduction='mean')
@@ -82,8 +83,8 @@ def get_layout_bdb(bins_tensor,pitch_cls_result,pitch_reg_result,lo_centroid_reg
     pitch_reg=pitch_reg_result[torch.arange(pitch_cls_result.shape[0]),pitch_cls_ind.long()]
     pitch=torch.mean(bins_tensor["pitch_bin"][pitch_cls_ind],dim=1)+pitch_reg*PITCH_WIDTH
 
-    lo_centroid = torch.tensor(avg_layout['avg_centroid']).float().cuda() + lo_centroid_reg
-    lo_coeffs=torch.tensor(avg_layout['avg_size']).float().cuda()+lo_coeffs_reg
+    lo_centroid = torch.tensor(avg_layout['avg_centroid']).float().to(lo_centroid_reg.device) + lo_centroid_reg
+    lo_coeffs=torch.tensor(avg_layout['avg_size']).float().to(lo_coeffs_reg.device)+lo_coeffs_reg
     layout_bdb=layout_corner_from_pred(pitch,lo_centroid,lo_coeffs)
     return layout_bdb
 
@@ -122,8 +123,8 @@ class LDIFLoss(BaseLoss):
 
         bounding_box = config['data']['bounding_box']
         lower, upper = -bounding_box, bounding_box
-        lower_error = torch.max(lower - element_centers, torch.zeros(1).cuda())
-        upper_error = torch.max(element_centers - upper, torch.zeros(1).cuda())
+        lower_error = torch.max(lower - element_centers, torch.zeros(1).to(element_centers.device))
+        upper_error = torch.max(element_centers - upper, torch.zeros(1).to(element_centers.device))
         bounding_box_constraint_error = lower_error * lower_error + upper_error * upper_error
         bounding_box_error = torch.mean(bounding_box_constraint_error)
         inside_box_loss = config['model']['inside_box_loss_weight'] * bounding_box_error
@@ -184,7 +185,7 @@ def get_corners_of_bb3d(coeffs,centroid,ori):
 
     verts = torch.cat(
         [c1[:, None], c2[:, None], c3[:, None], c4[:, None], c5[:, None], c6[:, None], c7[:, None], c8[:, None]], dim=1)
-    Ry = torch.zeros((patch_size, 3, 3)).cuda()
+    Ry = torch.zeros((patch_size, 3, 3)).to(coeffs.device)
     Ry[:, 0, 0] = cy
     Ry[:, 0, 2] = sy
     Ry[:, 1, 1] = 1
@@ -268,7 +269,13 @@ class JointLoss(BaseLoss):
                {'cam_R_result':cam_R_result, 'bdb3D_result':bdb3D_result}
 
 def get_phy_loss_samples(ldif, structured_implicit, ldif_center, ldif_coef, phy_loss_samples,
-                         return_range=False, surface_optimize=False):
+                         return_range=False, surface_optimize=False, surface_steps=10, surface_lr=200.):
+    '''
+    sample points inside the LDIF of every object, all objects at once on the device.
+    :param surface_steps: gradient steps moving the surface samples towards the LDIF surface
+    :param surface_lr: step size of the surface samples
+    :return: Number_of_objects x phy_loss_samples x 3, with return_range also the bounds of the inside points
+    '''
     # get inside points from blob centers
     centers = structured_implicit.all_centers.clone()
     sample_points = centers
@@ -278,71 +285,41 @@ def get_phy_loss_samples(ldif, structured_implicit, ldif_center, ldif_coef, phy_
                                device=centers.device) - 0.5) * 2 * ldif_coef.unsqueeze(1) + ldif_center.unsqueeze(1)
     sample_points = torch.cat([sample_points, bbox_samples], 1)
 
+    # the samples are only selected with the LDIF, a detached copy is evaluated without tracking the network
+    # and keeps its sample independent terms between the evaluations
+    sif = StructuredImplicit(config=ldif.config, net=ldif,
+                             **{k: v.detach() for k, v in structured_implicit.dict().items()})
+
     # optimize to get surface points
     if surface_optimize:
-        surface_samples = sample_points.clone()
-        surface_samples.requires_grad = True
-        ldif_grad = []
-        for param in ldif.parameters():
-            ldif_grad.append(param.requires_grad)
-            param.requires_grad = True
-        optimizer = torch.optim.SGD([surface_samples], 200)
+        surface_samples = sample_points.detach().clone()
         with torch.enable_grad():
-            for i in range(10):
-                optimizer.zero_grad()
-                est_sdf = ldif(
-                    samples=surface_samples,
-                    structured_implicit=structured_implicit.dict(),
-                    apply_class_transfer=False,
-                )['global_decisions'] + 0.07
-                # from external.PIFu.lib import sample_util
-                # sample_util.save_samples_truncted_prob(f'out/inside_sample_{i}.ply', surface_samples[0].detach().cpu(),
-                #                                        (est_sdf[0] < 0).detach().cpu())
+            for i in range(surface_steps):
+                surface_samples.requires_grad = True
+                est_sdf = sif.class_at_samples(surface_samples, apply_class_transfer=False)[0] + 0.07
                 error = torch.mean(abs(est_sdf))
-                error.backward()
-                optimizer.step()
-                # print(f"({i}) sdf error: {error:.4f}")
-        for param, requires_grad in zip(ldif.parameters(), ldif_grad):
-            param.requires_grad = requires_grad
-        surface_samples.requires_grad = False
+                grad, = torch.autograd.grad(error, surface_samples)
+                surface_samples = (surface_samples - surface_lr * grad).detach()
         sample_points = torch.cat([sample_points, surface_samples], 1)
 
     # remove outside points
-    est_sdf = ldif(
-        samples=sample_points,
-        structured_implicit=structured_implicit.dict(),
-        apply_class_transfer=True,
-    )['global_decisions']
-    inside_samples = []
-    in_coor_min = []
-    in_coor_max = []
-    for i, (s, mask) in enumerate(zip(sample_points, est_sdf < 0.5)):
-        inside_sample = s[mask.squeeze(), :]
-        if return_range:
-            if len(inside_sample) > 0:
-                inside_min = inside_sample.min(0)[0]
-                inside_max = inside_sample.max(0)[0]
-            if len(inside_sample) <= 0 or (inside_min == inside_max).sum() > 0:
-                inside_min = centers[i].min(0)[0]
-                inside_max = centers[i].max(0)[0]
-            in_coor_min.append(inside_min)
-            in_coor_max.append(inside_max)
-        # from external.PIFu.lib import sample_util
-        # sample_util.save_samples_truncted_prob('out/inside_sample.ply', s.detach().cpu(),
-        #                                        mask.detach().cpu())
-        if len(inside_sample) <= 0:
-            inside_sample = centers[i]
-        # from external.PIFu.lib import sample_util
-        # sample_util.save_samples_truncted_prob('out/inside_sample.ply', inside_sample.detach().cpu(),
-        #                                        np.zeros(inside_sample.shape[0]))
-        p_ids = np.random.choice(len(inside_sample), phy_loss_samples, replace=True)
-        inside_sample = inside_sample[p_ids]
-        inside_samples.append(inside_sample)
-    inside_samples = torch.stack(inside_samples)
+    with torch.no_grad():
+        est_sdf = sif.class_at_samples(sample_points.detach(), apply_class_transfer=True)[0]
+    inside = est_sdf[..., 0] < 0.5
+    has_inside = inside.any(1)
+
+    # objects without inside points sample their blob centers, the first points of sample_points
+    weights = inside.float()
+    weights[:, :centers.shape[1]] += (~has_inside).float().unsqueeze(1)
+    p_ids = torch.multinomial(weights, phy_loss_samples, replacement=True)
+    inside_samples = torch.gather(sample_points, 1, p_ids.unsqueeze(-1).expand(-1, -1, 3))
 
     if return_range:
-        in_coor_min = torch.stack(in_coor_min)
-        in_coor_max = torch.stack(in_coor_max)
+        in_coor_min = sample_points.masked_fill(~inside.unsqueeze(-1), float('inf')).min(1)[0]
+        in_coor_max = sample_points.masked_fill(~inside.unsqueeze(-1), float('-inf')).max(1)[0]
+        use_centers = ~has_inside | (in_coor_min == in_coor_max).any(1)
+        in_coor_min = torch.where(use_centers.unsqueeze(1), centers.min(1)[0], in_coor_min)
+        in_coor_max = torch.where(use_centers.unsqueeze(1), centers.max(1)[0], in_coor_max)
         return inside_samples, in_coor_min, in_coor_max
     return inside_samples
 
@@ -358,6 +335,8 @@ class LDIFReconLoss(BaseLoss):
         phy_loss_samples = loss_settings['phy_loss_samples']
         phy_loss_objects = loss_settings['phy_loss_objects']
         surface_optimize = config['model']['loss_settings']['surface_optimize']
+        surface_steps = loss_settings.get('surface_steps', 10)
+        surface_lr = loss_settings.get('surface_lr', 200.)
         sdf_data = {}
 
         if get_phy_loss:
@@ -370,7 +349,8 @@ class LDIFReconLoss(BaseLoss):
                 obj_center = ldif_center.clone()
                 #obj_center[:, 2] *= -1
                 inside_samples = get_phy_loss_samples(ldif, structured_implicit, obj_center, ldif_coef,
-                                                      phy_loss_samples, surface_optimize=surface_optimize)
+                                                      phy_loss_samples, surface_optimize=surface_optimize,
+                                                      surface_steps=surface_steps, surface_lr=surface_lr)
 
             # put points to other objects' coor
             #inside_samples[:, :, 2] *= -1
@@ -379,37 +359,37 @@ class LDIFReconLoss(BaseLoss):
             if max_sample_points == 0:
                 sdf_data['ldif_phy_loss'] = None
             else:
-                est_sdf = []
-                for start, end in gt_data['split']:
-                    assert end > start
-                    if end > start + 1:
-                        centroids = bdb3D_form['centroid'][start:end]
-                        centroids = centroids.unsqueeze(0).expand(len(centroids), -1, -1)
-                        distances = F.pairwise_distance(
-                            centroids.reshape(-1, 3), centroids.transpose(0, 1).reshape(-1, 3), 2
-                        ).reshape(len(centroids), len(centroids))
-                        for obj_ind in range(start, end):
-                            other_obj_dis = distances[obj_ind - start]
-                            _, nearest = torch.sort(other_obj_dis)
-                            other_obj_sample = obj_samples[start:end].index_select(
-                                0, nearest[1:phy_loss_objects + 1]).reshape(-1, 3)
-                            other_obj_sample = recover_points_to_obj_sys(
-                                {k: v[obj_ind:obj_ind + 1] for k, v in bdb3D_form.items()},
-                                other_obj_sample.unsqueeze(0),
-                                ldif_center[obj_ind:obj_ind + 1],
-                                ldif_coef[obj_ind:obj_ind + 1]
-                            )
-                            #other_obj_sample[:, :, 2] *= -1
-                            sdf = ldif(
-                                samples=other_obj_sample,
-                                structured_implicit=structured_implicit[obj_ind:obj_ind + 1].dict(),
-                                apply_class_transfer=False,
-                            )['global_decisions']
-                            est_sdf.append(sdf.squeeze())
+                # the phy_loss_objects nearest objects of the same image, for all objects at once
+                split = gt_data['split'].long()
+                counts = split[:, 1] - split[:, 0]
+                assert (counts > 0).all()
+                obj_batch = torch.repeat_interleave(torch.arange(len(split), device=split.device), counts).to(device)
+                centroids = bdb3D_form['centroid']
+                num_objects = len(centroids)
+                distances = F.pairwise_distance(
+                    centroids.unsqueeze(0).expand(num_objects, -1, -1).reshape(-1, 3),
+                    centroids.unsqueeze(1).expand(-1, num_objects, -1).reshape(-1, 3), 2
+                ).reshape(num_objects, num_objects)
+                distances = distances.masked_fill(obj_batch.unsqueeze(0) != obj_batch.unsqueeze(1), float('inf'))
+                _, nearest = torch.sort(distances, 1)
+                nearest = nearest[:, 1:phy_loss_objects + 1]
+                # objects of images with fewer objects than phy_loss_objects + 1 have fewer neighbours
+                valid = torch.arange(1, nearest.shape[1] + 1, device=device).unsqueeze(0) < \
+                        counts.to(device)[obj_batch].unsqueeze(1)
+
+                other_obj_sample = obj_samples[nearest].reshape(num_objects, -1, 3)
+                other_obj_sample = recover_points_to_obj_sys(bdb3D_form, other_obj_sample, ldif_center, ldif_coef)
+                #other_obj_sample[:, :, 2] *= -1
+                sdf = ldif(
+                    samples=other_obj_sample,
+                    structured_implicit=structured_implicit.dict(),
+                    apply_class_transfer=False,
+                )['global_decisions']
+                est_sdf = sdf.reshape(num_objects, nearest.shape[1], -1)[valid].reshape(-1)
                 if len(est_sdf) == 0:
                     sdf_data['ldif_phy_loss'] = None
                 else:
-                    est_sdf = torch.cat(est_sdf) + 0.07
+                    est_sdf = est_sdf + 0.07
                     est_sdf[est_sdf > 0] = 0
                     gt_sdf = torch.full(est_sdf.shape, 0., device=device, dtype=torch.float32)
                     sdf_data['ldif_phy_loss'] = (est_sdf, gt_sdf)
@@ -31,7 +31,7 @@ class Attention_RoI_Module(nn.Module):
 
 
     def forward(self,img_feat,global_feat,bdb_grid):
-        roi_feat=F.grid_sample(img_feat,bdb_grid,align_corners=True,mode='bilinear')
+        roi_feat=F.grid_sample(img_feat,bdb_grid.to(img_feat.dtype),align_corners=True,mode='bilinear')
         roi_feat = self.pre_conv(roi_feat)
         if self.global_detach:
             global_feat=global_feat.detach()
@@ -10,12 +10,22 @@ def index(feat, uv):
     :return: [B, C, N] image features at the uv coordinates
     '''
     #uv = uv.transpose(1, 2)  # [B, N, 2]
-    uv = uv.unsqueeze(2)  # [B, N, 1, 2]
+    uv = uv.unsqueeze(2).to(feat.dtype)  # [B, N, 1, 2], grid_sample needs matching dtypes under autocast
     # NOTE: for newer PyTorch, it seems that training results are degraded due to implementation diff in F.grid_sample
     # for old versions, simply remove the aligned_corners argument.
     samples = torch.nn.functional.grid_sample(feat, uv, align_corners=True,mode='bilinear')  # [B, C, N, 1]
     return samples[:, :, :, 0]  # [B, C, N]
 
+def stack_batch(x, num_stack):
+    '''
+    repeat x along the batch dimension for the hourglass stacks sampled as one batch.
+    :param x: [B, ...] tensor shared by the stacks
+    :return: [num_stack*B, ...] tensor, stack major
+    '''
+    if num_stack == 1:
+        return x
+    return x.repeat(num_stack, *[1] * (x.dim() - 1))
+
 class BasePIFuNet(nn.Module):
     def __init__(self,
                  projection_mode='orthogonal',
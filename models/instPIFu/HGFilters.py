@@ -1,6 +1,8 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
+import functools
 from net_utils.network_utils import *
 
 
@@ -168,6 +170,8 @@ class HGFilter(nn.Module):
         self.num_modules = opt["model"]["num_stack"]
 
         self.opt = opt
+        # stacks whose activations are recomputed in backward instead of being kept alive
+        self.checkpoint_stacks = set(opt["model"].get("checkpoint_stacks") or [])
 
         # Base part
         self.conv1 = nn.Conv2d(3, 64, kernel_size=7, stride=2, padding=3)
@@ -214,7 +218,12 @@ class HGFilter(nn.Module):
                 self.add_module('al' + str(hg_module), nn.Conv2d(opt["model"]["hourglass_dim"],
                                                                  256, kernel_size=1, stride=1, padding=0))
 
-    def forward(self, x):
+    def forward(self, x, stacks=None):
+        '''
+        :param stacks: indices of the stacks to return, negative ones count from the last stack. The filter stops
+                       after the highest of them and the stacks that are not returned are None in the output list.
+                       None returns every stack.
+        '''
         x = F.relu(self.bn1(self.conv1(x)), True)
         tmpx = x
         if self.opt["model"]["hg_down"] == 'ave_pool':
@@ -232,24 +241,43 @@ class HGFilter(nn.Module):
 
         previous = x
 
+        if stacks is None:
+            stacks = range(self.num_modules)
+        stacks = set(i % self.num_modules for i in stacks)
+        last_stack = max(stacks)
         outputs = []
-        for i in range(self.num_modules):
-            hg = self._modules['m' + str(i)](previous)
-            ll = hg
-            ll = self._modules['top_m_' + str(i)](ll)
+        for i in range(last_stack + 1):
+            # the input of the next stack is only needed up to the last requested one
+            stack_forward = functools.partial(self._stack_forward, i, merge=i < last_stack)
+            if i in self.checkpoint_stacks and self.training and torch.is_grad_enabled():
+                tmp_out, previous = torch.utils.checkpoint.checkpoint(stack_forward, previous, use_reentrant=False)
+            else:
+                tmp_out, previous = stack_forward(previous)
+            outputs.append(tmp_out if i in stacks else None)
+        outputs += [None] * (self.num_modules - last_stack - 1)
+        return outputs, tmpx.detach(), normx
 
-            ll = F.relu(self._modules['bn_end' + str(i)]
-                        (self._modules['conv_last' + str(i)](ll)), True)
+    def _stack_forward(self, i, previous, merge=True):
+        '''
+        run hourglass stack i.
+        :param merge: compute the input of the next stack
+        :return: the stack output and the input of the next stack
+        '''
+        hg = self._modules['m' + str(i)](previous)
+        ll = hg
+        ll = self._modules['top_m_' + str(i)](ll)
 
-            # Predict heatmaps
-            tmp_out = self._modules['l' + str(i)](ll)
-            outputs.append(tmp_out)
+        ll = F.relu(self._modules['bn_end' + str(i)]
+                    (self._modules['conv_last' + str(i)](ll)), True)
 
-            if i < self.num_modules - 1:
-                ll = self._modules['bl' + str(i)](ll)
-                tmp_out_ = self._modules['al' + str(i)](tmp_out)
-                previous = previous + ll + tmp_out_
-        return outputs, tmpx.detach(), normx
+        # Predict heatmaps
+        tmp_out = self._modules['l' + str(i)](ll)
+
+        if merge and i < self.num_modules - 1:
+            ll = self._modules['bl' + str(i)](ll)
+            tmp_out_ = self._modules['al' + str(i)](tmp_out)
+            previous = previous + ll + tmp_out_
+        return tmp_out, previous
 
 class HGFilter_pixatten(nn.Module):
     def __init__(self, opt):
@@ -1,14 +1,14 @@
-from models.instPIFu.BasePIFuNet import BasePIFuNet
+from models.instPIFu.BasePIFuNet import BasePIFuNet,stack_batch
 from models.instPIFu.SurfaceClassifier import SurfaceClassifier
 from models.instPIFu.HGFilters import *
 from net_utils.init_net import init_net
-from skimage import measure
-import trimesh
 from models.instPIFu.PositionEmbedder import get_embedder
 import pickle as p
 from models.instPIFu.Attention_module import Attention_RoI_Module
 import numpy as np
 from models.modules.resnet import resnet18_full,resnet18_small_stride
+import torch.utils.checkpoint
+from net_utils.profiler import profiler
 
 def positionalEncoder(cam_points, embedder, output_dim):
     cam_points = cam_points.permute(0, 2, 1)#[B,N,3]
@@ -42,6 +42,7 @@ class InstPIFu(BasePIFuNet):
 
         self.name = 'hgpifu'
         self.config=opt
+        self.eval_stacks=[0,-2]
 
         self.opt = opt
         self.num_views = 1
@@ -130,7 +131,8 @@ class InstPIFu(BasePIFuNet):
         store all intermediate features.
         :param images: [B, C, H, W] input images
         '''
-        self.im_feat_list, self.tmpx, self.normx = self.image_filter(images)
+        # the test time query uses the first stack for the global feature and the second last for the RoI feature
+        self.im_feat_list, self.tmpx, self.normx = self.image_filter(images, None if self.training else self.eval_stacks)
         # If it is not in training, only produce the last im_feat
         #if not self.training:
         #    self.im_feat_list = [self.im_feat_list[-1]]
@@ -166,17 +168,15 @@ class InstPIFu(BasePIFuNet):
 
         self.intermediate_preds_list = []
 
-        '''reconstruction using only the global feature'''
         if self.config['data']['use_positional_embedding']:
             position_feat = self.embedder(points.transpose(1,2), self.origin_embedder, self.embedder_outDim)
-            point_global_feat_list = [position_feat, z_feat.transpose(1, 2),
-                                     cls_codes.unsqueeze(2).repeat(1, 1, points.shape[1])]
         else:
-            point_global_feat_list = [points.transpose(1,2),z_feat.transpose(1,2),cls_codes.unsqueeze(2).repeat(1,1,points.shape[1])]
-            #print(point_local_feat_list[0].shape,points.shape)
-        point_global_feat_list.append(self.global_feat.unsqueeze(2).repeat(1, 1, points.shape[1]))
-        global_point_feat=torch.cat(point_global_feat_list,dim=1)
-        global_pred=self.global_surface_classifier(global_point_feat)
+            position_feat = points.transpose(1,2)
+        cls_feat = cls_codes.unsqueeze(2).repeat(1, 1, points.shape[1])
+        global_point_feat = self.global_feat.unsqueeze(2).repeat(1, 1, points.shape[1])
+
+        '''reconstruction using only the global feature'''
+        global_pred=self.global_surface_classifier(torch.cat([position_feat, z_feat.transpose(1, 2), cls_feat, global_point_feat],dim=1))
 
         self.intermediate_preds_list.append(global_pred)
         self.mask_list=[]
@@ -187,30 +187,35 @@ class InstPIFu(BasePIFuNet):
             input_im_feat=self.im_feat_list[0:-1]
         else:
             input_im_feat=self.im_feat_list[-2:-1]
+        shared_feat_list=[position_feat, z_feat.transpose(1, 2), cls_feat]
+        if self.opt["model"]["skip_hourglass"]:
+            shared_feat_list.append(tmpx_local_feature)
+        shared_feat_list.append(global_point_feat)
+        if len(input_im_feat)>1 and self.config['model'].get('fuse_stacks',True):
+            '''the stacks share every module after the filter, run them as one [num_stack*B] batch'''
+            input_im_feat=[torch.cat(input_im_feat,dim=0)]
         for im_feat in input_im_feat:
+            num_stack=im_feat.shape[0]//points.shape[0]
+            stack_grid=stack_batch(bdb_grid,num_stack)
             if self.config['model']['use_atten']:
-                ret_dict=self.post_op_module(im_feat,torch.cat([self.global_feat,cls_codes],dim=1),bdb_grid)
+                atten_input=(im_feat,stack_batch(torch.cat([self.global_feat,cls_codes],dim=1),num_stack),stack_grid)
+                if self.config['model'].get('checkpoint_atten',False) and self.training and torch.is_grad_enabled():
+                    '''recompute the RoI attention activations in backward'''
+                    ret_dict=torch.utils.checkpoint.checkpoint(self.post_op_module,*atten_input,use_reentrant=False)
+                else:
+                    ret_dict=self.post_op_module(*atten_input)
                 roi_feat=ret_dict["roi_feat"]
-                self.channel_atten_list.append(ret_dict['channel_atten_weight'])
+                self.channel_atten_list+=list(torch.chunk(ret_dict['channel_atten_weight'],num_stack,dim=0))
             else:
-                roi_feat = F.grid_sample(im_feat, bdb_grid, align_corners=True, mode='bilinear')
+                roi_feat = F.grid_sample(im_feat, stack_grid.to(im_feat.dtype), align_corners=True, mode='bilinear')
             if self.config['data']['use_instance_mask']:
-                pred_mask=self.mask_decoder(roi_feat)
-                self.mask_list.append(pred_mask)
-            if self.config['data']['use_positional_embedding']:
-                position_feat = self.embedder(points.transpose(1,2), self.origin_embedder, self.embedder_outDim)
-                point_local_feat_list = [self.index(roi_feat, xy),position_feat, z_feat.transpose(1, 2),
-                                         cls_codes.unsqueeze(2).repeat(1, 1, points.shape[1])]
-            else:
-                point_local_feat_list = [self.index(roi_feat, xy), points.transpose(1,2),z_feat.transpose(1,2),cls_codes.unsqueeze(2).repeat(1,1,points.shape[1])]
-
-            if self.opt["model"]["skip_hourglass"]:
-                point_local_feat_list.append(tmpx_local_feature)
-            point_local_feat_list.append(self.global_feat.unsqueeze(2).repeat(1,1,points.shape[1]))
+                self.mask_list+=list(torch.chunk(self.mask_decoder(roi_feat),num_stack,dim=0))
+            point_local_feat_list = [self.index(roi_feat, stack_batch(xy,num_stack))]
+            point_local_feat_list += [stack_batch(feat,num_stack) for feat in shared_feat_list]
             point_local_feat = torch.cat(point_local_feat_list, 1)
 
             pred=self.surface_classifier(point_local_feat)
-            self.intermediate_preds_list.append(pred)
+            self.intermediate_preds_list+=list(torch.chunk(pred,num_stack,dim=0))
         #print(len(self.intermediate_preds_list))
         self.preds = self.intermediate_preds_list[-1].squeeze(1)
 
@@ -231,34 +236,33 @@ class InstPIFu(BasePIFuNet):
             uni_error = 0
             for preds in self.intermediate_preds_list:
                 #print(preds.shape,self.labels.shape)
-                nss_error += self.error_term(preds[:,0,0:2048],self.labels[:,0:2048])
-                uni_error += self.error_term(preds[:,0,2048:],self.labels[:,2048:])
+                nss_error += self.error_term(preds[:,0,0:2048].float(),self.labels[:,0:2048])
+                uni_error += self.error_term(preds[:,0,2048:].float(),self.labels[:,2048:])
             nss_error /= len(self.intermediate_preds_list)
             uni_error /= len(self.intermediate_preds_list)
             self.nss_recon_loss=nss_error
             self.uni_recon_loss=uni_error
             mask_error=0
             for pred_mask in self.mask_list:
-                mask_error+=nn.MSELoss()(pred_mask,F.interpolate(self.mask_label,size=(pred_mask.shape[2],pred_mask.shape[3]),mode="nearest"))
+                mask_error+=nn.MSELoss()(pred_mask.float(),F.interpolate(self.mask_label,size=(pred_mask.shape[2],pred_mask.shape[3]),mode="nearest"))
             self.mask_loss=mask_error/len(self.mask_list)
             return nss_error*0.1+uni_error*1 + self.mask_loss
         elif self.config['data']['dataset']=="front3d_recon":
             error = 0
             for preds in self.intermediate_preds_list:
                 # print(preds.shape,self.labels.shape)
-                error += self.error_term(preds, self.labels)
+                error += self.error_term(preds.float(), self.labels)
             error /= len(self.intermediate_preds_list)
             self.recon_loss = error
             mask_error = 0
             for pred_mask in self.mask_list:
-                mask_error += nn.MSELoss()(pred_mask,
+                mask_error += nn.MSELoss()(pred_mask.float(),
                                            F.interpolate(self.mask_label, size=(pred_mask.shape[2], pred_mask.shape[3]),
                                                          mode="nearest"))
             self.mask_loss = mask_error / len(self.mask_list)
             return error + self.mask_loss
 
     def forward(self, data_dict):
-        print("data_dict keys in InstPIFu_net.py line 261: ", data_dict.keys())
         # Get image feature
         images, points, labels,img_coor,cls_codes = data_dict["whole_image"],data_dict["samples"],data_dict["inside_class"],data_dict["img_coor"],data_dict["cls_codes"]
         patch=data_dict["patch"]
@@ -268,13 +272,13 @@ class InstPIFu(BasePIFuNet):
 
         transforms = None
         self.filter(images,patch)
-        last_roi_feat = F.grid_sample(self.im_feat_list[0], bdb_grid, align_corners=True, mode='bilinear')
+        last_roi_feat = F.grid_sample(self.im_feat_list[0], bdb_grid.to(self.im_feat_list[0].dtype), align_corners=True, mode='bilinear')
         self.global_feat = self.global_encoder(last_roi_feat)
         # Phase 2: point query
         self.query(points=points, z_feat=z_feat,bdb_grid=bdb_grid,transforms=transforms,cls_codes=cls_codes, labels=labels,img_coor=img_coor)#,depth=depth)
 
-        # get the prediction
-        res = self.get_preds()
+        # get the prediction, losses and the occupancy threshold are kept in fp32
+        res = self.get_preds().float()
         #print(res)
 
         # get the error
@@ -312,28 +316,75 @@ class InstPIFu(BasePIFuNet):
         ret_dict["pred_mask"]=self.mask_list[-1]
         return ret_dict,loss_info
     def extract_mesh(self,data_dict,marching_cube_resolution=64):
-        whole_image,image, cls_codes =data_dict["whole_image"],data_dict["image"],data_dict["cls_codes"]
+        return self.extract_meshes(data_dict,marching_cube_resolution)[0]
+    def extract_meshes(self,data_dict,marching_cube_resolution=64):
+        '''
+        extract one mesh per object of the batch, the point queries of all objects run together.
+        :return: list of trimesh.Trimesh in the canonical object space
+        '''
+        pred=self.predict_volumes(data_dict,marching_cube_resolution)
+        return self.meshes_from_pred(pred,marching_cube_resolution)
+    def predict_volumes(self,data_dict,marching_cube_resolution=64):
+        '''
+        :return: [B, marching_cube_resolution**3] occupancy of the marching cubes grid
+        '''
+        whole_image, cls_codes =data_dict["whole_image"],data_dict["cls_codes"]
         patch = data_dict["patch"]
-        if self.config['data']['dataset']=='pix3d_recon':
-            K=data_dict['K']
-        else:
-            K=data_dict["K"]
-        rot_matrix=data_dict["rot_matrix"]
-        bbox_size=data_dict["bbox_size"]
-        obj_cam_center=data_dict["obj_cam_center"]
         bdb_grid=data_dict['bdb_grid']
         transforms = None
-        self.filter(whole_image, patch)
-        last_roi_feat = F.grid_sample(self.im_feat_list[0], bdb_grid, align_corners=True, mode='bilinear')
-        self.global_feat = self.global_encoder(last_roi_feat)
+        with profiler.stage('filter'):
+            self.filter(whole_image, patch)
+        with profiler.stage('global_encoder'):
+            last_roi_feat = F.grid_sample(self.im_feat_list[0], bdb_grid.to(self.im_feat_list[0].dtype), align_corners=True, mode='bilinear')
+            self.global_feat = self.global_encoder(last_roi_feat)
+
+        samples_incan,z_feat,img_coor=self.query_grid(data_dict,marching_cube_resolution)
 
+        '''conduct test on prepared sampled'''
+        if self.config['debug']:
+            #print(samples_incam[:,-4096:].shape,img_coor[:,0:-4096:].shape,data_dict["inside_class"].shape)
+            self.query(points=samples_incan[:,-4096:],z_feat=z_feat[:,-4096:,],transforms=transforms,cls_codes=cls_codes,labels=data_dict["inside_class"],
+                       img_coor=img_coor[:,-4096:],bdb_grid=bdb_grid)
+            res=self.get_preds().float()
+            pred_occ = torch.zeros(res.shape).to(res.device)
+            pred_occ[res > 0.5] = 1
+            pred_occ[res < 0.5] = 0
+            pred_acc = torch.mean(1 - torch.abs(pred_occ - self.labels))
+            print("debuging test accuracy is %f"%(pred_acc))
+            samples_incan,z_feat,img_coor=samples_incan[:,0:-4096],z_feat[:,0:-4096],img_coor[:,0:-4096]
+        # Phase 2: point query, the chunk is shared by the objects of the batch to keep the peak memory of one object
+        chunk_size = max(200000 // whole_image.shape[0], 1)
+        sample_list = torch.split(samples_incan, chunk_size, dim=1)
+        img_coor_list = torch.split(img_coor, chunk_size, dim=1)
+        z_feat_list = torch.split(z_feat, chunk_size, dim=1)
+        pred_list = []
+        for i in range(len(sample_list)):
+            # Phase 2: point query
+            with profiler.stage('query'):
+                self.query(points=sample_list[i], z_feat=z_feat_list[i], transforms=transforms, cls_codes=cls_codes,
+                           img_coor=img_coor_list[i],bdb_grid=bdb_grid)
+
+                res = self.get_preds().float()
+            pred_list.append(res)
+        return torch.cat(pred_list, dim=1)
+    def query_grid(self,data_dict,marching_cube_resolution):
+        '''
+        the marching cubes grid in the canonical space of every object and its query inputs,
+        the gt samples are appended at the end in debug mode.
+        :return: samples_incan [B,N,3], z_feat [B,N,1], img_coor [B,N,2]
+        '''
+        image=data_dict["image"]
+        K=data_dict["K"]
+        rot_matrix=data_dict["rot_matrix"]
+        bbox_size=data_dict["bbox_size"]
+        obj_cam_center=data_dict["obj_cam_center"]
         x_coor = torch.linspace(-1.2, 1.2, steps=marching_cube_resolution).float().to(image.device)
         y_coor = torch.linspace(-1.2, 1.2, steps=marching_cube_resolution).float().to(image.device)
         z_coor = torch.linspace(-1.2, 1.2, steps=marching_cube_resolution).float().to(image.device)
         X, Y, Z = torch.meshgrid(x_coor, y_coor, z_coor)
 
         samples_incan = torch.cat([X[:, :, :, None], Y[:, :, :, None], Z[:, :, :, None]], dim=3).unsqueeze(0)
-        samples_incan=samples_incan.view(samples_incan.shape[0],marching_cube_resolution**3,3)
+        samples_incan=samples_incan.view(1,marching_cube_resolution**3,3).expand(image.shape[0],-1,-1)
 
         '''adds some test sample to debug'''
         if self.config['debug']:
@@ -347,59 +398,35 @@ class InstPIFu(BasePIFuNet):
         samples_incam=samples_incan*bbox_size.unsqueeze(1)/2
         samples_incam=torch.einsum('ijk,ikq->ijq',samples_incam,rot_matrix.transpose(1,2))
         samples_incam[:,:,0:2]=-samples_incam[:,:,0:2] #y down coordinate
-        samples_incam[:,:,0:3]=samples_incam[:,:,0:3]+obj_cam_center
+        samples_incam[:,:,0:3]=samples_incam[:,:,0:3]+obj_cam_center.unsqueeze(1)
 
         img_samples=torch.einsum('ijk,ikq->ijq',samples_incam[:,:,0:3],K.transpose(1,2))
-        width=K[:,0,2]*2
-        height=K[:,1,2]*2
+        width=K[:,0,2:3]*2
+        height=K[:,1,2:3]*2
         x_coor=img_samples[:,:,0]/img_samples[:,:,2] #these are image coordinate
         y_coor=img_samples[:,:,1]/img_samples[:,:,2] #these are image coordinate
         if self.config['data']['use_crop']:
             bdb2D=data_dict['bdb2D_pos']
-            x_coor=x_coor-(bdb2D[0,0]+bdb2D[0,2])/2
-            y_coor=y_coor-(bdb2D[0,1]+bdb2D[0,3])/2
-            x_coor=x_coor/(bdb2D[0,2]-bdb2D[0,0])*2
-            y_coor=y_coor/(bdb2D[0,3]-bdb2D[0,1])*2
+            x_coor=x_coor-(bdb2D[:,0:1]+bdb2D[:,2:3])/2
+            y_coor=y_coor-(bdb2D[:,1:2]+bdb2D[:,3:4])/2
+            x_coor=x_coor/(bdb2D[:,2:3]-bdb2D[:,0:1])*2
+            y_coor=y_coor/(bdb2D[:,3:4]-bdb2D[:,1:2])*2
         else:
             x_coor=((x_coor-width/2)/width)*2
             y_coor=((y_coor-height/2)/height)*2
         #print(x_coor)
         img_coor=torch.cat([x_coor[:,:,None],y_coor[:,:,None]],dim=2)
-
-        '''conduct test on prepared sampled'''
-        if self.config['debug']:
-            #print(samples_incam[:,-4096:].shape,img_coor[:,0:-4096:].shape,data_dict["inside_class"].shape)
-            self.query(points=samples_incan[:,-4096:],z_feat=z_feat[:,-4096:,],transforms=transforms,cls_codes=cls_codes,labels=data_dict["inside_class"],
-                       img_coor=img_coor[:,-4096:],bdb_grid=bdb_grid)
-            res=self.get_preds()
-            pred_occ = torch.zeros(res.shape).to(res.device)
-            pred_occ[res > 0.5] = 1
-            pred_occ[res < 0.5] = 0
-            pred_acc = torch.mean(1 - torch.abs(pred_occ - self.labels))
-            print("debuging test accuracy is %f"%(pred_acc))
-        # Phase 2: point query
-        if self.config['debug']:
-            sample_list = torch.split(samples_incan[:,0:-4096], 200000, dim=1)
-            img_coor_list = torch.split(img_coor[:,0:-4096], 200000, dim=1)
-            z_feat_list = torch.split(z_feat[:,0:-4096], 200000, dim=1)
-        else:
-            sample_list = torch.split(samples_incan, 200000, dim=1)
-            img_coor_list = torch.split(img_coor, 200000, dim=1)
-            z_feat_list = torch.split(z_feat, 200000, dim=1)
-        pred_list = []
-        for i in range(len(sample_list)):
-            # Phase 2: point query
-            self.query(points=sample_list[i], z_feat=z_feat_list[i], transforms=transforms, cls_codes=cls_codes,
-                       img_coor=img_coor_list[i],bdb_grid=bdb_grid)
-
-            res = self.get_preds()
-            pred_list.append(res)
-        pred = torch.cat(pred_list, dim=1)
-        # get the prediction
-        pred=pred.view(-1,marching_cube_resolution,marching_cube_resolution,marching_cube_resolution).squeeze(0).detach().cpu().numpy()
-        mesh=self.marching_cubes(pred,mcubes_extent=(1.2,1.2,1.2))[1]
-        clean_mesh=self.delete_disconnected_component(mesh)
-        return clean_mesh
+        return samples_incan,z_feat,img_coor
+    def meshes_from_pred(self,pred,marching_cube_resolution):
+        with profiler.stage('device_to_host'):
+            pred=pred.view(-1,marching_cube_resolution,marching_cube_resolution,marching_cube_resolution).detach().cpu().numpy()
+        mesh_list=[]
+        for volume in pred:
+            with profiler.stage('marching_cubes'):
+                mesh=self.marching_cubes(volume,mcubes_extent=(1.2,1.2,1.2))[1]
+            with profiler.stage('component_cleanup'):
+                mesh_list.append(self.delete_disconnected_component(mesh))
+        return mesh_list
     def delete_disconnected_component(self,mesh):
 
         split_mesh = mesh.split(only_watertight=False)
@@ -416,6 +443,9 @@ class InstPIFu(BasePIFuNet):
 
     def marching_cubes(self,volume, mcubes_extent):
         """Maps from a voxel grid of implicit surface samples to a Trimesh mesh."""
+        # geometry libraries are only needed for mesh extraction, keep them out of model import
+        from skimage import measure
+        import trimesh
         volume = np.squeeze(volume)
         length, height, width = volume.shape
         resolution = length
@@ -14,6 +14,7 @@ import numpy as np
 from configs.data_config import Relation_Config, NYU40CLASSES
 import math
 import collections
+from dataset.relation_features import g_features
 
 default_collate = torch.utils.data.dataloader.default_collate
 
@@ -61,27 +62,11 @@ class Total3D_Dataset(SUNRGBD):
         boxes = sequence['boxes']
 
         # build relational geometric features for each object
-        n_objects = boxes['bdb2D_pos'].shape[0]
         # g_feature: n_objects x n_objects x 4
         # Note that g_feature is not symmetric,
         # g_feature[m, n] is the feature of object m contributes to object n.
         # TODO: think about it, do we need to involve the geometric feature from each object itself?
-        g_feature = [[((loc2[0] + loc2[2]) / 2. - (loc1[0] + loc1[2]) / 2.) / (loc1[2] - loc1[0]),
-                      ((loc2[1] + loc2[3]) / 2. - (loc1[1] + loc1[3]) / 2.) / (loc1[3] - loc1[1]),
-                      math.log((loc2[2] - loc2[0]) / (loc1[2] - loc1[0])),
-                      math.log((loc2[3] - loc2[1]) / (loc1[3] - loc1[1]))] \
-                     for id1, loc1 in enumerate(boxes['bdb2D_pos'])
-                     for id2, loc2 in enumerate(boxes['bdb2D_pos'])]
-
-        locs = [num for loc in g_feature for num in loc]
-
-        pe = torch.zeros(len(locs), d_model)
-        position = torch.from_numpy(np.array(locs)).unsqueeze(1).float()
-        div_term = torch.exp(torch.arange(0, d_model, 2).float() * -(math.log(10000.) / d_model))
-        pe[:, 0::2] = torch.sin(position * div_term)
-        pe[:, 1::2] = torch.cos(position * div_term)
-
-        boxes['g_feature'] = pe.view(n_objects * n_objects, rel_cfg.d_g)
+        boxes['g_feature'] = g_features(boxes['bdb2D_pos'])
 
         # encode class
         cls_codes = torch.zeros([len(boxes['size_cls']), len(NYU40CLASSES)])
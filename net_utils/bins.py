@@ -58,4 +58,6 @@ f.close()
 
 bins_tensor={}
 for key in bin:
-    bins_tensor[key]=torch.tensor(bin[key]).float().cuda()
\ No newline at end of file
+    bins_tensor[key]=torch.tensor(bin[key]).float()
+    if torch.cuda.is_available():
+        bins_tensor[key]=bins_tensor[key].cuda()
\ No newline at end of file
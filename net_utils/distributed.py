@@ -0,0 +1,58 @@
+# Helpers for multi-process training with torch.distributed.
+# The processes are expected to be started by torchrun, which provides RANK, LOCAL_RANK and WORLD_SIZE.
+import os
+import torch
+import torch.distributed as dist
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_local_rank():
+    return int(os.environ.get('LOCAL_RANK', 0))
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_main_process():
+    return get_rank() == 0
+
+def init_distributed(cfg):
+    '''
+    initialize the default process group when data.distributed is set and the script
+    was launched with more than one process.
+    nccl is used on gpu and gloo on cpu, device.dist_backend overrides the choice.
+    :return: True if a process group was initialized
+    '''
+    config = cfg.config
+    if not config['data'].get('distributed', False) or int(os.environ.get('WORLD_SIZE', 1)) <= 1:
+        return False
+    use_cuda = config['device']['use_gpu'] and torch.cuda.is_available()
+    backend = config['device'].get('dist_backend') or ('nccl' if use_cuda else 'gloo')
+    if use_cuda:
+        torch.cuda.set_device(get_local_rank())
+    dist.init_process_group(backend=backend, init_method='env://')
+    cfg.log_string('Distributed mode is on: rank %d/%d, backend %s.' % (get_rank(), get_world_size(), backend))
+    return True
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+def all_reduce_sum(tensor):
+    '''
+    in-place sum over all processes, returns the tensor for convenience.
+    '''
+    if is_distributed():
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
+
+class NullSummaryWriter(object):
+    '''
+    stands in for the tensorboard writer on non-main processes.
+    '''
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
@@ -0,0 +1,297 @@
+# TorchScript / ONNX export of the InstPIFu and BGPIFu inference graphs, and mesh extractors running them.
+# Each network is split into an image graph, run once per image, and a point graph, run per chunk of
+# marching cubes samples. The config lookups of query() are resolved when the graphs are built, so the
+# exported graphs hold tensor operations only.
+import os
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from models.instPIFu.BasePIFuNet import index
+from models.instPIFu.InstPIFu_net import InstPIFu,positionalEncoder
+from models.bg_PIFu.BGPIFu_net import BGPIFu_Net
+from net_utils.profiler import profiler
+
+graph_names = ('image', 'point')
+
+class InstImageGraph(nn.Module):
+    '''
+    HGFilter + global_encoder + Attention_RoI_Module, the RoI feature of the stack used at test time.
+    '''
+    def __init__(self, model):
+        super(InstImageGraph, self).__init__()
+        if model.config['model']['skip_hourglass']:
+            raise NotImplementedError('skip_hourglass is not supported by the exported graphs')
+        self.image_filter = model.image_filter
+        self.global_encoder = model.global_encoder
+        self.use_atten = model.config['model']['use_atten']
+        if self.use_atten:
+            self.post_op_module = model.post_op_module
+
+    def forward(self, whole_image, bdb_grid, cls_codes):
+        im_feat_list, _, _ = self.image_filter(whole_image, [0, -2])
+        last_roi_feat = F.grid_sample(im_feat_list[0], bdb_grid, align_corners=True, mode='bilinear')
+        global_feat = self.global_encoder(last_roi_feat)
+        if self.use_atten:
+            roi_feat = self.post_op_module(im_feat_list[-2], torch.cat([global_feat, cls_codes], dim=1), bdb_grid)["roi_feat"]
+        else:
+            roi_feat = F.grid_sample(im_feat_list[-2], bdb_grid, align_corners=True, mode='bilinear')
+        return roi_feat, global_feat
+
+class InstPointGraph(nn.Module):
+    '''
+    point features + SurfaceClassifier, equals InstPIFu.query in eval mode.
+    '''
+    def __init__(self, model):
+        super(InstPointGraph, self).__init__()
+        self.surface_classifier = model.surface_classifier
+        self.use_positional_embedding = model.config['data']['use_positional_embedding']
+        if self.use_positional_embedding:
+            self.origin_embedder, self.embedder_outDim = model.origin_embedder, model.embedder_outDim
+
+    def forward(self, points, z_feat, img_coor, roi_feat, global_feat, cls_codes):
+        num_points = points.shape[1]
+        if self.use_positional_embedding:
+            position_feat = positionalEncoder(points.transpose(1, 2), self.origin_embedder, self.embedder_outDim)
+        else:
+            position_feat = points.transpose(1, 2)
+        point_local_feat = torch.cat([index(roi_feat, img_coor), position_feat, z_feat.transpose(1, 2),
+                                      cls_codes.unsqueeze(2).expand(-1, -1, num_points),
+                                      global_feat.unsqueeze(2).expand(-1, -1, num_points)], 1)
+        return self.surface_classifier(point_local_feat).squeeze(1)
+
+class BGImageGraph(nn.Module):
+    '''
+    HGFilter + the resnet global encoder, the last stack is the one used at test time.
+    '''
+    def __init__(self, model):
+        super(BGImageGraph, self).__init__()
+        if model.config['model']['skip_hourglass']:
+            raise NotImplementedError('skip_hourglass is not supported by the exported graphs')
+        self.image_filter = model.image_filter
+        self.global_encoder = model.global_encoder
+
+    def forward(self, image):
+        im_feat_list, _, _ = self.image_filter(image, [-1])
+        return im_feat_list[-1], self.global_encoder(image)
+
+class BGPointGraph(nn.Module):
+    '''
+    point features + SurfaceClassifier, equals BGPIFu_Net.query in eval mode without augmentation.
+    '''
+    def __init__(self, model):
+        super(BGPointGraph, self).__init__()
+        self.surface_classifier = model.surface_classifier
+        self.use_positional_embedding = model.config['data']['use_positional_embedding']
+        if self.use_positional_embedding:
+            self.origin_embedder, self.embedder_outDim = model.origin_embedder, model.embedder_outDim
+
+    def forward(self, points, xy, im_feat, global_feat):
+        if self.use_positional_embedding:
+            position_feat = positionalEncoder(points.transpose(1, 2), self.origin_embedder, self.embedder_outDim)
+        else:
+            position_feat = points.transpose(1, 2)
+        point_local_feat = torch.cat([index(im_feat, xy), position_feat,
+                                      global_feat.unsqueeze(2).expand(-1, -1, points.shape[1])], 1)
+        return self.surface_classifier(point_local_feat).squeeze(1)
+
+def build_graphs(model):
+    '''
+    :return: dict of image and point graphs sharing the weights of model
+    '''
+    if isinstance(model, InstPIFu):
+        return {'image': InstImageGraph(model).eval(), 'point': InstPointGraph(model).eval()}
+    elif isinstance(model, BGPIFu_Net):
+        return {'image': BGImageGraph(model).eval(), 'point': BGPointGraph(model).eval()}
+    raise NotImplementedError
+
+def graph_specs(config, graphs, num_points=4096):
+    '''
+    example inputs, input/output names and dynamic axes of every graph. The example image size of
+    InstPIFu only matters for tracing, height and width stay dynamic in onnx.
+    '''
+    if config['method'] == 'instPIFu':
+        image_inputs = (torch.randn(1, 3, 484, 648), torch.rand(1, 64, 64, 2) * 2 - 1, torch.eye(9)[0:1])
+        with torch.no_grad():
+            roi_feat, global_feat = graphs['image'](*image_inputs)
+        point_inputs = (torch.rand(1, num_points, 3) * 2 - 1, torch.rand(1, num_points, 1) * 2 - 1,
+                        torch.rand(1, num_points, 2) * 2 - 1, roi_feat, global_feat, image_inputs[2])
+        return {
+            'image': (image_inputs, ['whole_image', 'bdb_grid', 'cls_codes'], ['roi_feat', 'global_feat'],
+                      {'whole_image': {0: 'batch', 2: 'height', 3: 'width'}, 'bdb_grid': {0: 'batch'},
+                       'cls_codes': {0: 'batch'}, 'roi_feat': {0: 'batch'}, 'global_feat': {0: 'batch'}}),
+            'point': (point_inputs, ['points', 'z_feat', 'img_coor', 'roi_feat', 'global_feat', 'cls_codes'], ['pred'],
+                      {'points': {0: 'batch', 1: 'num_points'}, 'z_feat': {0: 'batch', 1: 'num_points'},
+                       'img_coor': {0: 'batch', 1: 'num_points'}, 'roi_feat': {0: 'batch'},
+                       'global_feat': {0: 'batch'}, 'cls_codes': {0: 'batch'}, 'pred': {0: 'batch', 1: 'num_points'}}),
+        }
+    elif config['method'] == 'bgPIFu':
+        image_inputs = (torch.randn(1, 3, config['data']['image_height'], config['data']['image_width']),)
+        with torch.no_grad():
+            im_feat, global_feat = graphs['image'](*image_inputs)
+        point_inputs = (torch.rand(1, num_points, 3) * 4 + 1, torch.rand(1, num_points, 2) * 2 - 1, im_feat, global_feat)
+        return {
+            'image': (image_inputs, ['image'], ['im_feat', 'global_feat'],
+                      {'image': {0: 'batch'}, 'im_feat': {0: 'batch'}, 'global_feat': {0: 'batch'}}),
+            'point': (point_inputs, ['points', 'xy', 'im_feat', 'global_feat'], ['pred'],
+                      {'points': {0: 'batch', 1: 'num_points'}, 'xy': {0: 'batch', 1: 'num_points'},
+                       'im_feat': {0: 'batch'}, 'global_feat': {0: 'batch'}, 'pred': {0: 'batch', 1: 'num_points'}}),
+        }
+    raise NotImplementedError
+
+def graph_path(export_dir, method, name, backend):
+    return os.path.join(export_dir, '%s_%s.%s' % (method, name, 'onnx' if backend == 'onnx' else 'pt'))
+
+def export_graphs(model, config, export_dir, formats=('torchscript', 'onnx'), opset_version=16):
+    '''
+    trace the image and point graphs of model and save them for each format.
+    :param model: InstPIFu or BGPIFu_Net with loaded weights
+    :param formats: any of torchscript and onnx
+    :return: list of written files
+    '''
+    if not os.path.exists(export_dir):
+        os.makedirs(export_dir)
+    model = model.float().cpu().eval()
+    graphs = build_graphs(model)
+    specs = graph_specs(config, graphs)
+    saved = []
+    for name in graph_names:
+        inputs, input_names, output_names, dynamic_axes = specs[name]
+        if 'torchscript' in formats:
+            path = graph_path(export_dir, config['method'], name, 'torchscript')
+            with torch.no_grad():
+                traced = torch.jit.trace(graphs[name], inputs, check_trace=False)
+            traced.save(path)
+            saved.append(path)
+        if 'onnx' in formats:
+            path = graph_path(export_dir, config['method'], name, 'onnx')
+            with torch.no_grad():
+                torch.onnx.export(graphs[name], inputs, path, input_names=input_names, output_names=output_names,
+                                  dynamic_axes=dynamic_axes, opset_version=opset_version)
+            saved.append(path)
+    return saved
+
+class TorchScriptGraph(object):
+    def __init__(self, path):
+        self.module = torch.jit.load(path, map_location='cpu').eval()
+
+    def __call__(self, *inputs):
+        with torch.no_grad():
+            outputs = self.module(*[x.detach().float().cpu() for x in inputs])
+        return outputs if isinstance(outputs, tuple) else (outputs,)
+
+class OnnxGraph(object):
+    def __init__(self, path, num_threads=None):
+        # onnxruntime is only needed for this backend
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [x.name for x in self.session.get_inputs()]
+
+    def __call__(self, *inputs):
+        feeds = {name: x.detach().float().cpu().numpy() for name, x in zip(self.input_names, inputs)}
+        return tuple(torch.from_numpy(x) for x in self.session.run(None, feeds))
+
+def load_graph(path, backend, num_threads=None):
+    if backend == 'onnx':
+        return OnnxGraph(path, num_threads)
+    elif backend == 'torchscript':
+        return TorchScriptGraph(path)
+    raise NotImplementedError
+
+class ExportedInstPIFu(object):
+    '''
+    InstPIFu.extract_mesh running the exported graphs on cpu, the grid construction and marching cubes are
+    shared with the eager model.
+    '''
+    query_grid = InstPIFu.query_grid
+    meshes_from_pred = InstPIFu.meshes_from_pred
+    marching_cubes = InstPIFu.marching_cubes
+    delete_disconnected_component = InstPIFu.delete_disconnected_component
+
+    def __init__(self, config, image_graph, point_graph):
+        self.config = dict(config)
+        # the exported graphs do not keep the intermediate predictions used by the debug accuracy check
+        self.config['debug'] = False
+        self.image_graph = image_graph
+        self.point_graph = point_graph
+
+    def eval(self):
+        return self
+
+    def extract_mesh(self, data_dict, marching_cube_resolution=64):
+        return self.extract_meshes(data_dict, marching_cube_resolution)[0]
+
+    def extract_meshes(self, data_dict, marching_cube_resolution=64):
+        cls_codes = data_dict["cls_codes"].cpu()
+        with profiler.stage('filter'):
+            roi_feat, global_feat = self.image_graph(data_dict["whole_image"], data_dict['bdb_grid'], cls_codes)
+        samples_incan, z_feat, img_coor = self.query_grid({key: data_dict[key].cpu() for key in data_dict
+                                                           if isinstance(data_dict[key], torch.Tensor)},
+                                                          marching_cube_resolution)
+        chunk_size = max(200000 // samples_incan.shape[0], 1)
+        pred_list = []
+        for sample, z, coor in zip(torch.split(samples_incan, chunk_size, dim=1), torch.split(z_feat, chunk_size, dim=1),
+                                   torch.split(img_coor, chunk_size, dim=1)):
+            with profiler.stage('query'):
+                pred_list.append(self.point_graph(sample, z, coor, roi_feat, global_feat, cls_codes)[0])
+        return self.meshes_from_pred(torch.cat(pred_list, dim=1), marching_cube_resolution)
+
+class ExportedBGPIFu(object):
+    '''
+    BGPIFu_Net.extract_mesh running the exported graphs on cpu.
+    '''
+    project_points = BGPIFu_Net.project_points
+    query_grid = BGPIFu_Net.query_grid
+    grid_mode = BGPIFu_Net.grid_mode
+    frustum_axes = BGPIFu_Net.frustum_axes
+    frustum_grid = BGPIFu_Net.frustum_grid
+    mesh_from_volume = BGPIFu_Net.mesh_from_volume
+    marching_cubes = BGPIFu_Net.marching_cubes
+    frustum_marching_cubes = BGPIFu_Net.frustum_marching_cubes
+    delete_invisible_vert = BGPIFu_Net.delete_invisible_vert
+
+    def __init__(self, config, image_graph, point_graph):
+        self.config = config
+        self.image_graph = image_graph
+        self.point_graph = point_graph
+
+    def eval(self):
+        return self
+
+    def extract_mesh(self, data_dict, marching_cube_resolution=64):
+        data_dict = {key: data_dict[key].cpu() for key in data_dict if isinstance(data_dict[key], torch.Tensor)}
+        image, K = data_dict["image"], data_dict["intrinsic"]
+        height, width = image.shape[2:4]
+        with profiler.stage('filter'):
+            im_feat, global_feat = self.image_graph(image)
+        if self.grid_mode() == 'frustum':
+            visible_sample = self.frustum_grid(data_dict, marching_cube_resolution)
+        else:
+            samples_incam, visible_ind = self.query_grid(data_dict, marching_cube_resolution)
+            visible_sample = samples_incam[visible_ind[0], visible_ind[1], :].unsqueeze(0)
+        pred_list = []
+        for sample in torch.split(visible_sample, 200000, dim=1):
+            with profiler.stage('query'):
+                xy = self.project_points(sample, K, height, width)[1]
+                pred_list.append(self.point_graph(sample, xy, im_feat, global_feat)[0])
+        if self.grid_mode() == 'frustum':
+            volumn = torch.cat(pred_list, dim=1)
+        else:
+            volumn = torch.ones(marching_cube_resolution ** 3, 1)
+            volumn[visible_ind[1], :] = torch.cat(pred_list, dim=1).squeeze(0).unsqueeze(1)
+        return self.mesh_from_volume(volumn, K, height, width, marching_cube_resolution)
+
+def load_exported_model(config, export_dir, backend='torchscript', num_threads=None):
+    '''
+    :param backend: torchscript or onnx
+    :return: object with the extract_mesh interface of the eager model
+    '''
+    image_graph = load_graph(graph_path(export_dir, config['method'], 'image', backend), backend, num_threads)
+    point_graph = load_graph(graph_path(export_dir, config['method'], 'point', backend), backend, num_threads)
+    if config['method'] == 'instPIFu':
+        return ExportedInstPIFu(config, image_graph, point_graph)
+    elif config['method'] == 'bgPIFu':
+        return ExportedBGPIFu(config, image_graph, point_graph)
+    raise NotImplementedError
@@ -0,0 +1,259 @@
+# Long-running local reconstruction service. Both networks are loaded once and kept on the device,
+# object queries of concurrent requests are batched together and meshes are streamed back as they finish.
+#
+# Protocol: POST /reconstruct with a json body, one of
+#   {"testid": "rendertask7522"}                       prepare_data (and predicted pose) found through the configs
+#   {"prepare_data": path, "pred_pose": path or null}  explicit prepare_data pkl
+#   {"image_path": path or "image": base64 encoded image, "K": 3x3, "boxes": [box, ...]}
+# a box holds bdb2D_pos and size_cls, plus rot_matrix or yaw/pitch/roll, obj_cam_center or
+# project_center/centroid_depth, and bbox_size or size_reg, all at the resolution of the image.
+# "background": false skips the BGPIFu mesh.
+# The chunked response is a sequence of frames, each a json header line {"name", "size"} (or {"name", "error"})
+# followed by size bytes of ply. GET /health reports the queue state.
+import os
+import io
+import json
+import time
+import queue
+import base64
+import pickle
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler,ThreadingHTTPServer
+import numpy as np
+import torch
+from PIL import Image
+from net_utils.train_test_utils import build_inference_model,amp_autocast
+from net_utils.mesh_export import get_export_config,export_mesh_bytes
+from net_utils.tools import load_pred_result
+from dataset.scene_inputs import scene_from_prepare_data,parse_box,object_inputs,bg_inputs,collate_inputs,\
+    object_mesh_to_camera
+
+class SceneResults(queue.Queue):
+    '''
+    per request queue, closed with None once all of its meshes are done.
+    '''
+    def __init__(self,pending):
+        super(SceneResults,self).__init__()
+        self.pending=pending
+        if pending==0:
+            self.put(None)
+
+class InferenceEngine(object):
+    '''
+    owns the models and a single worker thread, so the device is only used from one thread.
+    '''
+    def __init__(self,inst_config,bg_config,device,max_batch=4,max_wait=0.05):
+        '''
+        :param max_batch: maximum number of objects reconstructed in one forward
+        :param max_wait: seconds the worker waits for more objects before running a partial batch
+        '''
+        self.inst_config=inst_config
+        self.bg_config=bg_config
+        '''the test configs compare against gt samples in debug mode, which requests do not have'''
+        self.inst_config['debug']=False
+        self.device=device
+        self.max_batch=max_batch
+        self.max_wait=max_wait
+        self.inst_model=build_inference_model(inst_config,device)
+        self.bg_model=build_inference_model(bg_config,device)
+        self.jobs=queue.Queue()
+        self.worker=threading.Thread(target=self.run,daemon=True)
+        self.worker.start()
+
+    def submit(self,request):
+        '''
+        :param request: decoded json request
+        :return: queue receiving (name, mesh, error) per mesh, then None
+        '''
+        image,K,boxes=self.parse_request(request)
+        jobs=[]
+        for box in boxes:
+            box=parse_box(box,K)
+            jobs.append(["object",box.get('obj_id',str(len(jobs))),object_inputs(image,K,box),box])
+        if request.get("background",True):
+            jobs.append(["bg","bg",bg_inputs(image,K,self.bg_config),None])
+        results=SceneResults(len(jobs))
+        for job in jobs:
+            job.append(results)
+            self.jobs.put(job)
+        return results
+
+    def parse_request(self,request):
+        if "testid" in request or "prepare_data" in request:
+            pred_result=None
+            if "testid" in request:
+                data_path=os.path.join(self.inst_config['data']['data_path'],"test",request["testid"]+".pkl")
+                if self.inst_config['data']['use_pred_pose']:
+                    pred_result=load_pred_result(self.inst_config['data']['pred_pose_path'],request["testid"])
+            else:
+                data_path=request["prepare_data"]
+                if request.get("pred_pose") is not None:
+                    with open(request["pred_pose"],'rb') as f:
+                        pred_result=pickle.load(f)
+            with open(data_path,'rb') as f:
+                sequence=pickle.load(f)
+            scene=scene_from_prepare_data(sequence,pred_result)
+            return scene["image"],scene["K"],scene["boxes"]
+        if "image_path" in request:
+            image=Image.open(request["image_path"])
+        else:
+            image=Image.open(io.BytesIO(base64.b64decode(request["image"])))
+        image=np.asarray(image.convert("RGB"))
+        return image,np.asarray(request["K"],dtype=np.float64),request.get("boxes",[])
+
+    def next_jobs(self):
+        '''
+        block for the first job, then gather more until the batch is full or max_wait has passed.
+        '''
+        job_list=[self.jobs.get()]
+        deadline=time.time()+self.max_wait
+        while len(job_list)<self.max_batch:
+            remain=deadline-time.time()
+            if remain<=0:
+                break
+            try:
+                job_list.append(self.jobs.get(timeout=remain))
+            except queue.Empty:
+                break
+        return job_list
+
+    def run(self):
+        while True:
+            job_list=self.next_jobs()
+            object_jobs=[job for job in job_list if job[0]=="object"]
+            for group in self.group_by_shape(object_jobs):
+                self.run_objects(group)
+            for job in job_list:
+                if job[0]=="bg":
+                    self.run_background(job)
+
+    def group_by_shape(self,jobs):
+        '''
+        split jobs into groups whose inputs can be stacked, so requests with images of different
+        resolutions are reconstructed in separate batches.
+        '''
+        groups={}
+        for job in jobs:
+            shapes=tuple((key,tuple(job[2][key].shape)) for key in job[2])
+            groups.setdefault(shapes,[]).append(job)
+        return list(groups.values())
+
+    def run_objects(self,object_jobs):
+        try:
+            data_batch=collate_inputs([job[2] for job in object_jobs])
+            data_batch={key:data_batch[key].to(self.device) for key in data_batch}
+            with torch.no_grad(),amp_autocast(self.inst_config,self.device):
+                mesh_list=self.inst_model.extract_meshes(data_batch,self.inst_config['data']['marching_cube_resolution'])
+        except Exception as e:
+            for job in object_jobs:
+                self.finish(job,None,repr(e))
+            return
+        for job,mesh in zip(object_jobs,mesh_list):
+            box=job[3]
+            try:
+                mesh=object_mesh_to_camera(mesh,box['rot_matrix'],box['obj_cam_center'],box['bbox_size'])
+            except Exception as e:
+                # report to the request, the worker thread has to keep serving the others
+                self.finish(job,None,repr(e))
+                continue
+            self.finish(job,mesh,None)
+
+    def run_background(self,job):
+        try:
+            data_batch=collate_inputs([job[2]])
+            data_batch={key:data_batch[key].to(self.device) for key in data_batch}
+            with torch.no_grad(),amp_autocast(self.bg_config,self.device):
+                mesh=self.bg_model.extract_mesh(data_batch,self.bg_config['data']['marching_cube_resolution'])
+        except Exception as e:
+            self.finish(job,None,repr(e))
+            return
+        self.finish(job,mesh,None)
+
+    def finish(self,job,mesh,error):
+        results=job[4]
+        results.put((job[1],mesh,error))
+        results.pending-=1
+        if results.pending==0:
+            results.put(None)
+
+class ReconstructionHandler(BaseHTTPRequestHandler):
+    protocol_version="HTTP/1.1"
+
+    def address_string(self):
+        # unix socket clients have no address
+        return self.client_address[0] if isinstance(self.client_address,tuple) else "unix"
+
+    def send_json(self,code,content):
+        body=json.dumps(content).encode()
+        self.send_response(code)
+        self.send_header("Content-Type","application/json")
+        self.send_header("Content-Length",str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def write_chunk(self,data):
+        self.wfile.write(b"%x\r\n"%(len(data))+data+b"\r\n")
+
+    def do_GET(self):
+        if self.path!="/health":
+            self.send_json(404,{"error":"unknown path %s"%(self.path)})
+            return
+        engine=self.server.engine
+        self.send_json(200,{"status":"ok","pending_jobs":engine.jobs.qsize(),"max_batch":engine.max_batch})
+
+    def do_POST(self):
+        if self.path!="/reconstruct":
+            self.send_json(404,{"error":"unknown path %s"%(self.path)})
+            return
+        engine=self.server.engine
+        try:
+            length=int(self.headers.get("Content-Length",0))
+            request=json.loads(self.rfile.read(length))
+            results=engine.submit(request)
+        except Exception as e:
+            self.send_json(400,{"error":repr(e)})
+            return
+        self.send_response(200)
+        self.send_header("Content-Type","application/octet-stream")
+        self.send_header("Transfer-Encoding","chunked")
+        self.end_headers()
+        while True:
+            item=results.get()
+            if item is None:
+                break
+            name,mesh,error=item
+            if error is not None:
+                self.write_chunk((json.dumps({"name":name,"error":error})+"\n").encode())
+                continue
+            _,content=export_mesh_bytes(mesh,self.server.export_cfg)
+            self.write_chunk((json.dumps({"name":name,"size":len(content)})+"\n").encode()+content)
+        self.write_chunk(b"")
+
+if hasattr(socketserver,"ThreadingUnixStreamServer"):
+    class ThreadingUnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads=True
+
+def serve(engine,export_cfg=None,host="127.0.0.1",port=8008,socket_path=None):
+    '''
+    serve the engine until interrupted, over a unix socket when socket_path is given.
+    '''
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server=ThreadingUnixHTTPServer(socket_path,ReconstructionHandler)
+        address=socket_path
+    else:
+        server=ThreadingHTTPServer((host,port),ReconstructionHandler)
+        address="http://%s:%d"%(host,port)
+    server.engine=engine
+    server.export_cfg=export_cfg if export_cfg is not None else get_export_config(engine.inst_config)
+    print("serving reconstruction on %s"%(address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
@@ -1,3 +1,4 @@
+import inspect
 import torch
 from torch.nn import init
 
@@ -52,4 +53,40 @@ def init_net(net, init_type='normal', init_gain=0.02, gpu_ids=[]):
         net.to(gpu_ids[0])
         net = torch.nn.DataParallel(net, gpu_ids)  # multi-GPUs
     init_weights(net, init_type, init_gain=init_gain)
-    return net
\ No newline at end of file
+    return net
+
+def meta_init_supported():
+    """torch.device works as a context manager from torch 2.0, load_state_dict(assign=True) from torch 2.1."""
+    return hasattr(torch.device, '__enter__') and \
+        'assign' in inspect.signature(torch.nn.Module.load_state_dict).parameters
+
+
+def build_on_meta(build_fn):
+    """Construct a network on the meta device, so its parameters are neither allocated nor initialized.
+
+    The network holds no data until load_state_dict(..., assign=True) replaces its tensors, see
+    load_meta_state_dict. With an older torch the network is built and initialized as usual.
+    """
+    if not meta_init_supported():
+        return build_fn()
+    with torch.device('meta'):
+        return build_fn()
+
+
+def load_meta_state_dict(net, state_dict, strict=True):
+    """Load state_dict into a network from build_on_meta, assigning the tensors instead of copying them."""
+    if meta_init_supported():
+        return net.load_state_dict(state_dict, strict=strict, assign=True)
+    return net.load_state_dict(state_dict, strict=strict)
+
+
+def check_materialized(net):
+    """Raise if a parameter, buffer or tensor attribute of net is still on the meta device after loading."""
+    missing = [name for name, tensor in list(net.named_parameters()) + list(net.named_buffers()) if tensor.is_meta]
+    for module_name, module in net.named_modules():
+        for name, value in vars(module).items():
+            if isinstance(value, torch.Tensor) and value.is_meta:
+                missing.append(module_name + '.' + name if module_name else name)
+    if len(missing) > 0:
+        raise RuntimeError('the loaded weights do not cover %s' % (', '.join(missing)))
+    return net
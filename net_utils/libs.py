@@ -47,9 +47,9 @@ def R_from_yaw_pitch_roll(yaw, pitch, roll):
     :return: camera rotation matrix
     '''
     n = yaw.size(0)
-    Rp = torch.zeros((n, 3, 3)).cuda()
-    Ry = torch.zeros((n,3,3)).cuda()
-    Rr = torch.zeros((n,3,3)).cuda()
+    Rp = torch.zeros((n, 3, 3)).to(pitch.device)
+    Ry = torch.zeros((n,3,3)).to(pitch.device)
+    Rr = torch.zeros((n,3,3)).to(pitch.device)
     cp=torch.cos(pitch)
     sp=torch.sin(pitch)
     cy=torch.cos(yaw)
@@ -105,7 +105,7 @@ def layout_basis_from_ori(ori):
     """
     n = ori.size(0)
 
-    basis = torch.zeros((n, 3, 3)).cuda()
+    basis = torch.zeros((n, 3, 3)).to(ori.device)
 
     basis[:, 0, 0] = torch.sin(ori)
     basis[:, 0, 2] = torch.cos(ori)
@@ -135,7 +135,7 @@ def get_corners_of_bb3d(coeffs,centroid,ori):
 
     verts = torch.cat(
         [c1[:, None], c2[:, None], c3[:, None], c4[:, None], c5[:, None], c6[:, None], c7[:, None], c8[:, None]], dim=1)
-    Ry = torch.zeros((patch_size, 3, 3)).cuda()
+    Ry = torch.zeros((patch_size, 3, 3)).to(coeffs.device)
     Ry[:, 0, 0] = cy
     Ry[:, 0, 2] = sy
     Ry[:, 1, 1] = 1
@@ -319,7 +319,7 @@ def basis_from_ori(ori):
     """
     n = ori.size(0)
 
-    basis = torch.zeros((n, 3, 3)).cuda()
+    basis = torch.zeros((n, 3, 3)).to(ori.device)
 
     basis[:, 0, 0] = torch.cos(ori)
     basis[:, 0, 2] = -torch.sin(ori)
@@ -0,0 +1,237 @@
+# DataLoader settings (num_workers, prefetch_factor, persistent_workers, pin_memory) and their tuning.
+# The settings come from the data section of the config. tune_loader times a dataset under several settings on
+# the current machine and recommends the fastest one, main.py --mode tune_loader writes it as a config block and
+# data.auto_tune_loader applies it at the start of training, cached per host and core count.
+import os
+import time
+import json
+import socket
+import resource
+import yaml
+import torch
+from torch.utils.data import DataLoader
+
+def loader_options(config, default_pin_memory=True):
+    '''
+    keyword arguments of DataLoader read from config['data'],
+    prefetch_factor and persistent_workers only apply with worker processes.
+    '''
+    data = config['data']
+    options = {'pin_memory': bool(data.get('pin_memory', default_pin_memory))}
+    if data['num_workers'] > 0:
+        if data.get('prefetch_factor') is not None:
+            options['prefetch_factor'] = data['prefetch_factor']
+        options['persistent_workers'] = bool(data.get('persistent_workers', False))
+    return options
+
+def rebuild_loader(dataloader, settings, sampler=None, shuffle=True):
+    '''
+    same dataset, batch size and collate function as dataloader with other worker and memory settings.
+    '''
+    kwargs = {'pin_memory': settings['pin_memory']}
+    if settings['num_workers'] > 0:
+        kwargs['prefetch_factor'] = settings.get('prefetch_factor') or 2
+        kwargs['persistent_workers'] = settings.get('persistent_workers', False)
+    return DataLoader(dataset=dataloader.dataset,
+                      batch_size=dataloader.batch_size,
+                      shuffle=shuffle if sampler is None else False,
+                      sampler=sampler,
+                      num_workers=settings['num_workers'],
+                      collate_fn=dataloader.collate_fn,
+                      worker_init_fn=dataloader.worker_init_fn,
+                      drop_last=dataloader.drop_last,
+                      **kwargs)
+
+def loader_settings(dataloader):
+    return {'num_workers': dataloader.num_workers,
+            'prefetch_factor': dataloader.prefetch_factor if dataloader.num_workers > 0 else None,
+            'persistent_workers': dataloader.persistent_workers,
+            'pin_memory': dataloader.pin_memory}
+
+def process_cpu_seconds(pid):
+    '''
+    user + system cpu time of a process from /proc, None where it is unavailable.
+    '''
+    try:
+        with open('/proc/%d/stat' % (pid)) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+def batch_size_of(batch):
+    if torch.is_tensor(batch):
+        return batch.shape[0]
+    if isinstance(batch, dict):
+        for value in batch.values():
+            size = batch_size_of(value)
+            if size is not None:
+                return size
+    if isinstance(batch, (list, tuple)) and len(batch) > 0:
+        return len(batch)
+    return None
+
+def to_device(batch, device, non_blocking):
+    if torch.is_tensor(batch):
+        return batch.to(device, non_blocking=non_blocking)
+    if isinstance(batch, dict):
+        return {key: to_device(value, device, non_blocking) for key, value in batch.items()}
+    if isinstance(batch, list):
+        return [to_device(value, device, non_blocking) for value in batch]
+    return batch
+
+def measure_loader(dataloader, num_batches, device=None, epochs=2):
+    '''
+    iterate num_batches batches of dataloader for a few epochs, copying them to device like the trainer does.
+    The second epoch shows the restart cost that persistent workers remove.
+    :return: dict with samples_per_s, the first batch latency of every epoch, and the cpu utilisation of the main
+             process and of every worker (cpu seconds / wall seconds, 1.0 is one busy core)
+    '''
+    first_batch, worker_util = [], []
+    samples, start_t = 0, time.perf_counter()
+    main_start = resource.getrusage(resource.RUSAGE_SELF)
+    for epoch in range(epochs):
+        epoch_t = time.perf_counter()
+        iterator = iter(dataloader)
+        workers = [process.pid for process in getattr(iterator, '_workers', [])]
+        worker_start = {pid: process_cpu_seconds(pid) for pid in workers}
+        worker_end = dict(worker_start)
+        for batch_id in range(num_batches):
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                break
+            if device is not None and device.type == 'cuda':
+                batch = to_device(batch, device, dataloader.pin_memory)
+            if batch_id == 0:
+                first_batch.append(time.perf_counter() - epoch_t)
+            samples += batch_size_of(batch) or dataloader.batch_size
+            for pid in workers:
+                cpu = process_cpu_seconds(pid)
+                worker_end[pid] = cpu if cpu is not None else worker_end[pid]
+        if device is not None and device.type == 'cuda':
+            torch.cuda.synchronize()
+        epoch_time = time.perf_counter() - epoch_t
+        for pid in workers:
+            if worker_start[pid] is not None and worker_end[pid] is not None:
+                worker_util.append((worker_end[pid] - worker_start[pid]) / epoch_time)
+        del iterator
+    elapsed = time.perf_counter() - start_t
+    main_end = resource.getrusage(resource.RUSAGE_SELF)
+    main_cpu = (main_end.ru_utime - main_start.ru_utime) + (main_end.ru_stime - main_start.ru_stime)
+    return {
+        'samples_per_s': samples / elapsed,
+        'elapsed': elapsed,
+        'first_batch_s': first_batch,
+        'main_cpu_util': main_cpu / elapsed,
+        'worker_cpu_util': sum(worker_util) / len(worker_util) if len(worker_util) > 0 else None,
+    }
+
+def max_loader_workers():
+    '''
+    cores available to the loaders of one training process.
+    '''
+    cpu_count = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    return max(cpu_count // int(os.environ.get('LOCAL_WORLD_SIZE', 1)), 1)
+
+def default_worker_counts(max_workers):
+    counts, count = {0, max_workers}, 1
+    while count < max_workers:
+        counts.add(count)
+        count *= 2
+    return sorted(counts)
+
+def candidate_settings(tuning_cfg, base, stage, use_cuda):
+    '''
+    staged search: the worker count first with the base settings, then prefetch_factor, persistent_workers and
+    pin_memory at the best worker count (stage 2). The grid search tries every combination at once.
+    '''
+    worker_counts = tuning_cfg.get('num_workers') or default_worker_counts(max_loader_workers())
+    prefetch_factors = tuning_cfg.get('prefetch_factor', [2, 4])
+    persistent = tuning_cfg.get('persistent_workers', [False, True])
+    pin = tuning_cfg.get('pin_memory', [False, True]) if use_cuda else [False]
+    if stage == 1:
+        prefetch_factors, persistent, pin = [2], [False], [base['pin_memory'] and use_cuda]
+    elif stage == 2:
+        worker_counts = [base['num_workers']]
+    candidates = []
+    for num_workers in worker_counts:
+        for prefetch_factor in (prefetch_factors if num_workers > 0 else [None]):
+            for persistent_workers in (persistent if num_workers > 0 else [False]):
+                for pin_memory in pin:
+                    candidates.append({'num_workers': num_workers, 'prefetch_factor': prefetch_factor,
+                                       'persistent_workers': persistent_workers, 'pin_memory': pin_memory})
+    return candidates
+
+def pick_best(records, tolerance):
+    '''
+    the fastest setting, or the one with the fewest workers among those within tolerance of it.
+    '''
+    best = max(records, key=lambda record: record['samples_per_s'])
+    close = [record for record in records if record['samples_per_s'] >= (1 - tolerance) * best['samples_per_s']]
+    return min(close, key=lambda record: (record['settings']['num_workers'], -record['samples_per_s']))
+
+def tune_loader(dataloader, tuning_cfg, device=None, log=print):
+    '''
+    :param dataloader: loader built from the config, it provides the dataset, batch size and collate function
+    :param tuning_cfg: num_batches, epochs, search (staged or grid), tolerance and the candidate lists
+    :return: best settings, list of measured records
+    '''
+    use_cuda = device is not None and device.type == 'cuda'
+    num_batches = tuning_cfg.get('num_batches', 20)
+    epochs = tuning_cfg.get('epochs', 2)
+    tolerance = tuning_cfg.get('tolerance', 0.05)
+    base = loader_settings(dataloader)
+    stages = [1, 2] if tuning_cfg.get('search', 'staged') == 'staged' else [0]
+    records = []
+    for stage in stages:
+        stage_records = []
+        for settings in candidate_settings(tuning_cfg, base, stage, use_cuda):
+            if any(record['settings'] == settings for record in records):
+                continue
+            result = measure_loader(rebuild_loader(dataloader, settings), num_batches, device, epochs)
+            result['settings'] = settings
+            stage_records.append(result)
+            log('loader %s: %.1f samples/s, first batch %s s, worker cpu %s' % (
+                json.dumps(settings), result['samples_per_s'], ['%.2f' % (t) for t in result['first_batch_s']],
+                '%.2f' % (result['worker_cpu_util']) if result['worker_cpu_util'] is not None else '-'))
+        records += stage_records
+        base = pick_best(records, tolerance)['settings']
+    return base, records
+
+def recommended_block(settings):
+    block = {'num_workers': settings['num_workers'], 'pin_memory': settings['pin_memory']}
+    if settings['num_workers'] > 0:
+        block['prefetch_factor'] = settings['prefetch_factor']
+        block['persistent_workers'] = settings['persistent_workers']
+    return {'data': block}
+
+def machine_key():
+    return {'hostname': socket.gethostname(), 'cpu_count': os.cpu_count(),
+            'loader_workers_available': max_loader_workers(),
+            'gpu': torch.cuda.get_device_name(0) if torch.cuda.is_available() else None}
+
+def save_tuning(path, settings, records):
+    '''
+    write the recommended data block as yaml, with the machine it was measured on, and the records next to it as json.
+    '''
+    save_dir = os.path.dirname(path)
+    if save_dir and not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+    content = recommended_block(settings)
+    content['tuned_on'] = machine_key()
+    with open(path, 'w') as f:
+        yaml.dump(content, f, default_flow_style=False)
+    with open(os.path.splitext(path)[0] + '.json', 'w') as f:
+        json.dump({'machine': content['tuned_on'], 'best': settings, 'records': records}, f, indent=2)
+    return path
+
+def load_tuning(path):
+    with open(path, 'r') as f:
+        return yaml.load(f, Loader=yaml.FullLoader)
+
+def tuning_cache_path(config):
+    key = machine_key()
+    name = '%s_bs%d_%s_%dcpu.yaml' % (config['data']['dataset'], config['data']['batch_size'], key['hostname'],
+                                       key['loader_workers_available'])
+    return os.path.join(config['other']['model_save_dir'], 'loader_tuning', name)
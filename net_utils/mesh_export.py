@@ -0,0 +1,162 @@
+# Mesh export stage shared by the testers and the demos.
+import os
+import numpy as np
+import trimesh
+
+QUANT_LEVELS = 65535
+
+default_export_config = {
+    'binary': True,
+    'target_faces': None,
+    'quantize': False,
+}
+
+def get_export_config(config):
+    '''
+    read the export block of a config, falling back to the defaults.
+    :param config: config dict
+    :return: dict with binary, target_faces and quantize entries
+    '''
+    export_cfg = dict(default_export_config)
+    if config.get('export') is not None:
+        export_cfg.update({k: v for k, v in config['export'].items() if v is not None})
+    return export_cfg
+
+def decimate_mesh(mesh, target_faces):
+    '''
+    quadric decimation down to target_faces, the mesh is returned untouched when it is already
+    small enough or no simplification backend is available.
+    '''
+    if not target_faces or mesh.faces.shape[0] <= target_faces:
+        return mesh
+    try:
+        return mesh.simplify_quadric_decimation(face_count=int(target_faces))
+    except (ImportError, ValueError, TypeError) as e:
+        print('Failed to decimate mesh with error %s. Exporting the full mesh.' % repr(e))
+        return mesh
+
+def quantize_vertices(vertices):
+    '''
+    map vertices into uint16 over their bounding box.
+    :return: quantized vertices, offset [3], scale [3]
+    '''
+    vertices = np.asarray(vertices, dtype=np.float64)
+    offset = vertices.min(axis=0)
+    extent = vertices.max(axis=0) - offset
+    scale = np.where(extent > 0, extent / QUANT_LEVELS, 1.0)
+    quant = np.round((vertices - offset) / scale).astype(np.uint16)
+    return quant, offset, scale
+
+def quantized_ply_bytes(vertices, faces):
+    '''
+    binary ply with ushort vertex coordinates, the dequantization offset and scale are stored
+    as header comments and read back by load_mesh.
+    '''
+    quant, offset, scale = quantize_vertices(vertices)
+    faces = np.asarray(faces, dtype=np.int32)
+    header = '\n'.join([
+        'ply',
+        'format binary_little_endian 1.0',
+        'comment quantize_offset %.9g %.9g %.9g' % tuple(offset),
+        'comment quantize_scale %.9g %.9g %.9g' % tuple(scale),
+        'element vertex %d' % quant.shape[0],
+        'property ushort x',
+        'property ushort y',
+        'property ushort z',
+        'element face %d' % faces.shape[0],
+        'property list uchar int vertex_indices',
+        'end_header',
+    ]) + '\n'
+    face_data = np.empty(faces.shape[0], dtype=[('count', 'u1'), ('index', '<i4', (3,))])
+    face_data['count'] = 3
+    face_data['index'] = faces
+    return header.encode('ascii') + quant.astype('<u2').tobytes() + face_data.tobytes()
+
+def write_quantized_ply(save_path, vertices, faces):
+    with open(save_path, 'wb') as f:
+        f.write(quantized_ply_bytes(vertices, faces))
+
+def read_quantized_ply(load_path):
+    '''
+    read a ply written by write_quantized_ply.
+    :return: vertices [N,3] float64, faces [F,3] int64
+    '''
+    with open(load_path, 'rb') as f:
+        content = f.read()
+    header_end = content.index(b'end_header\n') + len(b'end_header\n')
+    offset, scale, n_vert, n_face = None, None, 0, 0
+    for line in content[:header_end].decode('ascii').split('\n'):
+        tokens = line.split()
+        if line.startswith('comment quantize_offset'):
+            offset = np.array([float(t) for t in tokens[2:5]])
+        elif line.startswith('comment quantize_scale'):
+            scale = np.array([float(t) for t in tokens[2:5]])
+        elif line.startswith('element vertex'):
+            n_vert = int(tokens[2])
+        elif line.startswith('element face'):
+            n_face = int(tokens[2])
+    quant = np.frombuffer(content, dtype='<u2', count=n_vert * 3, offset=header_end).reshape(n_vert, 3)
+    face_data = np.frombuffer(content, dtype=[('count', 'u1'), ('index', '<i4', (3,))], count=n_face,
+                              offset=header_end + quant.nbytes)
+    vertices = quant.astype(np.float64) * scale + offset
+    return vertices, face_data['index'].astype(np.int64)
+
+def is_quantized_ply(load_path):
+    with open(load_path, 'rb') as f:
+        head = f.read(512)
+    return b'comment quantize_scale' in head
+
+def write_obj(save_path, vertices, faces):
+    '''
+    ascii obj written with a single formatting pass instead of one write per line.
+    '''
+    vertices = np.asarray(vertices, dtype=np.float64)
+    faces = np.asarray(faces, dtype=np.int64) + 1
+    with open(save_path, 'w') as f:
+        f.write(('v %.6f %.6f %.6f\n' * vertices.shape[0]) % tuple(vertices.ravel()))
+        f.write(('f %d %d %d\n' * faces.shape[0]) % tuple(faces.ravel()))
+
+def export_mesh(mesh, save_path, export_cfg=None):
+    '''
+    export a reconstructed mesh, the file type follows the extension of save_path.
+    :param mesh: trimesh.Trimesh
+    :param save_path: .ply or .obj path
+    :param export_cfg: dict from get_export_config
+    '''
+    if export_cfg is None:
+        export_cfg = dict(default_export_config)
+    mesh = decimate_mesh(mesh, export_cfg['target_faces'])
+    ext = os.path.splitext(save_path)[1].lower()
+    if ext == '.obj':
+        write_obj(save_path, mesh.vertices, mesh.faces)
+    elif ext == '.ply' and export_cfg['quantize']:
+        write_quantized_ply(save_path, mesh.vertices, mesh.faces)
+    elif ext == '.ply':
+        encoding = 'binary' if export_cfg['binary'] else 'ascii'
+        with open(save_path, 'wb') as f:
+            f.write(trimesh.exchange.ply.export_ply(mesh, encoding=encoding))
+    else:
+        mesh.export(save_path)
+    return mesh
+
+def export_mesh_bytes(mesh, export_cfg=None):
+    '''
+    in-memory counterpart of export_mesh for a .ply target, used to stream meshes without touching disk.
+    :return: decimated mesh, ply file content
+    '''
+    if export_cfg is None:
+        export_cfg = dict(default_export_config)
+    mesh = decimate_mesh(mesh, export_cfg['target_faces'])
+    if export_cfg['quantize']:
+        return mesh, quantized_ply_bytes(mesh.vertices, mesh.faces)
+    encoding = 'binary' if export_cfg['binary'] else 'ascii'
+    return mesh, trimesh.exchange.ply.export_ply(mesh, encoding=encoding)
+
+def load_mesh(load_path):
+    '''
+    trimesh.load that also understands quantized ply files.
+    '''
+    if load_path.lower().endswith('.ply') and is_quantized_ply(load_path):
+        vertices, faces = read_quantized_ply(load_path)
+        return trimesh.Trimesh(vertices=vertices, faces=faces, process=False)
+    return trimesh.load(load_path)
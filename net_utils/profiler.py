@@ -0,0 +1,181 @@
+# Per-stage wall time and peak memory instrumentation of the reconstruction path.
+# It is off by default and costs a single attribute check per stage, it is turned on by
+# other.profile in the config or by the INSTPIFU_PROFILE=1 environment variable.
+#
+#   with profiler.stage('query'):
+#       ...
+#
+# Timings synchronize cuda at the stage boundaries while enabled, so the numbers measure the stage rather
+# than the kernel launches.
+import os
+import csv
+import json
+import time
+import threading
+import contextlib
+import numpy as np
+import torch
+
+_null_stage = contextlib.nullcontext()
+
+def current_rss_mb():
+    '''
+    resident memory of the process, 0 where /proc is unavailable.
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+    except (OSError, ValueError):
+        return 0.0
+
+class _Stage(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.peak = 0
+
+    def __enter__(self):
+        self.profiler._enter(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler._exit(self)
+        return False
+
+class StageProfiler(object):
+    def __init__(self):
+        self.enabled = os.environ.get('INSTPIFU_PROFILE', '0') == '1'
+        self.trace = os.environ.get('INSTPIFU_PROFILE_TRACE', '0') == '1'
+        self.records = {}
+        self.events = []
+        self.local = threading.local()
+        self.origin = time.perf_counter()
+
+    def configure(self, config):
+        '''
+        read other.profile and other.profile_trace, the environment variable can only turn profiling on.
+        '''
+        other = config.get('other', {})
+        self.enabled = self.enabled or bool(other.get('profile', False))
+        self.trace = self.trace or bool(other.get('profile_trace', False))
+        return self.enabled
+
+    def reset(self):
+        self.records = {}
+        self.events = []
+        self.origin = time.perf_counter()
+
+    def stage(self, name):
+        if not self.enabled:
+            return _null_stage
+        return _Stage(self, name)
+
+    def iterate(self, iterable, name='data_loading'):
+        '''
+        time every next() of iterable as a stage, a dataloader is returned untouched when disabled.
+        '''
+        if not self.enabled:
+            return iterable
+        return self._iterate(iterable, name)
+
+    def _iterate(self, iterable, name):
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def _stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def _enter(self, stage):
+        stack = self._stack()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+            '''the parent keeps the peak reached so far, since the counter is reset for the child'''
+            if len(stack) > 0:
+                stack[-1].peak = max(stack[-1].peak, torch.cuda.max_memory_allocated())
+            torch.cuda.reset_peak_memory_stats()
+        stack.append(stage)
+        stage.start = time.perf_counter()
+
+    def _exit(self, stage):
+        stack = self._stack()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+            stage.peak = max(stage.peak, torch.cuda.max_memory_allocated())
+        end = time.perf_counter()
+        stack.pop()
+        if len(stack) > 0:
+            stack[-1].peak = max(stack[-1].peak, stage.peak)
+        duration = end - stage.start
+        rss = current_rss_mb()
+        record = self.records.setdefault(stage.name, {'time': [], 'peak_mem_mb': 0.0, 'peak_rss_mb': 0.0})
+        record['time'].append(duration)
+        record['peak_mem_mb'] = max(record['peak_mem_mb'], stage.peak / 1024 ** 2)
+        record['peak_rss_mb'] = max(record['peak_rss_mb'], rss)
+        if self.trace:
+            self.events.append({'name': stage.name, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                                'ts': (stage.start - self.origin) * 1e6, 'dur': duration * 1e6,
+                                'args': {'peak_mem_mb': stage.peak / 1024 ** 2, 'rss_mb': rss}})
+
+    def summary(self):
+        '''
+        :return: dict of stage name to count, total, mean, p50/p90/p99, max (seconds) and peak memory (MB)
+        '''
+        summary = {}
+        for name, record in self.records.items():
+            times = np.array(record['time'])
+            summary[name] = {
+                'count': int(times.shape[0]),
+                'total': float(times.sum()),
+                'mean': float(times.mean()),
+                'p50': float(np.percentile(times, 50)),
+                'p90': float(np.percentile(times, 90)),
+                'p99': float(np.percentile(times, 99)),
+                'max': float(times.max()),
+                'peak_mem_mb': record['peak_mem_mb'],
+                'peak_rss_mb': record['peak_rss_mb'],
+            }
+        return summary
+
+    def dump(self, save_dir, prefix='profile'):
+        '''
+        write <prefix>.json and <prefix>.csv, plus <prefix>_trace.json for chrome://tracing when tracing.
+        :return: list of written files
+        '''
+        if not self.enabled or len(self.records) == 0:
+            return []
+        if not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+        summary = self.summary()
+        saved = [os.path.join(save_dir, prefix + '.json'), os.path.join(save_dir, prefix + '.csv')]
+        with open(saved[0], 'w') as f:
+            json.dump(summary, f, indent=2)
+        fields = ['stage', 'count', 'total', 'mean', 'p50', 'p90', 'p99', 'max', 'peak_mem_mb', 'peak_rss_mb']
+        with open(saved[1], 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            for name in sorted(summary, key=lambda key: -summary[key]['total']):
+                writer.writerow(dict(stage=name, **summary[name]))
+        if self.trace:
+            saved.append(os.path.join(save_dir, prefix + '_trace.json'))
+            with open(saved[-1], 'w') as f:
+                json.dump({'traceEvents': self.events}, f)
+        return saved
+
+    def format_summary(self):
+        lines = ['%-20s %8s %10s %10s %10s %10s %12s' % ('stage', 'count', 'total(s)', 'p50(ms)', 'p90(ms)', 'p99(ms)', 'peak_mem(MB)')]
+        summary = self.summary()
+        for name in sorted(summary, key=lambda key: -summary[key]['total']):
+            item = summary[name]
+            lines.append('%-20s %8d %10.3f %10.2f %10.2f %10.2f %12.1f' % (name, item['count'], item['total'],
+                         item['p50'] * 1e3, item['p90'] * 1e3, item['p99'] * 1e3, item['peak_mem_mb']))
+        return '\n'.join(lines)
+
+profiler = StageProfiler()
@@ -0,0 +1,139 @@
+# Post-training int8 quantization of the point MLPs and global encoders for cpu inference.
+# dynamic: weights in int8, activations quantized on the fly, only Linear layers are supported so the 1x1 Conv1d
+#          of SurfaceClassifier are rewritten as Linear layers over the points.
+# static:  weights and activations in int8 through fx graph mode, activation ranges come from a calibration pass.
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import numpy as np
+from models.instPIFu.SurfaceClassifier import SurfaceClassifier
+
+quantizable_modules = ('surface_classifier', 'global_surface_classifier', 'global_encoder')
+
+class PointwiseLinearClassifier(nn.Module):
+    '''
+    SurfaceClassifier with its 1x1 Conv1d as Linear layers, the input and output layouts are unchanged.
+    '''
+    def __init__(self, classifier):
+        super(PointwiseLinearClassifier, self).__init__()
+        if classifier.num_views > 1:
+            raise NotImplementedError('multi view classifier is not supported')
+        self.no_residual = classifier.no_residual
+        self.last_op = classifier.last_op
+        self.filters = nn.ModuleList()
+        for conv in classifier.filters:
+            linear = nn.Linear(conv.in_channels, conv.out_channels)
+            linear.weight.data.copy_(conv.weight.data[:, :, 0])
+            linear.bias.data.copy_(conv.bias.data)
+            self.filters.append(linear)
+
+    def forward(self, feature):
+        y = feature.transpose(1, 2)
+        tmpy = y
+        for i, f in enumerate(self.filters):
+            y = f(y if (i == 0 or self.no_residual) else torch.cat([y, tmpy], -1))
+            if i != len(self.filters) - 1:
+                y = F.leaky_relu(y)
+        if self.last_op:
+            y = self.last_op(y)
+        return y.transpose(1, 2)
+
+def quantize_module(module, mode, calib_inputs=None, example_input=None):
+    '''
+    :param mode: dynamic or static
+    :param calib_inputs: list of module inputs observed for static quantization
+    :param example_input: input used to trace the module for static quantization
+    :return: quantized module
+    '''
+    module = module.float().cpu().eval()
+    if mode == 'dynamic':
+        if isinstance(module, SurfaceClassifier):
+            module = PointwiseLinearClassifier(module).eval()
+        return torch.ao.quantization.quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8)
+    elif mode == 'static':
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+        qconfig_mapping = get_default_qconfig_mapping(torch.backends.quantized.engine)
+        prepared = prepare_fx(module, qconfig_mapping, example_inputs=(example_input,))
+        with torch.no_grad():
+            for x in calib_inputs or []:
+                prepared(x)
+        return convert_fx(prepared)
+    raise NotImplementedError('unknown quantization mode %s' % (mode))
+
+def collect_calibration_inputs(model, data_batches, marching_cube_resolution, max_points=20000):
+    '''
+    run extract_mesh over the calibration batches and record the inputs of the quantizable modules,
+    the point inputs are subsampled to max_points per call.
+    :return: dict of module name to list of cpu tensors
+    '''
+    calib_inputs = {}
+    handles = []
+    for name in quantizable_modules:
+        if not hasattr(model, name):
+            continue
+        calib_inputs[name] = []
+        def hook(module, inputs, output, name=name):
+            x = inputs[0].detach().float().cpu()
+            if x.dim() == 3 and x.shape[2] > max_points:
+                x = x[:, :, torch.randperm(x.shape[2])[:max_points]]
+            calib_inputs[name].append(x)
+        handles.append(getattr(model, name).register_forward_hook(hook))
+    try:
+        with torch.no_grad():
+            for data_batch in data_batches:
+                model.predict_volumes(data_batch, marching_cube_resolution)
+    finally:
+        for handle in handles:
+            handle.remove()
+    return calib_inputs
+
+def quantize_model(model, mode, calib_inputs=None, example_shapes=None):
+    '''
+    replace the quantizable modules of model in place.
+    :param calib_inputs: from collect_calibration_inputs, required by static quantization to be accurate
+    :param example_shapes: input shapes to trace with when no calibration inputs are given (loading)
+    :return: model, input shapes of the quantized modules
+    '''
+    model = model.float().cpu().eval()
+    shapes = {}
+    for name in quantizable_modules:
+        if not hasattr(model, name):
+            continue
+        if calib_inputs is not None:
+            example_input = calib_inputs[name][0]
+        else:
+            example_input = torch.randn(example_shapes[name])
+        shapes[name] = list(example_input.shape)
+        module_inputs = calib_inputs[name] if calib_inputs is not None else None
+        setattr(model, name, quantize_module(getattr(model, name), mode, module_inputs, example_input))
+    return model, shapes
+
+def save_quantized_model(model, mode, example_shapes, path):
+    torch.save({'net': model.state_dict(), 'quantization': mode, 'example_shapes': example_shapes}, path)
+
+def load_quantized_model(model, path):
+    '''
+    rebuild the quantized structure on a freshly constructed model and load the saved int8 weights.
+    '''
+    checkpoint = torch.load(path, map_location='cpu')
+    model, _ = quantize_model(model, checkpoint['quantization'], example_shapes=checkpoint['example_shapes'])
+    model.load_state_dict(checkpoint['net'])
+    return model.eval()
+
+def occupancy_iou(pred, ref_pred, thresh=0.5):
+    pred_occ = pred > thresh
+    ref_occ = ref_pred > thresh
+    union = (pred_occ | ref_occ).sum().item()
+    return (pred_occ & ref_occ).sum().item() / max(union, 1)
+
+def mesh_chamfer(mesh, ref_mesh, num_points=10000):
+    '''
+    symmetric chamfer distance (mean of squared distances) between surface samples of two meshes.
+    '''
+    from scipy.spatial import cKDTree
+    points = mesh.sample(num_points)
+    ref_points = ref_mesh.sample(num_points)
+    dist1 = cKDTree(ref_points).query(points)[0]
+    dist2 = cKDTree(points).query(ref_points)[0]
+    return np.mean(dist1 ** 2) + np.mean(dist2 ** 2)
@@ -0,0 +1,99 @@
+# Single pass reconstruction of 3D-FRONT scenes. TOTAL3D predicts the layout and the object poses, InstPIFu
+# reconstructs all objects of the scene from the predicted poses in batches and BGPIFu the background.
+# Every network input is built from the same loaded prepare_data sequence and the detection result stays
+# in memory, so nothing is written between the stages and the scene is decoded once.
+import os
+import torch
+from net_utils.train_test_utils import build_inference_model,amp_autocast
+from net_utils.tools import decode_detections,detection_record,total3d_todevice
+from net_utils.mesh_export import export_mesh
+from net_utils.profiler import profiler
+from dataset.front3d_detect_dataset import det_sample,collate_fn
+from dataset.scene_inputs import scene_from_prepare_data,object_inputs,bg_inputs,collate_inputs,\
+    object_mesh_to_camera
+
+class ScenePipeline(object):
+    '''
+    holds the three networks on one device, reconstruct() runs them on a prepare_data sequence.
+    '''
+    def __init__(self,det_config,inst_config,bg_config,device,object_batch=8):
+        '''
+        :param object_batch: maximum number of objects reconstructed together by InstPIFu
+        '''
+        self.det_config=det_config
+        self.inst_config=inst_config
+        self.bg_config=bg_config
+        '''the test configs compare against gt samples in debug mode, which the predicted poses do not have'''
+        self.inst_config['debug']=False
+        self.device=device
+        self.object_batch=object_batch
+        self.det_model=build_inference_model(det_config,device)
+        self.inst_model=build_inference_model(inst_config,device)
+        self.bg_model=build_inference_model(bg_config,device)
+
+    def detect(self,sequence):
+        '''
+        :return: decoded detection result of the scene, the columns written by save_detections
+        '''
+        with profiler.stage('det_inputs'):
+            data_batch=collate_fn([det_sample(sequence,'test')])
+            object_input=total3d_todevice(None,data_batch,self.device)
+        with profiler.stage('detection'), torch.no_grad():
+            est_data,_=self.det_model(object_input)
+        return decode_detections(object_input,est_data)
+
+    def reconstruct_objects(self,scene):
+        '''
+        :param scene: scene description from scene_from_prepare_data
+        :return: list of (obj_id, mesh in camera coordinate)
+        '''
+        results=[]
+        boxes=scene["boxes"]
+        for start in range(0,len(boxes),self.object_batch):
+            box_list=boxes[start:start+self.object_batch]
+            with profiler.stage('object_inputs'):
+                data_batch=collate_inputs([object_inputs(scene["image"],scene["K"],box) for box in box_list])
+                data_batch={key:data_batch[key].to(self.device) for key in data_batch}
+            with torch.no_grad(),amp_autocast(self.inst_config,self.device):
+                mesh_list=self.inst_model.extract_meshes(data_batch,self.inst_config['data']['marching_cube_resolution'])
+            for box,mesh in zip(box_list,mesh_list):
+                mesh=object_mesh_to_camera(mesh,box['rot_matrix'],box['obj_cam_center'],box['bbox_size'])
+                results.append((box['obj_id'],mesh))
+        return results
+
+    def reconstruct_background(self,scene):
+        with profiler.stage('bg_inputs'):
+            data_batch=collate_inputs([bg_inputs(scene["image"],scene["K"],self.bg_config)])
+            data_batch={key:data_batch[key].to(self.device) for key in data_batch}
+        with torch.no_grad(),amp_autocast(self.bg_config,self.device):
+            return self.bg_model.extract_mesh(data_batch,self.bg_config['data']['marching_cube_resolution'])
+
+    def reconstruct(self,sequence,use_pred_pose=True,background=True):
+        '''
+        :param sequence: loaded prepare_data pkl
+        :param use_pred_pose: place the objects with the detected poses, False uses the gt poses of sequence
+        :return: dict with the detection result (None without use_pred_pose), the object meshes and the
+                 background mesh (None without background)
+        '''
+        detection=self.detect(sequence) if use_pred_pose else None
+        scene=scene_from_prepare_data(sequence,detection_record(detection,0) if use_pred_pose else None)
+        return {"detection":detection,
+                "objects":self.reconstruct_objects(scene),
+                "background":self.reconstruct_background(scene) if background else None}
+
+def save_scene(result,taskid,save_dir,export_cfg=None):
+    '''
+    write the meshes of a scene as the testers name them, the objects to objects/<taskid>_<obj_id>.ply
+    (evaluate_object_reconstruction.py) and the background to bg/<taskid>.ply (evaluate_bg.py).
+    :return: list of written files
+    '''
+    saved=[]
+    outputs=[("objects",taskid+"_%s.ply"%(obj_id),mesh) for obj_id,mesh in result["objects"]]
+    if result["background"] is not None:
+        outputs.append(("bg",taskid+".ply",result["background"]))
+    for folder,name,mesh in outputs:
+        save_path=os.path.join(save_dir,folder,name)
+        with profiler.stage('export'):
+            export_mesh(mesh,save_path,export_cfg)
+        saved.append(save_path)
+    return saved
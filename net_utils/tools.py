@@ -11,6 +11,7 @@ and Camera Pose Estimation." Advances in Neural Information Processing Systems.
 
 """
 
+import os
 import numpy as np
 from scipy.spatial import ConvexHull
 import re
@@ -532,113 +533,168 @@ def write_logfile(text, log_file):
     with open(log_file, 'a') as f:  # open and append
         f.write(text + '\n')
 
-def convert_result(data_batch,est_data):
-    split=data_batch["split"]
-    save_dict_list=[]
-    for idx,interval in enumerate(split):
-        sequence_id=data_batch['sequence_id'][idx]
-        length=interval[1]-interval[0]
-        bbox_list=[]
-        gt_bbox_list=[]
-        for i in range(length):
-            # ------------------------------object detection result--------------------------------
-            centroid_cls_result=est_data['centroid_cls_result'][interval[0]+i]
-            centroid_reg_result=est_data['centroid_reg_result'][interval[0]+i]
-            size_reg_result=est_data['size_reg_result'][interval[0]+i].cpu().numpy()
-            size_cls=data_batch['size_cls'][interval[0]+i]
-            ori_cls_result=est_data['ori_cls_result'][interval[0]+i]
-            ori_reg_result=est_data['ori_reg_result'][interval[0]+i]
-            offest2D_result=est_data['offset_2D_result'][interval[0]+i].cpu().numpy()
-            bdb2D=data_batch['bdb2D'][interval[0]+i].cpu().numpy()
-            #print(bdb2D)
-
-            max_centroid_ind=torch.argmax(centroid_cls_result)
-            centroid_reg=centroid_reg_result[max_centroid_ind].cpu().numpy()
-            centroid=np.mean(bin['centroid_bin'][max_centroid_ind])+centroid_reg*DEPTH_WIDTH
-            max_ori_ind=torch.argmax(ori_cls_result)
-            ori_reg=ori_reg_result[max_ori_ind].cpu().numpy()
-            ori=np.mean(bin['ori_bin'][max_ori_ind])+ori_reg*ORI_BIN_WIDTH
-            #print(max_ori_ind, ori_reg,ori)
-            project_center=np.zeros([2])
-            project_center[0]=(bdb2D[2]+bdb2D[0])/2-offest2D_result[0]*(bdb2D[2]-bdb2D[0])
-            project_center[1]=(bdb2D[1]+bdb2D[3])/2-offest2D_result[1]*(bdb2D[3]-bdb2D[1])
-            size_class_ind=torch.where(size_cls>0)[0]
-            size=torch.tensor(bin['avg_size'][size_class_ind])*(1+size_reg_result)
-            bbox_dict={
-                "project_center":project_center,
-                "centroid_depth":centroid,
-                "size":size.cpu().numpy(),
-                "yaw":ori,
-                "bdb2D":bdb2D,
-            }
-            bbox_list.append(bbox_dict)
-
-            # TODO: add ground truth data
-            #-----------------------------------object detection ground truth-----------------
-            centroid_cls = data_batch['centroid_cls'][interval[0] + i].cpu().numpy().astype(np.int32)
-            centroid_reg = data_batch['centroid_reg'][interval[0] + i]
-            size_reg = data_batch['size_reg'][interval[0] + i].cpu().numpy()
-            size_cls = data_batch['size_cls'][interval[0] + i]
-            ori_cls = data_batch['ori_cls'][interval[0] + i].cpu().numpy().astype(np.int32)
-            ori_reg = data_batch['ori_reg'][interval[0] + i]
-            offest2D = data_batch['offset_2D'][interval[0] + i].cpu().numpy()
-            bdb2D = data_batch['bdb2D'][interval[0] + i].cpu().numpy()
-
-            gt_centroid_reg = centroid_reg.cpu().numpy()
-            gt_centroid = np.mean(bin['centroid_bin'][centroid_cls]) + gt_centroid_reg * DEPTH_WIDTH
-            #max_ori_ind = torch.argmax(ori_cls)
-            gt_ori_reg = ori_reg.cpu().numpy()
-            gt_ori = np.mean(bin['ori_bin'][ori_cls]) + gt_ori_reg * ORI_BIN_WIDTH
-            #print(ori_cls,gt_ori_reg,gt_ori)
-            project_center = np.zeros([2])
-            project_center[0] = (bdb2D[2] + bdb2D[0]) / 2 - offest2D[0] * (bdb2D[2] - bdb2D[0])
-            project_center[1] = (bdb2D[1] + bdb2D[3]) / 2 - offest2D[1] * (bdb2D[3] - bdb2D[1])
-            size_class_ind = torch.where(size_cls > 0)[0]
-            size = torch.tensor(bin['avg_size'][size_class_ind])*(1+ size_reg)
-            gt_bbox_dict = {
-                "project_center": project_center,
-                "centroid_depth": gt_centroid,
-                "size": size.cpu().numpy(),
-                "yaw": gt_ori,
-                "bdb2D": bdb2D,
-            }
-            gt_bbox_list.append(gt_bbox_dict)
-
-        #-------------------------------layout estinamtion result----------------------------
-        pitch_cls_result=est_data['pitch_cls_result'][idx]
-        pitch_reg_result=est_data['pitch_reg_result'][idx]
-        max_pitch_ind=torch.argmax(pitch_cls_result)
-        pitch_reg=pitch_reg_result[max_pitch_ind].cpu().numpy()
-        pitch=np.mean(bin['pitch_bin'][max_pitch_ind])+pitch_reg*PITCH_WIDTH
-
-        roll_cls_result = est_data['roll_cls_result'][idx]
-        roll_reg_result = est_data['roll_reg_result'][idx]
-        max_roll_ind = torch.argmax(roll_cls_result)
-        roll_reg = roll_reg_result[max_roll_ind].cpu().numpy()
-        roll = np.mean(bin['roll_bin'][max_roll_ind]) + roll_reg * ROLL_WIDTH
-
-        #------------------------------ground truth layout data-------------------------------
-        gt_pitch=np.mean(bin['pitch_bin'][data_batch['pitch_cls'][idx].cpu().numpy()])+data_batch['pitch_reg'][idx].cpu().numpy()*PITCH_WIDTH
-        gt_roll = np.mean(bin['roll_bin'][data_batch['roll_cls'][idx].cpu().numpy()]) + data_batch['roll_reg'][
-            idx].cpu().numpy() * ROLL_WIDTH
-        lo_centroid=avg_layout['avg_centroid']+est_data['lo_centroid_result'][idx].cpu().numpy()
-        lo_size=avg_layout['avg_size']+est_data['lo_coeffs_result'][idx].cpu().numpy()
-        layout_dict={
-            "pitch":pitch,
-            "roll":roll,
-            "gt_pitch":gt_pitch,
-            "gt_roll":gt_roll,
-            "lo_centroid":lo_centroid,
-            "lo_size":lo_size,
-        }
-        save_dict={
-            "sequence_id":sequence_id,
-            "layout":layout_dict,
-            "bboxes":bbox_list,
-            "gt_bboxes":gt_bbox_list
-        }
-        save_dict_list.append(save_dict)
-    return save_dict_list
+def bin_centers(name, device):
+    '''
+    centers of the bins bin[name] as a float64 tensor.
+    '''
+    return torch.tensor(np.mean(np.asarray(bin[name], dtype=np.float64), axis=1), device=device)
+
+def decode_bin(cls_result, reg_result, name, width):
+    '''
+    center of the highest scoring bin plus its regression, for a batch of predictions.
+    :param cls_result: [N, num_bins] bin scores
+    :param reg_result: [N, num_bins] regression of every bin
+    :return: [N] float64 tensor
+    '''
+    max_ind = torch.argmax(cls_result, dim=1)
+    reg = torch.gather(reg_result, 1, max_ind[:, None])[:, 0].double()
+    return bin_centers(name, reg.device)[max_ind] + reg * width
+
+def decode_gt_bin(cls, reg, name, width):
+    '''
+    :param cls: [N] bin index
+    :param reg: [N] regression of that bin
+    '''
+    return bin_centers(name, reg.device)[cls.long().reshape(-1)] + reg.double().reshape(-1) * width
+
+def project_centers(bdb2D, offset_2D):
+    '''
+    :param bdb2D: [N, 4] x1, y1, x2, y2
+    :param offset_2D: [N, 2] offset of the projected 3D center, relative to the box size
+    :return: [N, 2] projected 3D centers
+    '''
+    bdb2D, offset_2D = bdb2D.double(), offset_2D.double()
+    return (bdb2D[:, 0:2] + bdb2D[:, 2:4]) / 2 - offset_2D * (bdb2D[:, 2:4] - bdb2D[:, 0:2])
+
+'''columns of the decoded detection results and their widths, per object and per image'''
+object_columns = [('project_center', 2), ('centroid_depth', 1), ('size', 3), ('yaw', 1), ('bdb2D', 4),
+                  ('gt_project_center', 2), ('gt_centroid_depth', 1), ('gt_size', 3), ('gt_yaw', 1)]
+image_columns = [('pitch', 1), ('roll', 1), ('gt_pitch', 1), ('gt_roll', 1), ('lo_centroid', 3), ('lo_size', 3),
+                 ('K', 9)]
+
+def decode_detections(data_batch, est_data):
+    '''
+    decode the bins of a TOTAL3D batch into poses for all objects and images at once, the result is copied to
+    the host in a single transfer.
+    :param data_batch: output of total3d_todevice
+    :param est_data: output of TOTAL3D
+    :return: dict of numpy columns, object columns have one row per object, image columns one per image,
+             split holds the object range of every image
+    '''
+    bdb2D = data_batch['bdb2D']
+    device = bdb2D.device
+    avg_size = torch.tensor(bin['avg_size'], dtype=torch.float64, device=device)[torch.argmax(data_batch['size_cls'], dim=1)]
+    objects = {
+        'project_center': project_centers(bdb2D, est_data['offset_2D_result']),
+        'centroid_depth': decode_bin(est_data['centroid_cls_result'], est_data['centroid_reg_result'], 'centroid_bin', DEPTH_WIDTH),
+        'size': avg_size * (1 + est_data['size_reg_result'].double()),
+        'yaw': decode_bin(est_data['ori_cls_result'], est_data['ori_reg_result'], 'ori_bin', ORI_BIN_WIDTH),
+        'bdb2D': bdb2D.double(),
+        'gt_project_center': project_centers(bdb2D, data_batch['offset_2D']),
+        'gt_centroid_depth': decode_gt_bin(data_batch['centroid_cls'], data_batch['centroid_reg'], 'centroid_bin', DEPTH_WIDTH),
+        'gt_size': avg_size * (1 + data_batch['size_reg'].double()),
+        'gt_yaw': decode_gt_bin(data_batch['ori_cls'], data_batch['ori_reg'], 'ori_bin', ORI_BIN_WIDTH),
+    }
+    images = {
+        'pitch': decode_bin(est_data['pitch_cls_result'], est_data['pitch_reg_result'], 'pitch_bin', PITCH_WIDTH),
+        'roll': decode_bin(est_data['roll_cls_result'], est_data['roll_reg_result'], 'roll_bin', ROLL_WIDTH),
+        'gt_pitch': decode_gt_bin(data_batch['pitch_cls'], data_batch['pitch_reg'], 'pitch_bin', PITCH_WIDTH),
+        'gt_roll': decode_gt_bin(data_batch['roll_cls'], data_batch['roll_reg'], 'roll_bin', ROLL_WIDTH),
+        'lo_centroid': torch.tensor(avg_layout['avg_centroid'], dtype=torch.float64, device=device) + est_data['lo_centroid_result'].double(),
+        'lo_size': torch.tensor(avg_layout['avg_size'], dtype=torch.float64, device=device) + est_data['lo_coeffs_result'].double(),
+        'K': data_batch['K'].double(),
+    }
+    object_table = torch.cat([objects[name].reshape(bdb2D.shape[0], width) for name, width in object_columns], dim=1)
+    image_table = torch.cat([images[name].reshape(data_batch['K'].shape[0], width) for name, width in image_columns], dim=1)
+    host = torch.cat([object_table.view(-1), image_table.view(-1)]).cpu().numpy()
+    object_table = host[:object_table.numel()].reshape(object_table.shape)
+    image_table = host[object_table.size:].reshape(image_table.shape)
+
+    results = {'sequence_id': np.asarray([str(sequence_id) for sequence_id in data_batch['sequence_id']]),
+               'split': np.asarray(data_batch['split'].cpu().numpy(), dtype=np.int64)}
+    for table, columns in [(object_table, object_columns), (image_table, image_columns)]:
+        start = 0
+        for name, width in columns:
+            results[name] = table[:, start] if width == 1 else table[:, start:start + width]
+            start += width
+    return results
+
+def detection_record(results, idx):
+    '''
+    the detection result of image idx as the dict of the per image pkl files:
+    sequence_id, layout, bboxes, gt_bboxes and K.
+    '''
+    start, end = results['split'][idx]
+    bbox_list, gt_bbox_list = [], []
+    for i in range(start, end):
+        bbox_list.append({"project_center": results['project_center'][i],
+                          "centroid_depth": results['centroid_depth'][i],
+                          "size": results['size'][i][np.newaxis],
+                          "yaw": results['yaw'][i],
+                          "bdb2D": results['bdb2D'][i]})
+        gt_bbox_list.append({"project_center": results['gt_project_center'][i],
+                             "centroid_depth": results['gt_centroid_depth'][i],
+                             "size": results['gt_size'][i][np.newaxis],
+                             "yaw": results['gt_yaw'][i],
+                             "bdb2D": results['bdb2D'][i]})
+    layout_dict = {key: results[key][idx] for key in ['pitch', 'roll', 'gt_pitch', 'gt_roll', 'lo_centroid', 'lo_size']}
+    return {"sequence_id": results['sequence_id'][idx],
+            "layout": layout_dict,
+            "bboxes": bbox_list,
+            "gt_bboxes": gt_bbox_list,
+            "K": results['K'][idx].reshape(3, 3)}
+
+def convert_result(data_batch, est_data):
+    '''
+    :return: list with the detection_record of every image of the batch
+    '''
+    results = decode_detections(data_batch, est_data)
+    return [detection_record(results, idx) for idx in range(len(results['sequence_id']))]
+
+def save_detections(save_path, results_list):
+    '''
+    write the decoded results of several batches as one columnar npz, split is offset to index the
+    concatenated object rows.
+    '''
+    offset = np.cumsum([0] + [len(results['project_center']) for results in results_list[:-1]])
+    arrays = {name: np.concatenate([results[name] for results in results_list])
+              for name in results_list[0] if name != 'split'}
+    arrays['split'] = np.concatenate([results['split'] - results['split'][0, 0] + start
+                                      for results, start in zip(results_list, offset)])
+    np.savez(save_path, **arrays)
+    return save_path
+
+class DetectionTable(object):
+    '''
+    detection results of a run read from the npz of save_detections.
+    '''
+    def __init__(self, load_path):
+        with np.load(load_path) as content:
+            self.results = {name: content[name] for name in content.files}
+        self.index = {sequence_id: idx for idx, sequence_id in enumerate(self.results['sequence_id'])}
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, sequence_id):
+        return detection_record(self.results, self.index[str(sequence_id)])
+
+detection_tables = {}
+def load_pred_result(pred_pose_path, sequence_id):
+    '''
+    detection result of one image, pred_pose_path is the npz written by Det_tester or a folder of per image pkl files.
+    a folder without <sequence_id>.pkl is read through the detection_results.npz it holds, as Det_tester writes it.
+    '''
+    pkl_path = os.path.join(pred_pose_path, "%s.pkl" % (sequence_id))
+    npz_path = os.path.join(pred_pose_path, "detection_results.npz")
+    if not pred_pose_path.endswith('.npz') and not os.path.exists(pkl_path) and os.path.exists(npz_path):
+        pred_pose_path = npz_path
+    if pred_pose_path.endswith('.npz'):
+        if pred_pose_path not in detection_tables:
+            detection_tables[pred_pose_path] = DetectionTable(pred_pose_path)
+        return detection_tables[pred_pose_path].get(sequence_id)
+    with open(pkl_path, 'rb') as f:
+        return pickle.load(f)
 
 def total3d_todevice(cfg,data,device):
     image = data['image'].to(device)
@@ -653,25 +709,25 @@ def total3d_todevice(cfg,data,device):
     lo_coeffs = data['layout']['coeffs_reg'].float().to(device)
     lo_bdb3D = data['layout']['bdb3D'].float().to(device)
 
-    patch = data['boxes_batch']['patch'].float().cuda()
-    g_features = data['boxes_batch']['g_feature'].float().cuda()
-    size_reg = data['boxes_batch']['size_reg'].float().cuda()
-    size_cls = data['boxes_batch']['size_cls'].float().cuda()
-    ori_reg = data['boxes_batch']['ori_reg'].float().cuda()
-    ori_cls = data['boxes_batch']['ori_cls'].long().cuda()
-    centroid_reg = data['boxes_batch']['centroid_reg'].float().cuda()
-    centroid_cls = data['boxes_batch']['centroid_cls'].long().cuda()
-    offset_2D = data['boxes_batch']['delta_2D'].float().cuda()
-    box_feat = data["boxes_batch"]['box_feat'].float().cuda()
-    bdb2D = data['boxes_batch']['bdb2D_pos'].float().cuda()
-    bdb3D = data['boxes_batch']['bdb3D'].float().cuda()
-    #yaw=data["boxes_batch"]["yaw"].float().cuda()
-    #gt_yaw=data["boxes_batch"]["yaw"].float().cuda()
+    patch = data['boxes_batch']['patch'].float().to(device)
+    g_features = data['boxes_batch']['g_feature'].float().to(device)
+    size_reg = data['boxes_batch']['size_reg'].float().to(device)
+    size_cls = data['boxes_batch']['size_cls'].float().to(device)
+    ori_reg = data['boxes_batch']['ori_reg'].float().to(device)
+    ori_cls = data['boxes_batch']['ori_cls'].long().to(device)
+    centroid_reg = data['boxes_batch']['centroid_reg'].float().to(device)
+    centroid_cls = data['boxes_batch']['centroid_cls'].long().to(device)
+    offset_2D = data['boxes_batch']['delta_2D'].float().to(device)
+    box_feat = data["boxes_batch"]['box_feat'].float().to(device)
+    bdb2D = data['boxes_batch']['bdb2D_pos'].float().to(device)
+    bdb3D = data['boxes_batch']['bdb3D'].float().to(device)
+    #yaw=data["boxes_batch"]["yaw"].float().to(device)
+    #gt_yaw=data["boxes_batch"]["yaw"].float().to(device)
     split = data['obj_split']
     # split of relational pairs for batch learning.
     rel_pair_counts = torch.cat([torch.tensor([0]), torch.cumsum(
         torch.pow(data['obj_split'][:, 1] - data['obj_split'][:, 0], 2), 0)], 0)
-    K = data['camera']["K"].float().cuda()
+    K = data['camera']["K"].float().to(device)
     camera_input = {
         "K": K
     }
@@ -1,8 +1,12 @@
 import torch
 import numpy as np
 import os
+import glob
 import urllib
+import threading
 import torch.nn as nn
+from net_utils.distributed import is_distributed, is_main_process, get_local_rank
+from net_utils.init_net import build_on_meta,load_meta_state_dict,check_materialized
 
 def read_obj_point(obj_path):
     with open(obj_path, 'r') as f:
@@ -21,6 +25,23 @@ def write_obj_point(points,obj_path):
             f.write(write_line)
     return
 
+def load_checkpoint_file(fpath):
+    '''
+    torch.load onto the cpu, memory-mapping the file when the installed torch supports it
+    so tensors are only read when they are copied into the network.
+    '''
+    try:
+        return torch.load(fpath, map_location='cpu', mmap=True)
+    except (TypeError, RuntimeError):
+        # older torch without mmap, or a checkpoint saved in the legacy (non-zip) format
+        return torch.load(fpath, map_location='cpu')
+
+def strip_module_prefix(state_dict):
+    '''
+    remove the module. prefix added by DataParallel/DistributedDataParallel.
+    '''
+    return {(k[7:] if k.startswith('module.') else k): v for k, v in state_dict.items()}
+
 def load_checkpoint(fpath, model):
     ckpt = torch.load(fpath, map_location='cpu')
 
@@ -54,6 +75,39 @@ def load_checkpoint(fpath, model):
     model.load_state_dict(modified,strict=False)
     return model
 
+def state_to_cpu(state):
+    '''
+    copy every tensor of a (nested) state dict to cpu, so that it can be serialized
+    while training keeps updating the originals.
+    '''
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    elif isinstance(state, dict):
+        cpu_state = type(state)((k, state_to_cpu(v)) for k, v in state.items())
+        if hasattr(state, '_metadata'):
+            # module versions used by load_state_dict
+            cpu_state._metadata = state._metadata
+        return cpu_state
+    elif isinstance(state, (list, tuple)):
+        return type(state)(state_to_cpu(v) for v in state)
+    return state
+
+def atomic_torch_save(obj, path):
+    '''
+    write to a temporary file, fsync it and rename it over path, so path is never left half written.
+    '''
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
 def worker_init_fn(worker_id):
     random_data = os.urandom(4)
     base_seed = int.from_bytes(random_data, byteorder="big")
@@ -62,7 +116,12 @@ def worker_init_fn(worker_id):
 class CheckpointIO(object):
     '''
     load, save, resume network weights.
+    network weights and scalars are saved in model_<suffix>.pth, optimizer/scheduler states in
+    model_<suffix>_opt.pth, so loading only the weights does not read the optimizer state.
     '''
+    # entries stored in the optimizer file
+    optimizer_keys = ('opt', 'sch', 'scaler')
+
     def __init__(self, cfg, **kwargs):
         '''
         initialize model and optimizer.
@@ -73,6 +132,11 @@ class CheckpointIO(object):
         self._module_dict = kwargs
         self._module_dict.update({'epoch': 0, 'min_loss': 1e8})
         self._saved_filename = 'model_last.pth'
+        other = cfg.config.get('other') or {}
+        self.async_save = other.get('async_checkpoint', True)
+        self.keep_checkpoints = other.get('keep_checkpoints', 0)
+        self._writer = None
+        self._writer_error = None
 
     @property
     def module_dict(self):
@@ -98,22 +162,77 @@ class CheckpointIO(object):
     def save(self, suffix=None, **kwargs):
         '''
         save the current module dictionary.
+        the states are copied to cpu right away and written by a background thread,
+        with other.keep_checkpoints > 0 a copy per epoch is kept and only the newest ones survive.
         :param kwargs:
         :return:
         '''
+        if not is_main_process():
+            return
+        # only one write in flight, this also surfaces errors of the previous write
+        self.wait()
+
         outdict = kwargs
         for k, v in self._module_dict.items():
             if hasattr(v, 'state_dict'):
-                outdict[k] = v.state_dict()
+                outdict[k] = state_to_cpu(v.state_dict())
             else:
                 outdict[k] = v
+        net_dict = {k: v for k, v in outdict.items() if k not in self.optimizer_keys}
+        opt_dict = {k: v for k, v in outdict.items() if k in self.optimizer_keys}
 
         if not suffix:
             filename = self.saved_filename
         else:
             filename = self.saved_filename.replace('last', suffix)
+        filenames = [filename]
+        if self.keep_checkpoints > 0:
+            filenames.append(self.saved_filename.replace('last', 'epoch%04d' % (outdict['epoch'])))
 
-        torch.save(outdict, os.path.join(self.cfg.config['log']['path'], filename))
+        if self.async_save:
+            self._writer = threading.Thread(target=self._write, args=(filenames, net_dict, opt_dict))
+            self._writer.start()
+        else:
+            self._write(filenames, net_dict, opt_dict)
+            self.wait()
+
+    def _write(self, filenames, net_dict, opt_dict):
+        try:
+            save_dir = self.cfg.config['log']['path']
+            for filename in filenames:
+                atomic_torch_save(net_dict, os.path.join(save_dir, filename))
+                if opt_dict:
+                    atomic_torch_save(opt_dict, os.path.join(save_dir, self.opt_filename(filename)))
+            if self.keep_checkpoints > 0:
+                self.remove_old_checkpoints(save_dir)
+        except Exception as e:
+            self._writer_error = e
+
+    def wait(self):
+        '''
+        block until the pending checkpoint is on disk.
+        '''
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+        if self._writer_error is not None:
+            error, self._writer_error = self._writer_error, None
+            raise error
+
+    @staticmethod
+    def opt_filename(filename):
+        return filename[:-len('.pth')] + '_opt.pth'
+
+    def remove_old_checkpoints(self, save_dir):
+        '''
+        keep the newest keep_checkpoints per-epoch checkpoints, best and latest are never removed.
+        '''
+        pattern = os.path.join(save_dir, self.saved_filename.replace('last', 'epoch[0-9]*'))
+        epoch_files = sorted(f for f in glob.glob(pattern) if not f.endswith('_opt.pth'))
+        for old_file in epoch_files[:-self.keep_checkpoints]:
+            for path in [old_file, self.opt_filename(old_file)]:
+                if os.path.exists(path):
+                    os.remove(path)
 
     def load(self, filename, *domain):
         '''
@@ -189,7 +308,11 @@ class CheckpointIO(object):
 
         if os.path.exists(filename):
             self.cfg.log_string('Loading checkpoint from %s.' % (filename))
-            checkpoint = torch.load(filename)
+            checkpoint = load_checkpoint_file(filename)
+            # optimizer states live next to the weights, they are only needed for a full resume
+            opt_file = self.opt_filename(filename) if filename.endswith('.pth') else None
+            if not domain and opt_file is not None and os.path.exists(opt_file):
+                checkpoint.update(load_checkpoint_file(opt_file))
             if "LDIF" in filename:
                 new_checkpoint={"net":{}}
                 for k,v in checkpoint["net"].items():
@@ -312,7 +435,10 @@ def get_optimizer(config, net):
 
 def load_scheduler(config,optimizer,train_loader):
     if config["scheduler"]["type"]=="OneCycleLR":
-        scheduler = torch.optim.lr_scheduler.OneCycleLR(optimizer, config["optimizer"]["lr"], epochs=config["other"]["nepoch"], steps_per_epoch=len(train_loader),
+        '''OneCycleLR is stepped once per optimizer step, which happens every accumulation_steps batches'''
+        accumulation_steps = config["other"].get("accumulation_steps", 1)
+        steps_per_epoch = (len(train_loader) + accumulation_steps - 1) // accumulation_steps
+        scheduler = torch.optim.lr_scheduler.OneCycleLR(optimizer, config["optimizer"]["lr"], epochs=config["other"]["nepoch"], steps_per_epoch=steps_per_epoch,
                                                   cycle_momentum=True,
                                                   base_momentum=0.85, max_momentum=0.95, last_epoch=config["scheduler"]['last_epoch'],
                                                   div_factor=config["scheduler"]['div_factor'],
@@ -335,11 +461,56 @@ def load_device(cfg):
     if cfg.config['device']['use_gpu'] and torch.cuda.is_available():
         cfg.log_string('GPU mode is on.')
         cfg.log_string('GPU Ids: %s used.' % (cfg.config['device']['gpu_ids']))
+        if is_distributed():
+            return torch.device("cuda", get_local_rank())
         return torch.device("cuda")
     else:
         cfg.log_string('CPU mode is on.')
         return torch.device("cpu")
 
+def use_amp(config):
+    return config['device'].get('use_amp', False)
+
+def get_amp_dtype(device):
+    '''
+    fp16 on cuda, bf16 on cpu (cpu autocast does not support fp16).
+    '''
+    return torch.float16 if device.type == 'cuda' else torch.bfloat16
+
+def amp_autocast(config, device):
+    '''
+    autocast context for the network forward, a no-op when device/use_amp is off.
+    losses and the occupancy threshold are cast back to fp32 inside the networks.
+    '''
+    return torch.autocast(device_type=device.type, dtype=get_amp_dtype(device), enabled=use_amp(config))
+
+def get_grad_scaler(config, device):
+    '''
+    loss scaling is only needed for fp16, bf16 keeps the fp32 exponent range.
+    '''
+    enabled = use_amp(config) and get_amp_dtype(device) == torch.float16
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+def amp_parity_check(model, data_batch, config, device):
+    '''
+    run the same batch in fp32 and under autocast and compare the outputs.
+    :return: dict with the max/mean abs difference of pred_class, the fp32 and amp losses
+    '''
+    was_training = model.training
+    model.eval()
+    with torch.no_grad():
+        est_fp32, loss_fp32 = model(data_batch)
+        with torch.autocast(device_type=device.type, dtype=get_amp_dtype(device)):
+            est_amp, loss_amp = model(data_batch)
+    model.train(was_training)
+    diff = torch.abs(est_fp32['pred_class'].float() - est_amp['pred_class'].float())
+    return {
+        'max_abs_diff': diff.max().item(),
+        'mean_abs_diff': diff.mean().item(),
+        'loss_fp32': torch.mean(loss_fp32['loss']).item(),
+        'loss_amp': torch.mean(loss_amp['loss']).item(),
+    }
+
 def get_model(cfg,device):
     #print("CFG line 345 in train_test_utils", cfg)
     #print("CFG method line 346 in train_test_utils", cfg['method'])
@@ -356,6 +527,46 @@ def get_model(cfg,device):
         raise NotImplementedError
     return model
 
+def build_inference_model(cfg,device):
+    '''
+    construct the network of cfg['method'] on the meta device and assign it the net weights of cfg['weight'].
+    model.runtime set to torchscript or onnx loads the graphs exported to model.export_dir instead (cpu only),
+    model.use_quantized loads the int8 model written to quantization.weight by --mode quantize (cpu only).
+    :return: model in eval mode
+    '''
+    runtime=cfg['model'].get('runtime','eager')
+    if runtime!='eager':
+        from net_utils.graph_export import load_exported_model
+        return load_exported_model(cfg,cfg['model'].get('export_dir','./checkpoints/exported'),runtime)
+    if cfg['method']=="instPIFu":
+        from models.instPIFu.InstPIFu_net import InstPIFu
+        build_fn=lambda:InstPIFu(cfg)
+    elif cfg['method']=="bgPIFu":
+        from models.bg_PIFu.BGPIFu_net import BGPIFu_Net
+        build_fn=lambda:BGPIFu_Net(cfg)
+    elif cfg['method']=="det":
+        from models.detection.network import TOTAL3D
+        build_fn=lambda:TOTAL3D(cfg)
+    else:
+        raise NotImplementedError
+    if cfg['model'].get('use_quantized',False):
+        '''quantize_model rebuilds the layers from real tensors, the int8 weights are loaded afterwards'''
+        from net_utils.quantization import load_quantized_model
+        return load_quantized_model(build_fn(),cfg['quantization']['weight'])
+    model=build_on_meta(build_fn)
+    if cfg['method']=="det":
+        '''the detection weights may be split over several files, as loaded by Det_tester'''
+        weight_paths=cfg['weight'] if isinstance(cfg['weight'],list) else [cfg['weight']]
+        for weight_path in weight_paths:
+            state_dict=strip_module_prefix(load_checkpoint_file(weight_path)['net'])
+            if "LDIF" in weight_path:
+                state_dict={"mesh_reconstruction."+k:v for k,v in state_dict.items()}
+            load_meta_state_dict(model,state_dict)
+        return check_materialized(model).to(device).eval()
+    checkpoint=load_checkpoint_file(cfg['weight'])
+    load_meta_state_dict(model,strip_module_prefix(checkpoint['net']))
+    return check_materialized(model).to(device).eval()
+
 def get_dataloader(cfg,mode):
     if cfg['data']['dataset']=="front3d_recon":
         from dataset.front3d_recon_dataset import Front3D_Recon_dataloader
@@ -371,8 +582,38 @@ def get_dataloader(cfg,mode):
         dataloader=Pix3D_Recon_dataloader(cfg,mode)
     else:
         raise NotImplementedError
+    if is_distributed():
+        dataloader = distributed_dataloader(dataloader, shuffle=(mode == 'train'))
     return dataloader
 
+def distributed_dataloader(dataloader, shuffle):
+    '''
+    rebuild a dataloader around a DistributedSampler so that every process reads its own shard.
+    batch_size stays the per-process batch size.
+    '''
+    from net_utils.loader_tuning import rebuild_loader,loader_settings
+    sampler = torch.utils.data.DistributedSampler(dataloader.dataset, shuffle=shuffle)
+    return rebuild_loader(dataloader, loader_settings(dataloader), sampler=sampler)
+
+def apply_loader_tuning(cfg,device):
+    '''
+    replace the loader settings of the data section with the ones measured on this machine (data.auto_tune_loader).
+    The measurement runs once on the main process with the loader_tuning block and is cached per dataset, batch size,
+    host and core count, data.loader_tuning_file points to a fixed result instead.
+    '''
+    from net_utils.loader_tuning import tune_loader,save_tuning,load_tuning,tuning_cache_path
+    from net_utils.distributed import barrier
+    config=cfg.config
+    path=config['data'].get('loader_tuning_file') or tuning_cache_path(config)
+    if is_main_process() and not os.path.isfile(path):
+        cfg.log_string('Measuring data loader settings on this machine, cached to %s.'%(path))
+        settings,records=tune_loader(get_dataloader(config,mode='train'),config.get('loader_tuning',{}),device,cfg.log_string)
+        save_tuning(path,settings,records)
+    barrier()
+    tuned=load_tuning(path)
+    cfg.update_config(data=tuned['data'])
+    cfg.log_string('Data loader settings from %s: %s'%(path,tuned['data']))
+
 def get_trainer(config):
     if config["method"]=="instPIFu" or config['method']=="bgPIFu":
         from training import Recon_trainer
@@ -17,6 +17,7 @@ from configs.data_config import Relation_Config, NYU40CLASSES, NYU37_TO_PIX3D_CL
 rel_cfg = Relation_Config()
 d_model = int(rel_cfg.d_g/4)
 from models.total3d.dataloader import collate_fn
+from dataset.relation_features import g_features
 
 HEIGHT_PATCH = 256
 WIDTH_PATCH = 256
@@ -35,25 +36,6 @@ def parse_detections(detections):
         size_cls.append(NYU40CLASSES.index(det['class']))
     return bdb2D_pos, size_cls
 
-def get_g_features(bdb2D_pos):
-    n_objects = len(bdb2D_pos)
-    g_feature = [[((loc2[0] + loc2[2]) / 2. - (loc1[0] + loc1[2]) / 2.) / (loc1[2] - loc1[0]),
-                  ((loc2[1] + loc2[3]) / 2. - (loc1[1] + loc1[3]) / 2.) / (loc1[3] - loc1[1]),
-                  math.log((loc2[2] - loc2[0]) / (loc1[2] - loc1[0])),
-                  math.log((loc2[3] - loc2[1]) / (loc1[3] - loc1[1]))] \
-                 for id1, loc1 in enumerate(bdb2D_pos)
-                 for id2, loc2 in enumerate(bdb2D_pos)]
-
-    locs = [num for loc in g_feature for num in loc]
-
-    pe = torch.zeros(len(locs), d_model)
-    position = torch.from_numpy(np.array(locs)).unsqueeze(1).float()
-    div_term = torch.exp(torch.arange(0, d_model, 2).float() * -(math.log(10000.) / d_model))
-    pe[:, 0::2] = torch.sin(position * div_term)
-    pe[:, 1::2] = torch.cos(position * div_term)
-
-    return pe.view(n_objects * n_objects, rel_cfg.d_g)
-
 def load_demo_data(demo_path, device):
     img_path = os.path.join(demo_path, 'img.jpg')
     assert os.path.exists(img_path)
@@ -74,7 +56,7 @@ def load_demo_data(demo_path, device):
     bdb2D_pos, size_cls = parse_detections(detections)
 
     # obtain geometric features
-    boxes['g_feature'] = get_g_features(bdb2D_pos)
+    boxes['g_feature'] = g_features(bdb2D_pos)
 
     # encode class
     cls_codes = torch.zeros([len(size_cls), len(NYU40CLASSES)])
@@ -0,0 +1,77 @@
+import os
+import copy
+import time
+import numpy as np
+import torch
+from net_utils.train_test_utils import build_inference_model,get_dataloader
+from net_utils.quantization import collect_calibration_inputs,quantize_model,save_quantized_model,\
+    occupancy_iou,mesh_chamfer
+
+def extract_with_volume(model,data_batch,marching_cube_resolution):
+    '''
+    :return: occupancy volume of the first sample, its mesh, seconds spent
+    '''
+    start_t=time.time()
+    with torch.no_grad():
+        pred=model.predict_volumes(data_batch,marching_cube_resolution)
+    elapsed=time.time()-start_t
+    if hasattr(model,'meshes_from_pred'):
+        mesh=model.meshes_from_pred(pred,marching_cube_resolution)[0]
+    else:
+        height,width=data_batch["image"].shape[2:4]
+        mesh=model.mesh_from_volume(pred,data_batch["intrinsic"],height,width,marching_cube_resolution)
+    return pred[0],mesh,elapsed
+
+def run(cfg):
+    config=copy.deepcopy(cfg.config)
+    config['model']['runtime']='eager'
+    config['model']['use_quantized']=False
+    '''the debug accuracy check needs the intermediate predictions of query, which are not quantized'''
+    config['debug']=False
+    quant_config=config['quantization']
+    device=torch.device('cpu')
+
+    '''Load net'''
+    cfg.log_string('Loading fp32 model.')
+    net=build_inference_model(config,device)
+
+    '''Load data, the first batches calibrate and the next ones are held out for evaluation'''
+    cfg.log_string('Loading dataset.')
+    loader=get_dataloader(config,mode='test')
+    calib_list,eval_list=[],[]
+    for data_batch in loader:
+        for key in data_batch:
+            if isinstance(data_batch[key], list) == False:
+                data_batch[key] = data_batch[key].float()
+        if len(calib_list)<quant_config['calib_batches']:
+            calib_list.append(data_batch)
+        elif len(eval_list)<quant_config['eval_batches']:
+            eval_list.append(data_batch)
+        else:
+            break
+
+    cfg.log_string('Calibrating on %d batches.'%(len(calib_list)))
+    calib_inputs=collect_calibration_inputs(net,calib_list,quant_config['calib_resolution'])
+    quant_net,example_shapes=quantize_model(copy.deepcopy(net),quant_config['mode'],calib_inputs)
+    save_dir=os.path.dirname(quant_config['weight'])
+    if save_dir and os.path.exists(save_dir)==False:
+        os.makedirs(save_dir)
+    save_quantized_model(quant_net,quant_config['mode'],example_shapes,quant_config['weight'])
+    cfg.log_string('%s int8 model saved to %s'%(quant_config['mode'],quant_config['weight']))
+
+    '''Compare against fp32 on the held out batches'''
+    resolution=config['data']['marching_cube_resolution']
+    iou_list,cd_list,fp32_time,int8_time=[],[],0,0
+    for batch_id,data_batch in enumerate(eval_list):
+        ref_pred,ref_mesh,ref_t=extract_with_volume(net,data_batch,resolution)
+        pred,mesh,quant_t=extract_with_volume(quant_net,data_batch,resolution)
+        iou_list.append(occupancy_iou(pred,ref_pred))
+        cd_list.append(mesh_chamfer(mesh,ref_mesh))
+        fp32_time+=ref_t
+        int8_time+=quant_t
+        cfg.log_string('[%d/%d] iou %f, chamfer %f, fp32 %.2fs, int8 %.2fs'%(batch_id+1,len(eval_list),
+                                                                             iou_list[-1],cd_list[-1],ref_t,quant_t))
+    if len(eval_list)>0:
+        cfg.log_string('mean iou %f, mean chamfer %f, speedup %.2fx'%(np.mean(iou_list),np.mean(cd_list),
+                                                                      fp32_time/max(int8_time,1e-6)))
+    cfg.log_string('Quantization finished.')
@@ -0,0 +1,63 @@
+import os
+import glob
+import time
+import datetime
+import pickle
+import yaml
+from net_utils.train_test_utils import load_device
+from net_utils.mesh_export import get_export_config
+from net_utils.profiler import profiler
+from net_utils.scene_pipeline import ScenePipeline,save_scene
+from net_utils.tools import save_detections
+
+def load_yaml(path):
+    with open(path, 'r') as f:
+        return yaml.load(f, Loader=yaml.FullLoader)
+
+def run(cfg):
+    config=cfg.config
+    scene_cfg=config['scene']
+    device=load_device(cfg)
+
+    '''Load the networks of the three stages'''
+    cfg.log_string('Loading models.')
+    det_config=load_yaml(scene_cfg['configs']['det'])
+    det_config['mode']='test'
+    det_config['model']['pretrained_resnet']=False #every weight comes from the checkpoint
+    inst_config=load_yaml(scene_cfg['configs']['instPIFu'])
+    bg_config=load_yaml(scene_cfg['configs']['bgPIFu'])
+    pipeline=ScenePipeline(det_config,inst_config,bg_config,device,scene_cfg.get('object_batch',8))
+
+    '''Scenes to reconstruct'''
+    data_dir=os.path.join(config['data']['data_path'],config['data'].get('split','test'))
+    testids=config['data'].get('testids') or sorted(os.path.splitext(os.path.basename(path))[0]
+                                                    for path in glob.glob(os.path.join(data_dir,'*.pkl')))
+    for folder in ['objects','bg']:
+        if not os.path.exists(os.path.join(cfg.save_path,folder)):
+            os.makedirs(os.path.join(cfg.save_path,folder))
+    export_cfg=get_export_config(inst_config)
+    if profiler.configure(config):
+        profiler.reset()
+
+    cfg.log_string('Reconstructing %d scenes.'%(len(testids)))
+    start_t=time.time()
+    detections=[]
+    for scene_id,testid in enumerate(testids):
+        with profiler.stage('load_scene'):
+            with open(os.path.join(data_dir,testid+'.pkl'),'rb') as f:
+                sequence=pickle.load(f)
+        result=pipeline.reconstruct(sequence,scene_cfg.get('use_pred_pose',True),scene_cfg.get('background',True))
+        saved=save_scene(result,testid,cfg.save_path,export_cfg)
+        if result["detection"] is not None:
+            detections.append(result["detection"])
+        cfg.log_string("{:0>8},[{}/{}] {}, {} objects, {} files written".format(
+            str(datetime.timedelta(seconds=round(time.time()-start_t))),
+            scene_id+1,len(testids),testid,len(result["objects"]),len(saved)))
+    if len(detections)>0:
+        '''one columnar file for the run, pred_pose_path of test_instPIFu.yaml can point to it'''
+        save_path=save_detections(os.path.join(cfg.save_path,"detection_results.npz"),detections)
+        cfg.log_string("detection results written to %s"%(save_path))
+    for path in profiler.dump(cfg.save_path):
+        cfg.log_string("profile written to %s"%(path))
+    if profiler.enabled:
+        cfg.log_string(profiler.format_summary())
@@ -0,0 +1,29 @@
+import torch
+import argparse
+from configs.config_utils import CONFIG
+from net_utils.inference_server import InferenceEngine,serve
+from net_utils.mesh_export import get_export_config
+from net_utils.train_test_utils import load_device
+
+def parse_args():
+    '''PARAMETERS'''
+    parser = argparse.ArgumentParser('InstPIFu reconstruction service')
+    parser.add_argument('--inst_config', type=str, default='./configs/test_instPIFu.yaml', help='InstPIFu config, provides the weight to load')
+    parser.add_argument('--bg_config', type=str, default='./configs/test_bg_PIFu.yaml', help='BGPIFu config, provides the weight to load')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8008, help='port to listen on')
+    parser.add_argument('--socket', type=str, default=None, help='serve over this unix socket instead of tcp')
+    parser.add_argument('--max_batch', type=int, default=4, help='maximum number of objects reconstructed together')
+    parser.add_argument('--max_wait', type=float, default=0.05, help='seconds to wait for more objects before running a batch')
+    parser.add_argument('--device', type=str, default=None, help='cuda or cpu, by default cuda if device.use_gpu is set in the InstPIFu config and available')
+    return parser.parse_args()
+
+if __name__=="__main__":
+    args=parse_args()
+    inst_cfg=CONFIG(args.inst_config)
+    instPIFu_config=inst_cfg.config
+    bg_config=CONFIG(args.bg_config).config
+    instPIFu_config['data']['use_pred_pose']=True #to use predict pose or not for testid requests
+    device=torch.device(args.device) if args.device is not None else load_device(inst_cfg)
+    engine=InferenceEngine(instPIFu_config,bg_config,device,max_batch=args.max_batch,max_wait=args.max_wait)
+    serve(engine,get_export_config(instPIFu_config),host=args.host,port=args.port,socket_path=args.socket)
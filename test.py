@@ -18,7 +18,7 @@ def run(cfg):
 
     '''Load net'''
     cfg.log_string('Loading model.')
-    net = get_model(cfg.config, device=device).cuda().float()
+    net = get_model(cfg.config, device=device).float()
     checkpoint.register_modules(net=net)
 
     '''Load tester'''
@@ -4,6 +4,9 @@ import datetime
 import time
 import pickle
 import numpy as np
+from net_utils.mesh_export import get_export_config,export_mesh
+from net_utils.train_test_utils import amp_autocast
+from net_utils.profiler import profiler
 
 def Recon_tester(cfg,model,loader,device,checkpoint):
     start_t = time.time()
@@ -16,12 +19,16 @@ def Recon_tester(cfg,model,loader,device,checkpoint):
     if config['resume'] == True:
         print("loading from",config['weight'])
         checkpoint.load(config['weight'])
+    export_cfg=get_export_config(config)
+    if profiler.configure(config):
+        profiler.reset()
     model.eval()
-    for batch_id, data_batch in enumerate(loader):
-        for key in data_batch:
-            if isinstance(data_batch[key], list) == False:
-                data_batch[key] = data_batch[key].float().cuda()
-        with torch.no_grad():
+    for batch_id, data_batch in enumerate(profiler.iterate(loader)):
+        with profiler.stage('host_to_device'):
+            for key in data_batch:
+                if isinstance(data_batch[key], list) == False:
+                    data_batch[key] = data_batch[key].float().to(device)
+        with torch.no_grad(), amp_autocast(config, device):
             #print(data_batch['sequence_id'])
             mesh=model.extract_mesh(data_batch,config['data']['marching_cube_resolution'])
             if config['other']['scale_back']:
@@ -43,16 +50,22 @@ def Recon_tester(cfg,model,loader,device,checkpoint):
             m_save_path=os.path.join(log_dir,taskid+"_"+str(object_id)+".ply")
             #print(m_save_path,data_batch['jid'][0])
             print("saving to %s"%(m_save_path))
-            mesh.export(m_save_path)
+            with profiler.stage('export'):
+                export_mesh(mesh,m_save_path,export_cfg)
         elif config['method']=="bgPIFu":
             taskid = data_batch['taskid'][0]
             m_save_path = os.path.join(log_dir, taskid + ".ply")
             print("saving to %s" % (m_save_path))
-            mesh.export(m_save_path)
+            with profiler.stage('export'):
+                export_mesh(mesh,m_save_path,export_cfg)
+    for path in profiler.dump(log_dir):
+        cfg.log_string("profile written to %s" % (path))
+    if profiler.enabled:
+        cfg.log_string(profiler.format_summary())
 
 
 def Det_tester(cfg,model,loader,device,checkpoint):
-    from net_utils.tools import convert_result,total3d_todevice
+    from net_utils.tools import decode_detections,detection_record,save_detections,total3d_todevice
     start_t=time.time()
     config = cfg.config
     log_dir = os.path.join(config['other']["model_save_dir"], config['exp_name'])
@@ -64,6 +77,7 @@ def Det_tester(cfg,model,loader,device,checkpoint):
         if isinstance(config['weight'],list):
             for weight_path in config["weight"]:
                 checkpoint.load(weight_path)
+    results_list=[]
     for batch_id, data_batch in enumerate(loader):
         with torch.no_grad():
             object_input=total3d_todevice(cfg,data_batch,device)
@@ -75,16 +89,14 @@ def Det_tester(cfg,model,loader,device,checkpoint):
             len(loader),
         )
         print(msg)
-        K=object_input["K"]
-        patch_size=object_input['patch'].shape[0]
-        obj_split=object_input['split'].long()
-        K_array = torch.zeros((patch_size, 3, 3)).to(object_input['patch'].device)
-        for idx, (start, end) in enumerate(obj_split.long()):
-            K_array[start:end] = K[idx:idx + 1]
-        save_dict_list=convert_result(object_input,est_data)
-        for idx,item in enumerate(save_dict_list):
-            sequence_id=item['sequence_id']
-            item['K']=K_array[idx].cpu().numpy()
-            save_path=os.path.join(log_dir,sequence_id+".pkl")
-            with open(save_path,'wb') as f:
-                pickle.dump(item,f)
+        results_list.append(decode_detections(object_input,est_data))
+    if config['other'].get('det_output','npz')=='pkl':
+        '''one pkl per image, as read by a pred_pose_path folder'''
+        for results in results_list:
+            for idx in range(len(results['sequence_id'])):
+                item=detection_record(results,idx)
+                with open(os.path.join(log_dir,item['sequence_id']+".pkl"),'wb') as f:
+                    pickle.dump(item,f)
+    elif len(results_list)>0:
+        save_path=save_detections(os.path.join(log_dir,"detection_results.npz"),results_list)
+        cfg.log_string("detection results written to %s"%(save_path))
@@ -1,6 +1,7 @@
 from net_utils.train_test_utils import load_device, get_model, \
-    get_dataloader,CheckpointIO,get_trainer,get_optimizer,load_scheduler
+    get_dataloader,CheckpointIO,get_trainer,get_optimizer,load_scheduler,apply_loader_tuning
 import torch.nn as nn
+from net_utils.distributed import is_distributed
 
 def run(cfg):
 
@@ -13,21 +14,27 @@ def run(cfg):
     device = load_device(cfg)
 
     '''Load data'''
+    if cfg.config['data'].get('auto_tune_loader',False):
+        apply_loader_tuning(cfg,device)
     cfg.log_string('Loading dataset.')
     train_loader = get_dataloader(cfg.config, mode='train')
     test_loader = get_dataloader(cfg.config, mode='test')
 
     '''Load net'''
     cfg.log_string('Loading model.')
-    net = get_model(cfg.config, device=device).cuda().float()
+    net = get_model(cfg.config, device=device).float()
     checkpoint.register_modules(net=net)
 
     '''Load optimizer'''
     cfg.log_string('Loading optimizer.')
     optimizer = get_optimizer(config=cfg.config, net=net)
-    # model, optimizer = amp.initialize(net, optimizer, opt_level="O1")
     checkpoint.register_modules(opt=optimizer)
-    net = nn.DataParallel(net)
+    if is_distributed():
+        # the last hourglass stack only feeds the eval branch, so not every parameter receives a gradient
+        device_ids = [device.index] if device.type == 'cuda' else None
+        net = nn.parallel.DistributedDataParallel(net, device_ids=device_ids, find_unused_parameters=True)
+    else:
+        net = nn.DataParallel(net)
     checkpoint.register_modules(net=net)
 
     '''Load scheduler'''
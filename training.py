@@ -6,8 +6,72 @@ import time
 import numpy as np
 import pickle
 import torch.nn as nn
+import contextlib
+from net_utils.train_test_utils import amp_autocast,get_grad_scaler,amp_parity_check,use_amp
+from net_utils.distributed import is_main_process,all_reduce_sum,NullSummaryWriter
 #torch.autograd.set_detect_anomaly(True)
 
+class LossAccumulator(object):
+    '''
+    keeps running sums of the loss dict on device, so the values only
+    travel to the host (one sync) when they are flushed.
+    '''
+    def __init__(self):
+        self.sums={}
+        self.count=0
+
+    def update(self,loss_dict):
+        with torch.no_grad():
+            for key in loss_dict:
+                value=torch.mean(torch.as_tensor(loss_dict[key]).detach().float())
+                if key in self.sums:
+                    self.sums[key]+=value
+                else:
+                    self.sums[key]=value.clone()
+        self.count+=1
+
+    def peek(self,reduce=False):
+        '''
+        :param reduce: average over all processes when running distributed
+        :return: dict of averaged python floats since the last flush, the sums are kept
+        '''
+        if self.count==0:
+            return {}
+        keys=list(self.sums.keys())
+        device=self.sums[keys[0]].device
+        values=torch.stack([self.sums[key].to(device) for key in keys]+[torch.tensor(float(self.count),device=device)])
+        if reduce:
+            all_reduce_sum(values)
+        values=(values[:-1]/values[-1]).cpu().tolist()
+        return dict(zip(keys,values))
+
+    def flush(self,reduce=False):
+        '''
+        :return: same as peek, then the sums are reset
+        '''
+        averages=self.peek(reduce)
+        self.sums={}
+        self.count=0
+        return averages
+
+def split_batch(data_batch,micro_batch_size):
+    '''
+    split a collated batch into micro-batches along the batch dimension.
+    :param micro_batch_size: samples per micro-batch, None keeps the batch whole
+    :return: list of (micro_batch, fraction of the full batch)
+    '''
+    batch_size=None
+    for key in data_batch:
+        batch_size=len(data_batch[key])
+        break
+    if not micro_batch_size or batch_size<=micro_batch_size:
+        return [(data_batch,1.0)]
+    micro_list=[]
+    for start in range(0,batch_size,micro_batch_size):
+        end=min(start+micro_batch_size,batch_size)
+        micro_list.append(({key:data_batch[key][start:end] for key in data_batch},(end-start)/batch_size))
+    return micro_list
+
 def Recon_trainer(cfg,model,optimizer,scheduler,train_loader,test_loader,device,checkpoint):
     start_t = time.time()
     config = cfg.config
@@ -15,61 +79,98 @@ def Recon_trainer(cfg,model,optimizer,scheduler,train_loader,test_loader,device,
     if os.path.exists(log_dir) == False:
         os.makedirs(log_dir)
     cfg.write_config()
-    tb_logger = SummaryWriter(log_dir)
+    tb_logger = SummaryWriter(log_dir) if is_main_process() else NullSummaryWriter()
     start_epoch = 0
+    scaler = get_grad_scaler(config, device)
+    if use_amp(config):
+        checkpoint.register_modules(scaler=scaler)
     if config["resume"] == True:
         checkpoint.load(config["weight"])
         start_epoch = scheduler.last_epoch
     if config['finetune']==True:
         start_epoch=0
     scheduler.last_epoch = start_epoch
+    if use_amp(config):
+        '''compare fp32 and mixed precision outputs on a fixed batch before training'''
+        for data_batch in test_loader:
+            break
+        for key in data_batch:
+            if isinstance(data_batch[key], list) == False:
+                data_batch[key] = data_batch[key].float().to(device)
+        parity = amp_parity_check(model, data_batch, config, device)
+        cfg.log_string("amp parity check: %s" % (parity))
     model.train()
     iter = 0
     min_eval_loss = 10000
+    log_interval = config['other'].get('log_interval', 1)
+    accumulation_steps = config['other'].get('accumulation_steps', 1)
+    micro_batch_size = config['other'].get('micro_batch_size', None)
+    step_per_iter = isinstance(scheduler, torch.optim.lr_scheduler.OneCycleLR)
+    train_metrics = LossAccumulator()
     for e in range(start_epoch, config['other']['nepoch']):
         cfg.log_string("Switch Phase to Train")
         model.train()
+        if hasattr(train_loader.sampler, 'set_epoch'):
+            train_loader.sampler.set_epoch(e)
         for batch_id, data_batch in enumerate(train_loader):
-            optimizer.zero_grad(set_to_none=True)
+            if batch_id % accumulation_steps == 0:
+                optimizer.zero_grad(set_to_none=True)
+            '''the optimizer steps every accumulation_steps loader batches, and at the end of the epoch'''
+            do_step = (batch_id + 1) % accumulation_steps == 0 or batch_id + 1 == len(train_loader)
+            group_size = min(accumulation_steps, len(train_loader) - batch_id // accumulation_steps * accumulation_steps)
             for key in data_batch:
                 if isinstance(data_batch[key], list) == False:
-                    data_batch[key] = data_batch[key].float().cuda()
-            est_data, loss_dict = model(data_batch)
-            total_loss = torch.mean(loss_dict["loss"])
-            total_loss.backward()
-            optimizer.step()
-            msg = "{:0>8},{}:{},[{}/{}],{}: {}".format(
-                str(datetime.timedelta(seconds=round(time.time() - start_t))),
-                "epoch",
-                e,
-                batch_id + 1,
-                len(train_loader),
-                "total_loss",
-                total_loss.item()
-            )
-            cfg.log_string(msg)
-            # iter += 1
-            for loss in loss_dict:
-                if "total" not in loss:
-                    tb_logger.add_scalar("train/" + loss, torch.mean(loss_dict[loss]).item(), iter)
-            tb_logger.add_scalar("train/total_loss", total_loss.item(), iter)
-            current_lr = optimizer.state_dict()['param_groups'][0]['lr']
-            tb_logger.add_scalar("train/lr", current_lr, iter)
+                    data_batch[key] = data_batch[key].float().to(device, non_blocking=True)
+            micro_list = split_batch(data_batch, micro_batch_size)
+            for micro_id, (micro_batch, fraction) in enumerate(micro_list):
+                '''gradients are only all-reduced on the backward right before the optimizer step'''
+                sync = do_step and micro_id == len(micro_list) - 1
+                no_sync = model.no_sync() if (not sync and hasattr(model, 'no_sync')) else contextlib.nullcontext()
+                with no_sync:
+                    with amp_autocast(config, device):
+                        est_data, loss_dict = model(micro_batch)
+                    # the losses are batch means, weight each micro-batch by its share of the effective batch
+                    total_loss = torch.mean(loss_dict["loss"]) * fraction / group_size
+                    scaler.scale(total_loss).backward()
+                train_metrics.update(loss_dict)
+            if do_step:
+                scaler.step(optimizer)
+                scaler.update()
+                if step_per_iter:
+                    scheduler.step()
+            if (batch_id + 1) % log_interval == 0 or batch_id + 1 == len(train_loader):
+                avg_loss = train_metrics.flush()
+                msg = "{:0>8},{}:{},[{}/{}],{}: {}".format(
+                    str(datetime.timedelta(seconds=round(time.time() - start_t))),
+                    "epoch",
+                    e,
+                    batch_id + 1,
+                    len(train_loader),
+                    "total_loss",
+                    avg_loss["loss"]
+                )
+                cfg.log_string(msg)
+                for loss in avg_loss:
+                    if "total" not in loss:
+                        tb_logger.add_scalar("train/" + loss, avg_loss[loss], iter)
+                tb_logger.add_scalar("train/total_loss", avg_loss["loss"], iter)
+                current_lr = optimizer.param_groups[0]['lr']
+                tb_logger.add_scalar("train/lr", current_lr, iter)
             if iter%config['other']['visualize_interval']==0:
-                rgb = data_batch["image"][0] * torch.tensor([0.229, 0.224, 0.225])[:, None, None].cuda() + torch.tensor(
-                    [0.485, 0.456, 0.406])[:, None, None].cuda()
+                rgb = micro_batch["image"][0] * torch.tensor([0.229, 0.224, 0.225])[:, None, None].to(device) + torch.tensor(
+                    [0.485, 0.456, 0.406])[:, None, None].to(device)
                 tb_logger.add_image("rgb", rgb, iter)
             if config['method']=="instPIFu":
                 if iter % config['other']['visualize_interval'] == 0 and config['data']['use_instance_mask']:
                     pred_mask=est_data["pred_mask"][0]
-                    gt_mask=data_batch['mask'][0]
+                    gt_mask=micro_batch['mask'][0]
                     tb_logger.add_image("gt_mask", gt_mask, iter)
                     tb_logger.add_image('pred_mask',pred_mask,iter)
-            if config["other"]["dump_result"]==True and iter%config["other"]["dump_interval"]==0 and config["phase"]=="reconstruction":
+            if config["other"]["dump_result"]==True and iter%config["other"]["dump_interval"]==0 and is_main_process() and config["phase"]=="reconstruction":
                 #gt_labels=data_batch['inside_class'][0]
                 pred_class=est_data['pred_class'][0]
-                sample_points=data_batch["samples"][0]
-                image=data_batch["image"][0]
+                sample_points=micro_batch["samples"][0]
+                image=micro_batch["image"][0]
                 save_dict={
                     "pred_class":pred_class.detach().cpu().numpy(),
                     "sample_points":sample_points.detach().cpu().numpy(),
@@ -79,45 +180,38 @@ def Recon_trainer(cfg,model,optimizer,scheduler,train_loader,test_loader,device,
                     pickle.dump(save_dict,f)
             iter += 1
         model.eval()
-        eval_loss = 0
-        eval_loss_info = {
-        }
+        eval_metrics = LossAccumulator()
         cfg.log_string("Switch Phase to Test")
         for batch_id, data_batch in enumerate(test_loader):
             for key in data_batch:
                 if isinstance(data_batch[key], list) == False:
-                    data_batch[key] = data_batch[key].float().cuda()
-            with torch.no_grad():
+                    data_batch[key] = data_batch[key].float().to(device, non_blocking=True)
+            with torch.no_grad(), amp_autocast(config, device):
                 est_data, loss_dict = model(data_batch)
-            total_loss = torch.mean(loss_dict["loss"])
-            msg = "{:0>8},{}:{},[{}/{}],{}: {}".format(
-                str(datetime.timedelta(seconds=round(time.time() - start_t))),
-                "epoch",
-                e,
-                batch_id + 1,
-                len(test_loader),
-                "test_loss",
-                total_loss.item()
-            )
-            for key in loss_dict:
-                if "total" not in key:
-                    if key not in eval_loss_info:
-                        eval_loss_info[key] = 0
-                    eval_loss_info[key] += torch.mean(loss_dict[key]).item()
-
-            total_loss = torch.mean(total_loss)
-            eval_loss += total_loss.item()
-            cfg.log_string(msg)
-        avg_eval_loss = eval_loss / (batch_id + 1)
-        for key in eval_loss_info:
-            eval_loss_info[key] = eval_loss_info[key] / (batch_id + 1)
-        print("eval_loss is", avg_eval_loss)
+            eval_metrics.update(loss_dict)
+            if (batch_id + 1) % log_interval == 0 or batch_id + 1 == len(test_loader):
+                '''running mean of this process, the epoch average below is reduced over all processes'''
+                running_loss = eval_metrics.peek()
+                msg = "{:0>8},{}:{},[{}/{}],{}: {}".format(
+                    str(datetime.timedelta(seconds=round(time.time() - start_t))),
+                    "epoch",
+                    e,
+                    batch_id + 1,
+                    len(test_loader),
+                    "test_loss",
+                    running_loss["loss"]
+                )
+                cfg.log_string(msg)
+        eval_loss_info = eval_metrics.flush(reduce=True)
+        avg_eval_loss = eval_loss_info["loss"]
+        cfg.log_string("eval_loss is %f" % (avg_eval_loss))
         tb_logger.add_scalar('eval/eval_loss', avg_eval_loss, e)
         for key in eval_loss_info:
-            tb_logger.add_scalar("eval/" + key, eval_loss_info[key], e)
+            if "total" not in key:
+                tb_logger.add_scalar("eval/" + key, eval_loss_info[key], e)
         if isinstance(scheduler, torch.optim.lr_scheduler.ReduceLROnPlateau):
             scheduler.step(avg_eval_loss)
-        else:
+        elif not step_per_iter:
             scheduler.step()
 
         checkpoint.register_modules(epoch=e, min_loss=avg_eval_loss)
@@ -126,4 +220,5 @@ def Recon_trainer(cfg,model,optimizer,scheduler,train_loader,test_loader,device,
             min_eval_loss = avg_eval_loss
         else:
             checkpoint.save("latest")
-        e += 1
\ No newline at end of file
+        e += 1
+    checkpoint.wait()
\ No newline at end of file
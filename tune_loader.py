@@ -0,0 +1,23 @@
+import yaml
+from net_utils.train_test_utils import load_device,get_dataloader
+from net_utils.loader_tuning import tune_loader,save_tuning,tuning_cache_path,recommended_block,machine_key
+
+def run(cfg):
+    config=cfg.config
+    tuning_cfg=config.get('loader_tuning',{})
+    device=load_device(cfg)
+
+    '''Load data'''
+    cfg.log_string('Loading dataset.')
+    loader=get_dataloader(config,mode=tuning_cfg.get('split','train'))
+
+    '''Measure the loader settings'''
+    machine=machine_key()
+    cfg.log_string('Tuning %s loader (batch size %d) on %s, %d cores for the loader workers.'%(
+        config['data']['dataset'],loader.batch_size,machine['hostname'],machine['loader_workers_available']))
+    settings,records=tune_loader(loader,tuning_cfg,device,cfg.log_string)
+
+    '''the cache path is where data.auto_tune_loader looks first, so training picks the result up on this machine'''
+    path=config['data'].get('loader_tuning_file') or tuning_cache_path(config)
+    save_tuning(path,settings,records)
+    cfg.log_string('Recommended loader settings, written to %s:\n%s'%(path,yaml.dump(recommended_block(settings),default_flow_style=False)))